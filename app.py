@@ -1,20 +1,15 @@
+import hashlib
 import io
 import os
-import re
+import warnings
 import zipfile
 from datetime import datetime
 
 df_itens = None  # V3: evita NameError antes do upload/processamento
-import pandas as pd
 import streamlit as st
 
-from utils.nfe_parser import parse_nfe_xml
-from utils.users import ensure_admin, authenticate
-from utils.base_legal import ensure_base_legal, load_tables, get_status
-from utils.validator import validar_itens
-
-from v3_corrector.correction_engine import apply_corrections
-from v3_corrector.xml_rewriter import rewrite_nfe_xml
+from utils.bootstrap import bootstrap
+from utils.users import authenticate, session_auth
 
 st.set_page_config(page_title="Agente XML Fiscal — v2", page_icon="🧾", layout="wide")
 
@@ -34,17 +29,17 @@ def _safe_secret(key: str, default: str) -> str:
 
 ADMIN_USER = _safe_secret("ADMIN_USER", "admin")
 ADMIN_PASS = _safe_secret("ADMIN_PASS", "admin123")
-ensure_admin(admin_username=ADMIN_USER, admin_password=ADMIN_PASS)
-
-# Ensure base legal templates exist
-ensure_base_legal()
+# Admin e Base Legal verificados uma vez por processo; os módulos da página e a
+# Base Legal compilada aquecem em segundo plano enquanto o login é exibido.
+bootstrap(ADMIN_USER, ADMIN_PASS)
 
 
 def require_login():
     if "auth" not in st.session_state:
         st.session_state.auth = None
 
-    if st.session_state.auth is None:
+    # sessão já logada: confere só o token assinado (sem refazer o PBKDF2 da senha)
+    if session_auth() is None:
         st.title("🔒 Login")
         st.caption("Acesso restrito. Solicite seu usuário e senha ao administrador.")
         with st.form("login_form", clear_on_submit=False):
@@ -64,6 +59,59 @@ def require_login():
 
 require_login()
 
+# Página principal: importada só depois do login (a tela de login abre sem pandas).
+# V3, reescrita do XML, correções manuais, vigência e exportações importam no ramo que os usa.
+import pandas as pd
+
+from utils.pipeline import items_frame
+from utils.product_catalog import get_catalog
+from utils.rule_profiles import DEFAULT_PROFILE, get_profile, load_profiles
+from utils.base_legal import get_base_legal, get_status
+from utils.validator import expand_v2, is_compact_v2, validar_itens, validar_itens_por_vigencia
+from utils.consolidation import ConsolidationCube, GROUPINGS
+from utils import instrumentation
+from utils.jobs import ACTIVE_STATES, is_stale, job_status, list_jobs, load_job_inputs, load_job_result, submit_job, submit_resume, submit_revalidation
+from utils.instrumentation import span
+from utils.result_grid import FrameSource, SqlSource, pager, result_grid, window_caption
+from utils.results_db import ResultsDB
+
+from v3_corrector.finding import expand_v3, is_compact_v3
+from v3_corrector.rules.ncm_similarity import ENGINES as NCM_ENGINES, available_engines, default_engine as default_ncm_engine
+
+
+def _export_on_demand(key: str, sig, build, label: str, suffix: str):
+    """Export file built only on click and reused while `sig` (data + options) holds.
+
+    build(path) writes the file in the session folder (utils.results_db); only
+    its path stays in session_state, so reruns from paging, sorting or filtering
+    the grids neither rebuild the export nor keep its bytes in memory.
+    """
+    cached = st.session_state.get(key)
+    if cached is not None and cached[0] == sig and cached[1].exists():
+        return cached[1]
+    if cached is not None:
+        cached[1].unlink(missing_ok=True)
+        st.session_state.pop(key, None)
+    if not st.button(label, key=f"{key}_gerar"):
+        return None
+    from utils.results_db import session_file_path
+
+    path = session_file_path(suffix)
+    with st.spinner("Gerando arquivo..."):
+        try:
+            build(path)
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+    st.session_state[key] = (sig, path)
+    return path
+
+
+def _download_file(path, label: str, file_name: str, mime: str) -> None:
+    with open(path, "rb") as fh:
+        st.download_button(label, data=fh, file_name=file_name, mime=mime)
+
+
 auth = st.session_state.auth
 st.sidebar.markdown("### aplicativo")
 st.sidebar.caption(f"Logado como: **{auth['username']}** ({auth.get('role','user')})")
@@ -71,6 +119,18 @@ if st.sidebar.button("Sair"):
     st.session_state.auth = None
     st.rerun()
 
+# Instrumentação por etapa (opcional): tempos, itens e pico de memória desta execução
+with st.sidebar.expander("⏱️ Desempenho", expanded=False):
+    perf_on = st.checkbox("Medir etapas", value=False, key="perf_on")
+    perf_mem = st.checkbox("Incluir pico de memória (tracemalloc)", value=False, key="perf_mem", disabled=not perf_on)
+# dono do tracemalloc = a sessão (cada rerun roda numa thread nova)
+_perf_owner = st.session_state.setdefault("_perf_owner", os.urandom(8).hex())
+if perf_on:
+    instrumentation.enable(memory=perf_mem, owner=_perf_owner)
+else:
+    instrumentation.disable(owner=_perf_owner)
+instrumentation.reset()
+
 st.title("🧾 Agente Leitor + Validador de XML Fiscal (NF-e) — v2")
 st.write(
     "Faça upload de **XML(s) de NF-e** (ou um **.zip** com vários XMLs). "
@@ -83,18 +143,44 @@ colA, colB, colC, colD = st.columns([2, 2, 2, 2])
 with colA:
     consolidar_por = st.selectbox(
         "Consolidar por",
-        ["xProd + NCM + CFOP", "cProd + NCM + CFOP", "NCM + CFOP", "xProd"],
+        list(GROUPINGS),
         index=0,
     )
 with colB:
     incluir_cabecalho = st.checkbox("Incorporar aba 'Cabeçalho NF-e'", value=True)
 with colC:
     gerar_csv = st.checkbox("Gerar CSV junto (opcional)", value=False)
+    gerar_colunar = st.checkbox("Gerar Parquet/Arrow (BI)", value=False, help="Itens, cabeçalhos, consolidado e achados V2/V3 em formato colunar tipado (ZIP).")
+    formato_colunar = st.radio("Formato colunar", ["parquet", "arrow"], horizontal=True, disabled=not gerar_colunar)
 with colD:
     executar_validacao = st.checkbox("Executar validação fiscal (Base Legal)", value=True)
     aplicar_correcao_v3 = st.checkbox("Aplicar correção automática (V3)", value=False, help="Aplica correções seguras por item (NCM/CFOP/CST) e permite baixar XML corrigido.")
+    # só os motores instalados (similaridade precisa do SciPy); NFE_NCM_ENGINE inválido cai no padrão
+    _motores = available_engines()
+    with warnings.catch_warnings(record=True) as _avisos:
+        warnings.simplefilter("always")
+        _motor_padrao = default_ncm_engine()
+    for _aviso in _avisos:
+        st.warning(str(_aviso.message))
+    motor_ncm = st.selectbox(
+        "Sugestão de NCM (V3)",
+        list(_motores),
+        index=list(_motores).index(_motor_padrao),
+        format_func=NCM_ENGINES.get,
+        help="Similaridade: compara n-gramas das descrições (pega abreviações como 'PARAF SEXT'), todos os itens de uma vez."
+        + ("" if len(_motores) == len(NCM_ENGINES) else " Indisponível: requer o pacote scipy."),
+    )
+    _perfis = load_profiles()
+    perfil_regras = st.selectbox("Perfil de regras (cliente)", list(_perfis), help="Perfis com regras desativadas são mantidos no Admin — Base Legal.") if len(_perfis) > 1 else DEFAULT_PROFILE
+    por_vigencia = st.checkbox(
+        "Base Legal vigente na emissão",
+        value=False,
+        help="Valida cada NF-e contra as tabelas em vigor no dhEmi (histórico de uploads e datas de vigência do Admin).",
+    )
+    processar_em_fila = st.checkbox("Processar em segundo plano (fila)", value=False, help="Envia o lote para processamento em background; acompanhe em 'Meus lotes' e abra o resultado quando concluir.")
 
 def _read_files(uploaded_files):
+    """(xml_payloads, digest): digest = SHA-1 of names + contents, the key of everything cached per batch."""
     xml_payloads = []
     for uf in uploaded_files or []:
         name = uf.name
@@ -109,63 +195,142 @@ def _read_files(uploaded_files):
                 st.warning(f"Falha ao ler ZIP {name}: {e}")
         elif name.lower().endswith(".xml"):
             xml_payloads.append((name, data))
-    return xml_payloads
-
-xml_files = _read_files(uploaded)
+    h = hashlib.sha1()
+    for name, payload in xml_payloads:
+        h.update(f"{name}\0{len(payload)}\0".encode("utf-8"))
+        h.update(payload)
+    return xml_payloads, h.hexdigest()
+
+# Uploads lidos (e ZIPs abertos) uma vez por conjunto de arquivos enviados: paginar, ordenar
+# ou filtrar as grades é um rerun e não deve reler nem reprocessar o lote.
+_upload_key = tuple((uf.file_id, uf.name, uf.size) for uf in uploaded or [])
+_cached_upload = st.session_state.get("_uploads")
+if _cached_upload is None or _cached_upload[0] != _upload_key:
+    with span("read_uploads") as _sp:
+        _cached_upload = (_upload_key, *_read_files(uploaded))
+        _sp.set(items=len(_cached_upload[1]))
+    st.session_state["_uploads"] = _cached_upload
+xml_files, upload_digest = _cached_upload[1], _cached_upload[2]
+
+
+def _jobs_panel_body(live: bool = False):
+    my_jobs = list_jobs(owner=auth["username"])
+    if not my_jobs:
+        return
+    active = [j for j in my_jobs if j.state in ACTIVE_STATES]
+    if live and not active:
+        st.rerun()  # terminou: rerun completo para parar o polling
+    with st.expander("🗂️ Meus lotes em segundo plano", expanded=bool(active)):
+        for j in active:
+            st.progress(j.progress, text=f"{j.job_id} — {j.state} {j.stage} ({j.done}/{j.total} arquivos, {j.items} itens)")
+        st.dataframe(
+            pd.DataFrame([{
+                "lote": j.job_id, "estado": j.state, "arquivos": j.total, "itens": j.items,
+                "erros_leitura": j.errors, "criado": j.created_at, "concluido": j.finished_at, "mensagem": j.message,
+            } for j in my_jobs]),
+            use_container_width=True, hide_index=True, height=180,
+        )
+        done = [j for j in my_jobs if j.state == "done"]
+        if done:
+            c1, c2, c3 = st.columns([3, 1, 1])
+            with c1:
+                sel = st.selectbox("Resultado", [j.job_id for j in done], key="job_sel", label_visibility="collapsed")
+            with c2:
+                if st.button("Abrir resultado"):
+                    st.session_state["job_loaded"] = sel
+                    st.rerun()
+            with c3:
+                sel_job = next(j for j in done if j.job_id == sel)
+                if is_stale(sel_job) and st.button(
+                    "Revalidar (Base Legal nova)",
+                    help="A Base Legal mudou desde o processamento: reavalia só os itens afetados pelos códigos incluídos/removidos/alterados.",
+                ):
+                    submit_revalidation(sel)
+                    st.rerun()
+        failed = [j for j in my_jobs if j.state == "failed"]
+        if failed:
+            c1, c2 = st.columns([3, 2])
+            with c1:
+                sel_f = st.selectbox("Lote com falha", [j.job_id for j in failed], key="job_sel_falha",
+                                     label_visibility="collapsed")
+            with c2:
+                if st.button("Retomar", help="Reaproveita os blocos já lidos e reprocessa só os que falharam."):
+                    submit_resume(sel_f)
+                    st.rerun()
+
+
+@st.fragment(run_every=3)
+def _jobs_panel_live():
+    _jobs_panel_body(live=True)
+
+
+# Fila: o lote vai para um worker em background em vez de rodar nesta sessão
+if processar_em_fila and xml_files:
+    batch_sig = upload_digest
+    if st.session_state.get("_job_submitted_sig") == batch_sig:
+        st.info("Este lote já foi enviado para a fila.")
+    elif st.button("📤 Enviar lote para a fila", type="primary"):
+        job_id = submit_job(xml_files, owner=auth["username"], options={
+            "executar_validacao": executar_validacao,
+            "aplicar_correcao_v3": aplicar_correcao_v3,
+            "ncm_engine": motor_ncm,
+            "perfil_regras": perfil_regras,
+            "por_vigencia": por_vigencia,
+        })
+        st.session_state["_job_submitted_sig"] = batch_sig
+        st.success(f"Lote {job_id} enviado ({len(xml_files)} arquivos).")
+    xml_files = []
+
+if any(j.state in ACTIVE_STATES for j in list_jobs(owner=auth["username"])):
+    _jobs_panel_live()
+else:
+    _jobs_panel_body()
+
+# Resultado de um lote em background aberto pelo usuário
+job_res = None
+job_opts = {}
+if not xml_files and st.session_state.get("job_loaded"):
+    _job_id = st.session_state["job_loaded"]
+    _st = job_status(_job_id)
+    _job_key = (_job_id, _st.finished_at if _st else "")  # revalidação regrava os achados
+    cached_job = st.session_state.get("_job_cache")
+    if cached_job is None or cached_job[0] != _job_key:
+        with st.spinner(f"Carregando lote {_job_id}..."):
+            cached_job = (_job_key, load_job_result(_job_id), load_job_inputs(_job_id), _st.options if _st else {})
+        st.session_state["_job_cache"] = cached_job
+    job_res, xml_files, job_opts = cached_job[1], cached_job[2], cached_job[3]
+    st.caption(f"Exibindo resultado do lote em background **{_job_id}**.")
 
 if xml_files:
-    headers = []
-    itens_all = []
-
-    with st.spinner("Lendo XML(s)..."):
-        for fname, payload in xml_files:
-            try:
-                parsed = parse_nfe_xml(payload)
-                h = parsed["header"]
-                h["arquivo"] = fname
-                headers.append(h)
-                for it in parsed["items"]:
-                    row = {}
-                    row.update(h)  # include header fields for traceability
-                    row.update(it)
-                    itens_all.append(row)
-            except Exception as e:
-                st.error(f"Erro ao processar {fname}: {e}")
-
-    if not itens_all:
+    if job_res is not None:
+        headers = job_res["cabecalho"].to_dict("records")
+        df_itens = job_res["itens"]
+        parse_errors = list(job_res["erros"].itertuples(index=False, name=None))
+    else:
+        cached_parse = st.session_state.get("_parsed")
+        if cached_parse is None or cached_parse[0] != upload_digest:
+            with st.spinner("Lendo XML(s)..."):
+                cached_parse = (upload_digest, *items_frame(xml_files))
+            st.session_state["_parsed"] = cached_parse
+        headers, df_itens, parse_errors = cached_parse[1], cached_parse[2], cached_parse[3]
+    for fname, err in parse_errors:
+        st.error(f"Erro ao processar {fname}: {err}")
+
+    if df_itens.empty:
         st.warning("Nenhum item encontrado nos XMLs enviados.")
         st.stop()
 
-    df_itens = pd.DataFrame(itens_all)
-
-    # numeric conversions (best-effort)
-    for c in ["qCom", "vUnCom", "vProd", "pICMS", "vICMS", "vNF"]:
-        if c in df_itens.columns:
-            df_itens[c] = pd.to_numeric(
-                df_itens[c].astype(str).str.replace(",", ".", regex=False),
-                errors="coerce",
-            )
-
     # Choose consolidation keys
-    if consolidar_por.startswith("xProd +"):
-        key_cols = ["xProd", "NCM", "CFOP"]
-    elif consolidar_por.startswith("cProd +"):
-        key_cols = ["cProd", "NCM", "CFOP"]
-    elif consolidar_por.startswith("NCM"):
-        key_cols = ["NCM", "CFOP"]
-    else:
-        key_cols = ["xProd"]
-
-    # Consolidate
-    agg = (
-        df_itens.groupby(key_cols, dropna=False, as_index=False)
-        .agg(
-            quantidade=("qCom", "sum"),
-            valor_total=("vProd", "sum"),
-            valor_unit_medio=("vUnCom", "mean"),
-        )
-        .sort_values(["valor_total"], ascending=False)
-    )
+    key_cols = GROUPINGS[consolidar_por]
+
+    # Consolidate: o cubo (grão xProd × cProd × NCM × CFOP) é montado uma vez por lote
+    # e reaproveitado entre reruns; trocar o agrupamento só faz o rollup do cubo.
+    cube_sig = (st.session_state.get("job_loaded"), None) if job_res is not None else (None, upload_digest)
+    cached = st.session_state.get("_consolidation_cube")
+    if cached is None or cached[0] != cube_sig:
+        cached = (cube_sig, ConsolidationCube.build(df_itens))
+        st.session_state["_consolidation_cube"] = cached
+    agg = cached[1].rollup(key_cols)
 # Validation
 df_findings = pd.DataFrame()
 df_findings_v3 = pd.DataFrame()
@@ -177,46 +342,106 @@ else:
 bl_status = get_status()
 tables = {}
 
-if executar_validacao:
+if executar_validacao and df_itens is not None:
     with st.spinner("Executando validações..."):
-        tables = load_tables()
-        # V2 - apontar erros/alertas
-        df_findings = validar_itens(df_itens, tables)
-        # V3 - sugerir correções (e aplicar se habilitado)
-        df_itens_corrigido, df_findings_v3 = apply_corrections(
-            df_itens, tables, auto_apply=aplicar_correcao_v3
-        )
+        tables = get_base_legal()
+        use_job = (job_res is not None and job_opts.get("executar_validacao")
+                   and is_compact_v2(job_res["achados_v2"]) and is_compact_v3(job_res["achados_v3"]))
+        # opções com que os achados foram (ou serão) calculados: também valem para o recálculo das correções manuais
+        val_opts = dict(job_opts) if use_job else {
+            "aplicar_correcao_v3": aplicar_correcao_v3, "ncm_engine": motor_ncm,
+            "perfil_regras": perfil_regras, "por_vigencia": por_vigencia,
+        }
+        val_key = (cube_sig, st.session_state.get("_job_cache", (None,))[0] if use_job else None,
+                   tables.version, tuple(sorted(val_opts.items())))
+        cached_val = st.session_state.get("_validation_state")
+        if cached_val is None or cached_val[0] != val_key:
+            from utils.manual_corrections import ManualState
+            from v3_corrector.correction_engine import apply_corrections, apply_corrections_por_vigencia
+            if use_job:
+                # lote em background: achados já calculados pelo worker
+                v2, v3, corr = job_res["achados_v2"], job_res["achados_v3"], job_res["itens_corrigido"]
+            elif por_vigencia:
+                # cada NF-e contra a Base Legal vigente no seu dhEmi
+                v2 = validar_itens_por_vigencia(df_itens, profile=get_profile(perfil_regras), compact=True)
+                corr, v3 = apply_corrections_por_vigencia(
+                    df_itens, auto_apply=aplicar_correcao_v3, ncm_engine=motor_ncm,
+                    catalog=get_catalog().snapshot(), profile=get_profile(perfil_regras), compact=True,
+                )
+            else:
+                # V2 - apontar erros/alertas
+                v2 = validar_itens(df_itens, tables, profile=get_profile(perfil_regras), compact=True)
+                # V3 - sugerir correções (e aplicar se habilitado)
+                corr, v3 = apply_corrections(
+                    df_itens, tables, auto_apply=aplicar_correcao_v3, ncm_engine=motor_ncm,
+                    catalog=get_catalog().snapshot(), profile=get_profile(perfil_regras), compact=True,
+                )
+            cached_val = (val_key, ManualState(df_itens, corr, v2, v3))
+            st.session_state["_validation_state"] = cached_val
+        val_state = cached_val[1]
+        # achados ficam compactos (item + regra); o texto legível só é montado para exibir/exportar
+        view = st.session_state.get("_findings_view")
+        if view is None or view[0] is not val_state.achados_v2 or view[1] is not val_state.achados_v3:
+            view = (val_state.achados_v2, val_state.achados_v3,
+                    expand_v2(val_state.achados_v2, df_itens), expand_v3(val_state.achados_v3))
+            st.session_state["_findings_view"] = view
+        df_findings, df_findings_v3 = view[2], view[3]
+        df_itens_corrigido = val_state.corrigido
+        # Consulta SQL local: itens e achados num SQLite indexado; filtros e agregações rodam no servidor
+        cached_db = st.session_state.get("_results_db")
+        if cached_db is None or cached_db[0] is not val_state.achados_v2 or cached_db[1] is not val_state.achados_v3:
+            from utils.results_db import SESSION_DIR, build_results_db, ensure_dir_db, session_db_path
+            if cached_db is not None and cached_db[2].parent == SESSION_DIR:
+                cached_db[2].unlink(missing_ok=True)
+            if use_job and val_state.achados_v2 is job_res["achados_v2"] and val_state.achados_v3 is job_res["achados_v3"]:
+                # lote em background sem correções manuais: o arquivo do próprio lote
+                from utils.jobs import job_dir
+                db_path = ensure_dir_db(job_dir(st.session_state["job_loaded"]) / "results")
+            else:
+                db_path = build_results_db(session_db_path(), df_itens, pd.DataFrame(headers),
+                                           val_state.achados_v2, val_state.achados_v3)
+            cached_db = (val_state.achados_v2, val_state.achados_v3, db_path)
+            st.session_state["_results_db"] = cached_db
+        results_db = ResultsDB(cached_db[2])
+        if not use_job:
+            # Catálogo: itens com NCM da Tabela NCM viram conhecimento (uma vez por NF-e)
+            if st.session_state.get("_catalog_learned") != cube_sig:
+                get_catalog().learn(df_itens, tables.allowed_ncms)
+                st.session_state["_catalog_learned"] = cube_sig
     # UI tabs
-    tabs = st.tabs(["Itens (leitura bruta)", "Consolidado", "Validação", "Base Legal (status)"])
+    tabs = st.tabs(["Itens (leitura bruta)", "Consolidado", "Validação", "Base Legal (status)", "Consulta"])
 
+    # grades paginadas: filtros e ordenação rodam no servidor, só a página visível vai para o navegador
     with tabs[0]:
         st.subheader("Itens (det/prod) — leitura bruta")
-        st.dataframe(df_itens, use_container_width=True, height=360)
+        result_grid(SqlSource(results_db, "itens"), "g_itens", columns=list(df_itens.columns),
+                    filters=("arquivo", "NCM", "CFOP", "texto"))
 
     with tabs[1]:
         st.subheader("Consolidado")
-        st.dataframe(agg, use_container_width=True, height=360)
+        result_grid(FrameSource(agg), "g_agg", filters=("NCM", "CFOP", "texto"))
 
-if aplicar_correcao_v3 and not df_itens_corrigido.empty:
+# estado dos dados na tela: o arquivo de consulta é refeito a cada novo conjunto de achados
+export_sig = None
+if df_itens is not None:
+    export_sig = (cube_sig, str(results_db.path) if executar_validacao else None)
+
+if aplicar_correcao_v3 and df_itens_corrigido is not None and not df_itens_corrigido.empty:
     st.markdown("#### Consolidado (após correção automática V3)")
     try:
-        agg2 = (
-            df_itens_corrigido.assign(
-                vProd_num=pd.to_numeric(df_itens_corrigido.get("vProd", 0), errors="coerce").fillna(0),
-                qCom_num=pd.to_numeric(df_itens_corrigido.get("qCom", 0), errors="coerce").fillna(0),
-                vUnCom_num=pd.to_numeric(df_itens_corrigido.get("vUnCom", 0), errors="coerce").fillna(0),
-            )
-            .groupby(group_cols, dropna=False)
-            .agg(
-                arquivos=("arquivo", "nunique"),
-                itens=("nItem", "count"),
-                quantidade=("qCom_num", "sum"),
-                valor_total=("vProd_num", "sum"),
-                valor_unitario=("vUnCom_num", "mean"),
-            )
-            .sort_values(["valor_total"], ascending=False)
-        )
-        st.dataframe(agg2, use_container_width=True, height=260)
+        # o cubo pós-correção também é montado uma vez: o DataFrame corrigido só muda de
+        # identidade quando a validação ou uma correção manual o recalcula
+        if executar_validacao:
+            cube2 = st.session_state.get("_consolidation_cube_v3")
+            if cube2 is None or cube2[0] is not df_itens_corrigido:
+                cube2 = (df_itens_corrigido, ConsolidationCube.build(df_itens_corrigido))
+                st.session_state["_consolidation_cube_v3"] = cube2
+            cube2 = cube2[1]
+        else:
+            # sem validação nada foi corrigido: o cubo bruto vale
+            cube2 = st.session_state["_consolidation_cube"][1]
+        agg2 = cube2.rollup(key_cols)
+        result_grid(FrameSource(agg2), "g_agg2", filters=("NCM", "CFOP", "texto"), height=260)
     except Exception:
         st.warning("Não foi possível gerar o consolidado pós-correção.")
 
@@ -235,7 +460,7 @@ if aplicar_correcao_v3 and not df_itens_corrigido.empty:
                     st.metric("Erros", int((df_findings["severidade"] == "ERRO").sum()))
                 with c2:
                     st.metric("Alertas", int((df_findings["severidade"] == "ALERTA").sum()))
-                st.dataframe(df_findings, use_container_width=True, height=260)
+                result_grid(SqlSource(results_db, "achados_v2"), "g_v2", columns=list(df_findings.columns), height=260)
 
             st.markdown("### 🛠️ Correções sugeridas (V3)")
             if df_findings_v3.empty:
@@ -249,160 +474,120 @@ if aplicar_correcao_v3 and not df_itens_corrigido.empty:
                 with c5:
                     st.metric("Aplicadas", int((df_findings_v3["aplicado"] == True).sum()) if "aplicado" in df_findings_v3.columns else 0)
 
-                st.dataframe(df_findings_v3, use_container_width=True, height=320)
+                result_grid(SqlSource(results_db, "achados_v3"), "g_v3", columns=list(df_findings_v3.columns), height=320)
                 # V3: Correção manual de NCM (quando não há correspondência segura na Tabela NCM)
-                try:
-                    ncm_table = (tables or {}).get("ncm", pd.DataFrame())
-                    allowed_ncms = set()
-                    if ncm_table is not None and not ncm_table.empty and "ncm" in ncm_table.columns:
-                        allowed_ncms = {re.sub(r"\D+","", str(x)).zfill(8)[:8] for x in ncm_table["ncm"].astype(str).tolist()}
-                        allowed_ncms = {n for n in allowed_ncms if n and n != "00000000" and not n.startswith("00")}
-                except Exception:
-                    allowed_ncms = set()
-
-                df_zero = df_itens_corrigido.copy() if df_itens_corrigido is not None else pd.DataFrame()
-                if df_zero is not None and not df_zero.empty:
-                    # base para seleção de correções manuais:
-                    #  - NCM zerado (00000000)
-                    #  - NCM que não consta na Tabela NCM (quando houver)
-                    #  - Itens com a MESMA descrição aparecendo com NCMs diferentes no lote (mesmo que o NCM exista na tabela)
-                    cand = df_zero.copy()
-                    cand["_ncm8"] = cand.get("NCM","").astype(str).apply(lambda x: re.sub(r"\D+","", x).zfill(8)[:8])
-                    cand["_desc_key"] = (
-                        cand.get("xProd","").astype(str)
-                        .str.lower()
-                        .str.replace(r"[^a-z0-9]+", " ", regex=True)
-                        .str.replace(r"\s+", " ", regex=True)
-                        .str.strip()
-                    )
-
-                    # descrições com divergência de NCM no mesmo lote
-                    try:
-                        div_descs = set(
-                            cand.groupby("_desc_key")["_ncm8"].nunique(dropna=False)
-                            .loc[lambda s: s > 1]
-                            .index.tolist()
+                allowed_ncms = tables.allowed_ncms
+
+                # base para seleção de correções manuais (índice e normalizações do lote ficam em val_state):
+                #  - NCM zerado (00000000)
+                #  - NCM que não consta na Tabela NCM (quando houver)
+                #  - Itens com a MESMA descrição aparecendo com NCMs diferentes no lote (mesmo que o NCM exista na tabela)
+                cand_pos = val_state.candidates(allowed_ncms)
+                # NCMs digitados (posição do item -> código), mantidos ao trocar de página
+                if st.session_state.get("_manual_edits", (None,))[0] is not val_state:
+                    st.session_state["_manual_edits"] = (val_state, {})
+                manual_edits = st.session_state["_manual_edits"][1]
+                if len(cand_pos):
+                    with st.expander("✍️ Informar NCM manualmente (campo Correção sugerida)", expanded=True):
+                        st.caption(
+                            "Quando o NCM não consta na sua Tabela NCM (base legal), vem como 00000000, ou houver divergência de NCM para a mesma descrição no lote, "
+                            "preencha o NCM correto em **Correção sugerida**. "
+                            "O sistema só aplica se o código informado existir na Tabela NCM."
                         )
-                    except Exception:
-                        div_descs = set()
-
-                    mask = (cand["_ncm8"] == "00000000") | (cand["_desc_key"].isin(div_descs))
-                    if allowed_ncms:
-                        mask = mask | (~cand["_ncm8"].isin(list(allowed_ncms)))
-                    cand = cand[mask]
-
-                    if not cand.empty:
-                        with st.expander("✍️ Informar NCM manualmente (campo Correção sugerida)", expanded=True):
-                            st.caption(
-                                "Quando o NCM não consta na sua Tabela NCM (base legal), vem como 00000000, ou houver divergência de NCM para a mesma descrição no lote, "
-                                "preencha o NCM correto em **Correção sugerida**. "
-                                "O sistema só aplica se o código informado existir na Tabela NCM."
-                            )
+                        cand_off, cand_size = pager("g_cand", len(cand_pos))
+                        page_pos = cand_pos[cand_off:cand_off + cand_size]
+
+                        def _edit_frame(pos):
+                            cand = df_itens_corrigido.iloc[pos]
                             edit_df = cand[["arquivo","nItem","xProd","NCM"]].copy() if "arquivo" in cand.columns else cand[["nItem","xProd","NCM"]].copy()
                             edit_df = edit_df.rename(columns={"NCM":"valor_atual"})
-                            edit_df["correcao_sugerida"] = ""
-
-                            edited = st.data_editor(
-                                edit_df,
-                                use_container_width=True,
-                                hide_index=True,
-                                column_config={
-                                    "correcao_sugerida": st.column_config.TextColumn(
-                                        "correcao_sugerida",
-                                        help="Informe 8 dígitos (ex.: 08119000).",
-                                    ),
-                                    "valor_atual": st.column_config.TextColumn("valor_atual", disabled=True),
-                                    "xProd": st.column_config.TextColumn("xProd", disabled=True),
-                                },
+                            edit_df["correcao_sugerida"] = [manual_edits.get(int(p), "") for p in pos]
+                            return edit_df
+
+                        edited_page = st.data_editor(
+                            _edit_frame(page_pos),
+                            key=f"cand_editor_{cand_off}_{cand_size}",
+                            use_container_width=True,
+                            hide_index=True,
+                            column_config={
+                                "correcao_sugerida": st.column_config.TextColumn(
+                                    "correcao_sugerida",
+                                    help="Informe 8 dígitos (ex.: 08119000).",
+                                ),
+                                "valor_atual": st.column_config.TextColumn("valor_atual", disabled=True),
+                                "xProd": st.column_config.TextColumn("xProd", disabled=True),
+                            },
+                        )
+                        for p, v in zip(page_pos, edited_page["correcao_sugerida"].fillna("").astype(str).str.strip()):
+                            if v:
+                                manual_edits[int(p)] = v
+                            else:
+                                manual_edits.pop(int(p), None)
+                        window_caption(cand_off, len(page_pos), len(cand_pos))
+                        if manual_edits:
+                            st.caption(f"{len(manual_edits)} NCM(s) informado(s) no total (todas as páginas).")
+
+                        if st.button("Aplicar correções manuais (NCM)", type="primary"):
+                            edited = _edit_frame(list(manual_edits))
+                            from utils.manual_corrections import apply_manual_ncm
+                            if val_opts.get("por_vigencia"):
+                                from utils.base_legal_history import split_by_vigencia
+
+                                def _groups(itens, pos):
+                                    return [(bl, pos[g]) for bl, g in split_by_vigencia(itens.iloc[pos])]
+                            else:
+                                def _groups(itens, pos):
+                                    return [(tables, pos)]
+                            res = apply_manual_ncm(
+                                val_state, edited, allowed_ncms, _groups,
+                                auto_apply=bool(val_opts.get("aplicar_correcao_v3")), ncm_engine=val_opts.get("ncm_engine"),
+                                catalog=get_catalog().snapshot(), profile=get_profile(val_opts.get("perfil_regras")),
                             )
-
-                            if st.button("Aplicar correções manuais (NCM)", type="primary"):
-                                applied_ct = 0
-                                rejected_ct = 0
-                                for i, rowm in edited.iterrows():
-                                    ncm8 = re.sub(r"\D+","", str(rowm.get("correcao_sugerida",""))).zfill(8)[:8]
-                                    if not ncm8 or ncm8 == "00000000" or ncm8.startswith("00"):
-                                        continue
-                                    if allowed_ncms and ncm8 not in allowed_ncms:
-                                        rejected_ct += 1
-                                        continue
-
-                                    # localizar o item correspondente (mesmo arquivo e nItem quando existir)
-                                    if "arquivo" in edited.columns and "arquivo" in df_itens_corrigido.columns:
-                                        mask = (df_itens_corrigido["arquivo"] == rowm.get("arquivo")) & (df_itens_corrigido["nItem"].astype(str) == str(rowm.get("nItem")))
-                                        idxs = df_itens_corrigido.index[mask].tolist()
-                                        if idxs:
-                                            df_itens_corrigido.at[idxs[0], "NCM"] = ncm8
-                                            applied_ct += 1
-                                    else:
-                                        # fallback por nItem
-                                        mask = (df_itens_corrigido["nItem"].astype(str) == str(rowm.get("nItem")))
-                                        idxs = df_itens_corrigido.index[mask].tolist()
-                                        if idxs:
-                                            df_itens_corrigido.at[idxs[0], "NCM"] = ncm8
-                                            applied_ct += 1
-
-                                if applied_ct:
-                                    st.success(f"NCMs manuais aplicados: {applied_ct}")
-                                if rejected_ct:
-                                    st.warning(f"NCMs rejeitados (não constam na Tabela NCM): {rejected_ct}")
-                    else:
-                        pass
-                else:
-                    pass
+                            if res.aplicados:
+                                # correções aceitas alimentam o catálogo de produtos
+                                conf = val_state.corrigido.iloc[res.posicoes]
+                                get_catalog().confirm(zip(
+                                    conf.get("emit_CNPJ", pd.Series("", index=conf.index)),
+                                    conf.get("cProd", pd.Series("", index=conf.index)),
+                                    conf.get("xProd", pd.Series("", index=conf.index)),
+                                    conf["NCM"],
+                                ))
+                            # achados e candidatos já recalculados: mostra o resultado no próximo ciclo
+                            st.session_state["_manual_msgs"] = (res.aplicados, res.rejeitados)
+                            st.session_state.pop("_manual_edits", None)
+                            st.rerun()
+                _applied_ct, _rejected_ct = st.session_state.pop("_manual_msgs", (0, 0))
+                if _applied_ct:
+                    st.success(f"NCMs manuais aplicados: {_applied_ct}")
+                if _rejected_ct:
+                    st.warning(f"NCMs rejeitados (não constam na Tabela NCM): {_rejected_ct}")
 
 # Download corrected XMLs (ZIP) when auto-correction is enabled
             if aplicar_correcao_v3 and not df_findings_v3.empty:
                 st.divider()
                 st.markdown("### 📦 Saída (V3) — Download dos XMLs corrigidos")
 
-                # build zip in memory
-                zip_buf = io.BytesIO()
-                with zipfile.ZipFile(zip_buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-                    for fname, payload in xml_files:
-                        try:
-                            df_o = df_itens[df_itens["arquivo"] == fname].copy()
-                            df_c = df_itens_corrigido[df_itens_corrigido["arquivo"] == fname].copy()
-
-                            changes_by_nitem = {}
-                            if "nItem" in df_o.columns and "nItem" in df_c.columns:
-                                df_o = df_o.set_index("nItem")
-                                df_c = df_c.set_index("nItem")
-
-                                common = df_o.index.intersection(df_c.index)
-                                for nItem in common:
-                                    ch = {}
-                                    for col, key in [("NCM","NCM"),("CFOP","CFOP"),("CST_ICMS","CST"),("CSOSN","CSOSN")]:
-                                        if col in df_o.columns and col in df_c.columns:
-                                            v0 = str(df_o.at[nItem, col] or "")
-                                            v1 = str(df_c.at[nItem, col] or "")
-                                            if v0.strip() != v1.strip():
-                                                ch[key] = v1
-                                    if ch:
-                                        changes_by_nitem[str(nItem)] = ch
-
-                            corrected = rewrite_nfe_xml(payload, changes_by_nitem) if changes_by_nitem else payload
-                            out_name = fname.replace(".xml", "_corrigido.xml")
+                def _zip_corrigidos(path) -> None:
+                    from utils.batch import rewrite_files
+
+                    with span("rewrite_zip", items=len(xml_files)), zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                        for out_name, corrected in rewrite_files(xml_files, df_itens, df_itens_corrigido):
                             zf.writestr(out_name, corrected)
-                        except Exception:
-                            # fallback: keep original if something fails for this file
-                            zf.writestr(fname, payload)
-
-                zip_buf.seek(0)
-                st.download_button(
-                    "📥 Baixar ZIP com XMLs corrigidos (V3)",
-                    data=zip_buf.getvalue(),
-                    file_name=f"xmls_corrigidos_v3_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
-                    mime="application/zip",
-                )
+
+                # arquivos gerados sob demanda: reruns da página reaproveitam o arquivo
+                zip_path = _export_on_demand("_exp_zip_v3", export_sig, _zip_corrigidos,
+                                             "Gerar ZIP com XMLs corrigidos (V3)", ".zip")
+                if zip_path is not None:
+                    _download_file(zip_path, "📥 Baixar ZIP com XMLs corrigidos (V3)",
+                                   f"xmls_corrigidos_v3_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip", "application/zip")
 
                 # Also allow download of corrected items table
-                st.download_button(
-                    "📥 Baixar relatório de correções (CSV)",
-                    data=df_itens_corrigido.to_csv(index=False).encode("utf-8-sig"),
-                    file_name=f"itens_corrigidos_v3_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                    mime="text/csv",
-                )
+                csv_corr = _export_on_demand("_exp_csv_v3", export_sig,
+                                             lambda path: df_itens_corrigido.to_csv(path, index=False, encoding="utf-8-sig"),
+                                             "Gerar relatório de correções (CSV)", ".csv")
+                if csv_corr is not None:
+                    _download_file(csv_corr, "📥 Baixar relatório de correções (CSV)",
+                                   f"itens_corrigidos_v3_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv", "text/csv")
     with tabs[3]:
         st.subheader("Status da Base Legal vigente")
         st.caption("Para substituir a Base Legal, use a página **📚 Admin — Base Legal** no menu lateral (apenas ADMIN).")
@@ -410,39 +595,118 @@ if aplicar_correcao_v3 and not df_itens_corrigido.empty:
             {"tabela": "NCM", "arquivo": "ncm_regras.xlsx", "linhas": bl_status["ncm"].rows, "status": bl_status["ncm"].message},
             {"tabela": "CFOP", "arquivo": "cfop_regras.xlsx", "linhas": bl_status["cfop"].rows, "status": bl_status["cfop"].message},
             {"tabela": "CST/CSOSN", "arquivo": "cst_csosn_regras.xlsx", "linhas": bl_status["cst"].rows, "status": bl_status["cst"].message},
+            {"tabela": "CFOP × CST/CSOSN", "arquivo": "cfop_cst_regras.xlsx", "linhas": bl_status["cfop_cst"].rows, "status": bl_status["cfop_cst"].message},
         ]))
 
+    with tabs[4]:
+        st.subheader("Consulta (SQL local)")
+        if not executar_validacao:
+            st.info("Validação desativada no topo. Marque a opção para consultar itens e achados.")
+        else:
+            from utils.results_db import GROUPINGS as Q_GROUPINGS, TABLES as Q_TABLES, Filters
+
+            qdb = results_db
+            st.caption("Filtros e agrupamentos rodam no servidor; só o resultado vem para a tela.")
+            q1, q2, q3, q4 = st.columns(4)
+            with q1:
+                q_tabela = st.selectbox("Tabela", Q_TABLES, index=Q_TABLES.index("achados"), key="q_tabela")
+                q_emit = st.text_input("Emitente (CNPJ)", key="q_emit")
+            with q2:
+                q_de = st.text_input("dhEmi de", placeholder="AAAA-MM-DD", key="q_de")
+                q_ate = st.text_input("dhEmi até", placeholder="AAAA-MM-DD", key="q_ate")
+            with q3:
+                q_ncm = st.text_input("NCM (capítulo, posição ou código)", key="q_ncm")
+                q_cfop = st.text_input("CFOP", key="q_cfop")
+            with q4:
+                q_regra = st.multiselect("Regra", qdb.distinct("achados", "regra"), key="q_regra")
+                q_sev = st.multiselect("Severidade", qdb.distinct("achados", "severidade"), key="q_sev")
+            q_texto = st.text_input("Texto (descrição / mensagem)", key="q_texto")
+            q_agrupar = st.multiselect("Agrupar por", list(Q_GROUPINGS), key="q_agrupar")
+            q_flt = Filters(emitente=q_emit, de=q_de, ate=q_ate, ncm=q_ncm, cfop=q_cfop,
+                            regra=q_regra, severidade=q_sev, texto=q_texto)
+            try:
+                if q_agrupar:
+                    st.dataframe(qdb.aggregate(q_tabela, q_agrupar, q_flt, limit=1000),
+                                 use_container_width=True, hide_index=True, height=360)
+                else:
+                    q_total = qdb.count(q_tabela, q_flt)
+                    st.caption(f"{q_total} linha(s) no filtro; exibindo até 500.")
+                    st.dataframe(qdb.select(q_tabela, q_flt, limit=500),
+                                 use_container_width=True, hide_index=True, height=360)
+            except ValueError as e:
+                st.warning(str(e))
+
     # Downloads
     st.divider()
     st.subheader("Exportações")
 
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+    # Cada arquivo é gerado só quando pedido (botão "Gerar") e fica em disco enquanto
+    # os dados e as opções não mudam: paginar/ordenar/filtrar as grades não refaz a exportação.
+
+    def _xlsx(path) -> None:
+        from utils.excel_export import ExcelSheet, write_excel_streaming
+
+        # Exportação em modo constant_memory (linha a linha, direto no arquivo);
+        # tabelas acima do limite do Excel viram Itens_Bruto_1..N.
+        sheets = []
         if incluir_cabecalho:
-            pd.DataFrame(headers).to_excel(writer, sheet_name="Cabecalho_NFe", index=False)
-        df_itens.to_excel(writer, sheet_name="Itens_Bruto", index=False)
-        agg.to_excel(writer, sheet_name="Consolidado", index=False)
+            sheets.append(ExcelSheet("Cabecalho_NFe", pd.DataFrame(headers)))
+        sheets.append(ExcelSheet("Itens_Bruto", df_itens))
+        sheets.append(ExcelSheet("Consolidado", agg))
         if executar_validacao:
-            df_findings.to_excel(writer, sheet_name="Validacao", index=False)
-    buffer.seek(0)
-
-    st.download_button(
-        "📥 Baixar Excel (com abas)",
-        data=buffer,
-        file_name=f"xml_fiscal_v2_{ts}.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+            sheets.append(ExcelSheet("Validacao", df_findings))
+        write_excel_streaming(sheets, path)
+
+    xlsx_path = _export_on_demand("_exp_xlsx", (export_sig, consolidar_por, incluir_cabecalho), _xlsx,
+                                  "Gerar Excel (com abas)", ".xlsx")
+    if xlsx_path is not None:
+        _download_file(xlsx_path, "📥 Baixar Excel (com abas)", f"xml_fiscal_v2_{ts}.xlsx",
+                       "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
     if gerar_csv:
-        st.download_button(
-            "📥 Baixar CSV (Itens_Bruto)",
-            data=df_itens.to_csv(index=False).encode("utf-8-sig"),
-            file_name=f"itens_bruto_{ts}.csv",
-            mime="text/csv",
-        )
+        csv_path = _export_on_demand("_exp_csv", export_sig,
+                                     lambda path: df_itens.to_csv(path, index=False, encoding="utf-8-sig"),
+                                     "Gerar CSV (Itens_Bruto)", ".csv")
+        if csv_path is not None:
+            _download_file(csv_path, "📥 Baixar CSV (Itens_Bruto)", f"itens_bruto_{ts}.csv", "text/csv")
+
+    if gerar_colunar:
+        def _colunar(path) -> None:
+            from utils.columnar_export import columnar_zip
+
+            colunar_tables = {
+                "itens": df_itens,
+                "cabecalho": pd.DataFrame(headers),
+                "consolidado": agg,
+                "achados_v2": df_findings,
+                "achados_v3": df_findings_v3,
+            }
+            path.write_bytes(columnar_zip(colunar_tables, fmt=formato_colunar))
+
+        try:
+            colunar_path = _export_on_demand("_exp_colunar", (export_sig, consolidar_por, formato_colunar), _colunar,
+                                             f"Gerar {formato_colunar.capitalize()} (ZIP)", ".zip")
+        except ImportError:
+            colunar_path = None
+            st.warning("Exportação Parquet/Arrow requer o pacote pyarrow.")
+        if colunar_path is not None:
+            _download_file(colunar_path, f"📥 Baixar {formato_colunar.capitalize()} (ZIP: itens, cabeçalho, consolidado, achados)",
+                           f"xml_fiscal_{formato_colunar}_{ts}.zip", "application/zip")
 
 else:
     st.info("Envie ao menos 1 XML ou 1 ZIP contendo XMLs para começar.")
 
-st.caption("Admin: gerenciamento de usuários e Base Legal ficam nas páginas do menu lateral (apenas admin).")
\ No newline at end of file
+st.caption("Admin: gerenciamento de usuários e Base Legal ficam nas páginas do menu lateral (apenas admin).")
+
+if instrumentation.is_enabled():
+    _spans = instrumentation.get_spans()
+    with st.sidebar.expander("⏱️ Desempenho — última execução", expanded=True):
+        if _spans:
+            _perf = pd.DataFrame(_spans)
+            _perf["etapa"] = _perf["depth"].map(lambda d: "· " * int(d)) + _perf["span"]
+            _cols = [c for c in ["etapa", "seconds", "items", "items_per_s", "peak_mb"] if c in _perf.columns]
+            st.dataframe(_perf[_cols], use_container_width=True, hide_index=True)
+            st.caption(f"Total (etapas raiz): {_perf.loc[_perf['depth'] == 0, 'seconds'].sum():.2f}s")
+        else:
+            st.caption("Nenhuma etapa registrada nesta execução.")
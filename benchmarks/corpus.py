@@ -0,0 +1,140 @@
+"""Synthetic NF-e corpus for benchmarks.
+
+Generates realistic-looking NF-e XMLs (nfeProc/NFe/infNFe with det/prod/imposto)
+and Base Legal tables of realistic size. Everything is deterministic per seed.
+"""
+from __future__ import annotations
+
+import random
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Tuple
+from xml.sax.saxutils import escape
+
+import pandas as pd
+
+NFE_NS = "http://www.portalfiscal.inf.br/nfe"
+
+# Modalidades ICMS geradas: (nó, tag do código, código)
+ICMS_MODALITIES: List[Tuple[str, str, str]] = [
+    ("ICMS00", "CST", "00"),
+    ("ICMS10", "CST", "10"),
+    ("ICMS20", "CST", "20"),
+    ("ICMS60", "CST", "60"),
+    ("ICMSSN102", "CSOSN", "102"),
+    ("ICMSSN500", "CSOSN", "500"),
+]
+
+CFOPS = ["5101", "5102", "5401", "5405", "6102", "6108", "5202", "5949"]
+
+_WORDS = [
+    "PARAF", "SEXT", "PORCA", "ARRUELA", "REFRIG", "SUCO", "AGUA", "MINERAL", "CABO",
+    "FLEX", "TOMADA", "INTERR", "LAMP", "LED", "TINTA", "ACRIL", "CANO", "PVC",
+    "JOELHO", "LUVA", "FITA", "ISOL", "CHAVE", "FENDA", "ALICATE", "MARTELO",
+    "BROCA", "ACO", "RAPIDO", "PARAFUSO", "DISJUNTOR", "BIPOLAR", "CAIXA", "PAPELAO",
+]
+_SIZES = ["2L", "600ML", "1/4", "3/8", "10MM", "20A", "5M", "100UN", "18L", "9W"]
+
+
+@dataclass
+class CorpusSpec:
+    docs: int = 200
+    items_per_doc: int = 20
+    namespaces: bool = True
+    zero_ncm_ratio: float = 0.05        # itens com NCM 00000000
+    duplicate_desc_ratio: float = 0.30  # itens que repetem descrição de outro produto
+    catalog_size: int = 2_000           # produtos distintos
+    ncm_rows: int = 10_000              # linhas da tabela NCM (TIPI ~10k códigos)
+    seed: int = 42
+    modalities: List[Tuple[str, str, str]] = field(default_factory=lambda: list(ICMS_MODALITIES))
+
+
+def _ncm_code(rng: random.Random) -> str:
+    return f"{rng.randint(1, 97):02d}{rng.randint(0, 999999):06d}"
+
+
+def _desc(rng: random.Random) -> str:
+    return " ".join(rng.sample(_WORDS, rng.randint(2, 4)) + [rng.choice(_SIZES)])
+
+
+def make_ncm_table(spec: CorpusSpec) -> pd.DataFrame:
+    rng = random.Random(spec.seed + 1)
+    codes = set()
+    while len(codes) < spec.ncm_rows:
+        codes.add(_ncm_code(rng))
+    rows = [{"ncm": c, "descricao": _desc(rng).lower()} for c in sorted(codes)]
+    return pd.DataFrame(rows)
+
+
+def make_tables(spec: CorpusSpec) -> Dict[str, pd.DataFrame]:
+    """Base Legal tables in the shape returned by utils.base_legal.load_tables()."""
+    ncm = make_ncm_table(spec)
+    cfop = pd.DataFrame([{"cfop": c, "descricao": f"CFOP {c}"} for c in CFOPS])
+    cst = pd.DataFrame(
+        [{"codigo": c, "tipo": "CST", "descricao": f"CST {c}"} for c in ["00", "10", "20", "40", "41", "60", "90"]]
+        + [{"codigo": c, "tipo": "CSOSN", "descricao": f"CSOSN {c}"} for c in ["101", "102", "103", "300", "400", "500", "900"]]
+    )
+    return {"ncm": ncm, "cfop": cfop, "cst": cst}
+
+
+def _catalog(spec: CorpusSpec, ncm_codes: List[str]) -> List[Dict[str, str]]:
+    rng = random.Random(spec.seed + 2)
+    catalog = []
+    for i in range(spec.catalog_size):
+        if catalog and rng.random() < spec.duplicate_desc_ratio:
+            desc = rng.choice(catalog)["xProd"]
+        else:
+            desc = _desc(rng)
+        catalog.append({"cProd": f"P{i:06d}", "xProd": desc, "NCM": rng.choice(ncm_codes)})
+    return catalog
+
+
+def _det(n: int, prod: Dict[str, str], rng: random.Random, spec: CorpusSpec) -> str:
+    ncm = "00000000" if rng.random() < spec.zero_ncm_ratio else prod["NCM"]
+    node, code_tag, code = rng.choice(spec.modalities)
+    q = rng.randint(1, 50)
+    vun = round(rng.uniform(0.5, 500), 2)
+    vprod = round(q * vun, 2)
+    icms_vals = "" if code_tag == "CSOSN" else (
+        f"<modBC>3</modBC><vBC>{vprod:.2f}</vBC><pICMS>18.00</pICMS><vICMS>{vprod * 0.18:.2f}</vICMS>"
+    )
+    return (
+        f'<det nItem="{n}"><prod><cProd>{prod["cProd"]}</cProd><cEAN>SEM GTIN</cEAN>'
+        f"<xProd>{escape(prod['xProd'])}</xProd><NCM>{ncm}</NCM><CFOP>{rng.choice(CFOPS)}</CFOP>"
+        f"<uCom>UN</uCom><qCom>{q:.4f}</qCom><vUnCom>{vun:.10f}</vUnCom><vProd>{vprod:.2f}</vProd>"
+        f"<cEANTrib>SEM GTIN</cEANTrib><uTrib>UN</uTrib><qTrib>{q:.4f}</qTrib><vUnTrib>{vun:.10f}</vUnTrib>"
+        f"<indTot>1</indTot></prod><imposto><vTotTrib>0.00</vTotTrib>"
+        f"<ICMS><{node}><orig>0</orig><{code_tag}>{code}</{code_tag}>{icms_vals}</{node}></ICMS>"
+        f"<IPI><cEnq>999</cEnq><IPINT><CST>53</CST></IPINT></IPI>"
+        f"<PIS><PISAliq><CST>01</CST><vBC>{vprod:.2f}</vBC><pPIS>1.65</pPIS><vPIS>{vprod * 0.0165:.2f}</vPIS></PISAliq></PIS>"
+        f"<COFINS><COFINSAliq><CST>01</CST><vBC>{vprod:.2f}</vBC><pCOFINS>7.60</pCOFINS><vCOFINS>{vprod * 0.076:.2f}</vCOFINS></COFINSAliq></COFINS>"
+        f"</imposto></det>"
+    )
+
+
+def iter_corpus(spec: CorpusSpec, ncm_table: pd.DataFrame = None) -> Iterator[Tuple[str, bytes]]:
+    """Yield (filename, xml_bytes) for `spec.docs` documents."""
+    if ncm_table is None:
+        ncm_table = make_ncm_table(spec)
+    catalog = _catalog(spec, ncm_table["ncm"].tolist())
+    rng = random.Random(spec.seed + 3)
+    xmlns = f' xmlns="{NFE_NS}"' if spec.namespaces else ""
+    for d in range(1, spec.docs + 1):
+        cnpj = f"{rng.randint(10**13, 10**14 - 1)}"
+        chave = f"35{rng.randint(2001, 2612):04d}{cnpj}55001{d:09d}1{rng.randint(10**8, 10**9 - 1)}"[:44]
+        dets = "".join(_det(i, rng.choice(catalog), rng, spec) for i in range(1, spec.items_per_doc + 1))
+        xml = (
+            f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<nfeProc{xmlns} versao="4.00"><NFe{xmlns}><infNFe Id="NFe{chave}" versao="4.00">'
+            f"<ide><cUF>35</cUF><natOp>VENDA</natOp><mod>55</mod><serie>1</serie><nNF>{d}</nNF>"
+            f"<dhEmi>2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T10:00:00-03:00</dhEmi></ide>"
+            f"<emit><CNPJ>{cnpj}</CNPJ><xNome>EMITENTE {d % 50} LTDA</xNome></emit>"
+            f"<dest><CNPJ>{rng.randint(10**13, 10**14 - 1)}</CNPJ><xNome>DESTINATARIO {d % 80}</xNome></dest>"
+            f"{dets}"
+            f"<total><ICMSTot><vBC>0.00</vBC><vICMS>0.00</vICMS><vST>0.00</vST><vProd>0.00</vProd><vNF>0.00</vNF></ICMSTot></total>"
+            f"</infNFe></NFe></nfeProc>"
+        )
+        yield f"nfe_{d:06d}.xml", xml.encode("utf-8")
+
+
+def make_corpus(spec: CorpusSpec, ncm_table: pd.DataFrame = None) -> List[Tuple[str, bytes]]:
+    return list(iter_corpus(spec, ncm_table))
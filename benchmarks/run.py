@@ -0,0 +1,265 @@
+"""End-to-end benchmarks: python -m benchmarks.run [opções]
+
+Stages: startup, parse, validate, correct, consolidate, rewrite, export_excel.
+Each stage reports wall time, docs/s, items/s and tracemalloc peak (MB).
+startup is the app's cold start: imports for the login screen and the main
+page in a fresh interpreter, checked against NFE_STARTUP_TARGET_S (the run
+exits with 1 when it is over the target); the on-demand feature modules are
+timed on their own in another fresh interpreter.
+Results are saved as JSON under benchmarks/results/ and can be compared:
+
+    python -m benchmarks.run --docs 500 --items 20
+    python -m benchmarks.run --compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from .corpus import CorpusSpec, make_corpus, make_tables
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+ALL_STAGES = ["startup", "parse", "validate", "correct", "consolidate", "rewrite", "export_excel"]
+
+
+def _git_rev() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parents[1],
+            capture_output=True, text=True, timeout=5,
+        )
+        return out.stdout.strip()
+    except Exception:
+        return ""
+
+
+def _measure(fn: Callable[[], Any], repeat: int, memory: bool) -> Dict[str, Any]:
+    """Best wall time over `repeat` runs (sem tracemalloc) + one traced run for peak memory."""
+    result = None
+    times: List[float] = []
+    for _ in range(max(1, repeat)):
+        gc.collect()
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    peak_mb = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    return {"seconds": min(times), "runs": times, "peak_mb": peak_mb, "_result": result}
+
+
+STARTUP_TARGET_ENV = "NFE_STARTUP_TARGET_S"
+STARTUP_TARGET_S = 1.0  # login + página principal, processo novo
+
+_STARTUP_PROBE = """
+import importlib, json, time
+t = [time.perf_counter()]
+for group in {groups!r}:
+    for name in group:
+        importlib.import_module(name)
+    t.append(time.perf_counter())
+print(json.dumps([b - a for a, b in zip(t, t[1:])]))
+"""
+
+
+def startup_target() -> float:
+    try:
+        return float(os.environ.get(STARTUP_TARGET_ENV, "") or STARTUP_TARGET_S)
+    except ValueError:
+        return STARTUP_TARGET_S
+
+
+def _probe_imports(*groups) -> List[float]:
+    """Import each group of modules in order in a fresh interpreter; seconds per group."""
+    out = subprocess.run(
+        [sys.executable, "-c", _STARTUP_PROBE.format(groups=groups)], cwd=Path(__file__).resolve().parents[1],
+        capture_output=True, text=True, timeout=300, check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure_startup(repeat: int = 1) -> Dict[str, Any]:
+    """Cold-start imports in fresh interpreters; best of `repeat` (login + main page).
+
+    The feature modules get their own interpreter, so their time includes the
+    shared dependencies (pandas...) instead of finding them already loaded.
+    """
+    from utils.bootstrap import FEATURE_MODULES, LOGIN_MODULES, STARTUP_MODULES
+
+    runs: List[List[float]] = []
+    features = float("inf")
+    for _ in range(max(1, repeat)):
+        runs.append(_probe_imports(LOGIN_MODULES, STARTUP_MODULES))
+        features = min(features, _probe_imports(FEATURE_MODULES)[0])
+    login, main = min(runs, key=lambda r: r[0] + r[1])
+    target = startup_target()
+    return {
+        "seconds": login + main, "runs": [r[0] + r[1] for r in runs], "peak_mb": None,
+        "login_s": login, "principal_s": main, "recursos_s": features,
+        "target_s": target, "ok": login + main <= target,
+    }
+
+
+def run(spec: CorpusSpec, stages: List[str], repeat: int = 1, memory: bool = True) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    if "startup" in stages:
+        m = measure_startup(repeat)
+        out["startup"] = m
+        print(f"{'startup':>14}: {m['seconds']:8.3f}s  (login {m['login_s']:.3f}s + página {m['principal_s']:.3f}s; "
+              f"recursos sob demanda, processo novo {m['recursos_s']:.3f}s)  meta {m['target_s']:.2f}s: "
+              f"{'ok' if m['ok'] else 'ACIMA DA META'}", flush=True)
+        if not set(stages) - {"startup"}:
+            return out
+
+    from utils.base_legal import compile_base_legal
+    from utils.pipeline import items_frame, changes_by_file
+    from utils.validator import validar_itens
+    from utils.consolidation import ConsolidationCube, GROUPINGS
+    from utils.excel_export import ExcelSheet, write_excel_streaming
+    from v3_corrector.correction_engine import apply_corrections
+    from v3_corrector.xml_rewriter import rewrite_nfe_xml
+
+    # como no app: a Base Legal é compilada uma vez e compartilhada
+    tables = compile_base_legal(make_tables(spec))
+    files = make_corpus(spec, tables["ncm"])
+    n_docs = len(files)
+    n_items = spec.docs * spec.items_per_doc
+
+    def record(name: str, m: Dict[str, Any]) -> Any:
+        res = m.pop("_result")
+        s = m["seconds"] or 1e-9
+        m.update({"docs_per_s": n_docs / s, "items_per_s": n_items / s})
+        out[name] = m
+        print(f"{name:>14}: {m['seconds']:8.3f}s  {m['items_per_s']:12.0f} itens/s  "
+              f"pico {m['peak_mb'] if m['peak_mb'] is not None else float('nan'):8.1f} MB", flush=True)
+        return res
+
+    # parse é pré-requisito das demais etapas
+    m = _measure(lambda: items_frame(files), repeat if "parse" in stages else 1, memory and "parse" in stages)
+    headers, df_itens, _ = m["_result"]
+    if "parse" in stages:
+        record("parse", m)
+
+    if "validate" in stages:
+        record("validate", _measure(lambda: validar_itens(df_itens.copy(), tables, compact=True), repeat, memory))
+
+    df_corr = df_itens
+    if "correct" in stages or "rewrite" in stages:
+        m = _measure(lambda: apply_corrections(df_itens, tables, auto_apply=True, compact=True), repeat if "correct" in stages else 1,
+                     memory and "correct" in stages)
+        if "correct" in stages:
+            df_corr, _ = record("correct", m)
+        else:
+            df_corr, _ = m["_result"]
+
+    if "consolidate" in stages:
+        def consolidate():
+            cube = ConsolidationCube.build(df_itens)
+            return [cube.rollup(k) for k in GROUPINGS.values()]
+        record("consolidate", _measure(consolidate, repeat, memory))
+
+    if "rewrite" in stages:
+        def rewrite():
+            all_changes = changes_by_file(df_itens, df_corr)
+            return sum(len(rewrite_nfe_xml(p, all_changes.get(f, {}))) for f, p in files)
+        record("rewrite", _measure(rewrite, repeat, memory))
+
+    if "export_excel" in stages:
+        def export():
+            path = write_excel_streaming([
+                ExcelSheet("Cabecalho_NFe", __import__("pandas").DataFrame(headers)),
+                ExcelSheet("Itens_Bruto", df_itens),
+            ])
+            path.unlink(missing_ok=True)
+        record("export_excel", _measure(export, repeat, memory))
+
+    return out
+
+
+def compare(a_path: str, b_path: str) -> None:
+    a = json.loads(Path(a_path).read_text(encoding="utf-8"))
+    b = json.loads(Path(b_path).read_text(encoding="utf-8"))
+    if a.get("spec") != b.get("spec"):
+        print("ATENÇÃO: corpus diferente entre os resultados; comparação apenas indicativa.")
+    print(f"{'etapa':>14} {'A (s)':>9} {'B (s)':>9} {'B/A':>7} {'pico A':>8} {'pico B':>8}")
+    for stage in ALL_STAGES:
+        sa, sb = a["stages"].get(stage), b["stages"].get(stage)
+        if not sa or not sb:
+            continue
+        ratio = sb["seconds"] / sa["seconds"] if sa["seconds"] else float("nan")
+        flag = "  <-- mais lento" if ratio > 1.10 else ""
+        if sb.get("ok") is False:
+            flag += f"  <-- acima da meta ({sb['target_s']:.2f}s)"
+        pa = sa.get("peak_mb") or float("nan")
+        pb = sb.get("peak_mb") or float("nan")
+        print(f"{stage:>14} {sa['seconds']:9.3f} {sb['seconds']:9.3f} {ratio:7.2f} {pa:8.1f} {pb:8.1f}{flag}")
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmarks do Agente XML Fiscal")
+    ap.add_argument("--docs", type=int, default=200)
+    ap.add_argument("--items", type=int, default=20, help="itens por NF-e")
+    ap.add_argument("--ncm-rows", type=int, default=10_000)
+    ap.add_argument("--catalog", type=int, default=2_000, help="produtos distintos")
+    ap.add_argument("--zero-ncm", type=float, default=0.05)
+    ap.add_argument("--dup-desc", type=float, default=0.30)
+    ap.add_argument("--no-ns", action="store_true", help="gerar XML sem namespace")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--stages", default=",".join(ALL_STAGES))
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--no-memory", action="store_true", help="não medir pico de memória")
+    ap.add_argument("--out", default=None, help="arquivo JSON de saída")
+    ap.add_argument("--compare", nargs=2, metavar=("A", "B"))
+    args = ap.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    spec = CorpusSpec(
+        docs=args.docs, items_per_doc=args.items, namespaces=not args.no_ns,
+        zero_ncm_ratio=args.zero_ncm, duplicate_desc_ratio=args.dup_desc,
+        catalog_size=args.catalog, ncm_rows=args.ncm_rows, seed=args.seed,
+    )
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in ALL_STAGES]
+    if unknown:
+        ap.error(f"etapas desconhecidas: {', '.join(unknown)}")
+
+    results = run(spec, stages, repeat=args.repeat, memory=not args.no_memory)
+    doc = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_rev": _git_rev(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+        },
+        "spec": {k: v for k, v in spec.__dict__.items() if k != "modalities"},
+        "stages": results,
+    }
+    out = Path(args.out) if args.out else RESULTS_DIR / f"bench_{datetime.now():%Y%m%d_%H%M%S}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(doc, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"resultado: {out}")
+    return 1 if results.get("startup", {}).get("ok") is False else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,12 +1,11 @@
 import os
 import streamlit as st
-import pandas as pd
-from utils.users import add_user, list_users, set_user_active
+from utils.users import add_user, list_users, session_auth, set_user_active
 
 st.set_page_config(page_title="Admin - Usuários", page_icon="🛡️", layout="wide")
 
 def require_admin():
-    auth = st.session_state.get("auth")
+    auth = session_auth()
     if not auth:
         st.error("Você precisa estar logado para acessar esta página.")
         st.stop()
@@ -41,13 +40,14 @@ with st.expander("➕ Criar novo usuário", expanded=True):
             st.error(str(e))
 
 st.subheader("Usuários cadastrados")
-users = pd.DataFrame(list_users()).sort_values(["role","username"])
+# lista simples: a página não precisa de pandas
+users = sorted(list_users(), key=lambda u: (u["role"], u["username"]))
 st.dataframe(users, use_container_width=True)
 
 st.subheader("Ativar / Desativar")
 col1, col2 = st.columns([2,1])
 with col1:
-    alvo = st.selectbox("Selecione o usuário", users["username"].tolist() if not users.empty else [])
+    alvo = st.selectbox("Selecione o usuário", [u["username"] for u in users])
 with col2:
     novo_status = st.selectbox("Novo status", ["Ativo","Inativo"], index=0)
 
@@ -3,6 +3,9 @@ import streamlit as st
 
 from utils.users import require_admin
 from utils.base_legal import get_status, save_uploaded_table
+from utils.base_legal_history import get_timeline
+from utils.rule_profiles import DEFAULT_PROFILE, delete_profile, load_profiles, save_profile
+from v3_corrector.rules.registry import list_rules
 
 st.set_page_config(page_title="Admin - Base Legal", page_icon="📚", layout="wide")
 
@@ -12,35 +15,68 @@ st.title("📚 Admin — Base Legal (CFOP / NCM / CST/CSOSN)")
 st.caption("Aqui você faz upload das planilhas que serão usadas como **fonte da verdade** nas validações. Apenas ADMIN pode acessar.")
 
 status = get_status()
+_usuario = (st.session_state.get("auth") or {}).get("username", "")
+
+
+def _publicacao(s) -> None:
+    m = s.manifest
+    if m.get("publicado_em"):
+        st.caption(f"Publicado em {m['publicado_em'].replace('T', ' ')} por {m.get('enviado_por') or '—'} · sha256 {m.get('sha256', '')[:12]}")
+
+
+vigente_desde = st.date_input(
+    "Vigente desde (opcional)",
+    value=None,
+    format="DD/MM/YYYY",
+    help="Data em que a planilha enviada passa a valer (ex.: publicação da nova TIPI). "
+         "Em branco: vale a partir do upload. Usada na validação pela Base Legal vigente na emissão.",
+)
 
 col1, col2, col3 = st.columns(3)
 with col1:
     st.subheader("NCM")
     st.write(f"Status: {'✅' if status['ncm'].ok else '❌'} {status['ncm'].message}")
     st.write(f"Linhas: {status['ncm'].rows}")
+    _publicacao(status['ncm'])
     up_ncm = st.file_uploader("Upload ncm_regras.xlsx", type=["xlsx"], key="up_ncm")
     if up_ncm is not None:
-        res = save_uploaded_table("ncm", up_ncm.read())
+        res = save_uploaded_table("ncm", up_ncm.read(), vigente_desde=vigente_desde, usuario=_usuario)
         st.success(res.message) if res.ok else st.error(res.message)
 
 with col2:
     st.subheader("CFOP")
     st.write(f"Status: {'✅' if status['cfop'].ok else '❌'} {status['cfop'].message}")
     st.write(f"Linhas: {status['cfop'].rows}")
+    _publicacao(status['cfop'])
     up_cfop = st.file_uploader("Upload cfop_regras.xlsx", type=["xlsx"], key="up_cfop")
     if up_cfop is not None:
-        res = save_uploaded_table("cfop", up_cfop.read())
+        res = save_uploaded_table("cfop", up_cfop.read(), vigente_desde=vigente_desde, usuario=_usuario)
         st.success(res.message) if res.ok else st.error(res.message)
 
 with col3:
     st.subheader("CST / CSOSN")
     st.write(f"Status: {'✅' if status['cst'].ok else '❌'} {status['cst'].message}")
     st.write(f"Linhas: {status['cst'].rows}")
+    _publicacao(status['cst'])
     up_cst = st.file_uploader("Upload cst_csosn_regras.xlsx", type=["xlsx"], key="up_cst")
     if up_cst is not None:
-        res = save_uploaded_table("cst", up_cst.read())
+        res = save_uploaded_table("cst", up_cst.read(), vigente_desde=vigente_desde, usuario=_usuario)
         st.success(res.message) if res.ok else st.error(res.message)
 
+st.subheader("Matriz CFOP × CST/CSOSN")
+st.write(f"Status: {'✅' if status['cfop_cst'].ok else '❌'} {status['cfop_cst'].message}")
+st.write(f"Linhas: {status['cfop_cst'].rows}")
+_publicacao(status['cfop_cst'])
+up_cfop_cst = st.file_uploader("Upload cfop_cst_regras.xlsx", type=["xlsx"], key="up_cfop_cst")
+if up_cfop_cst is not None:
+    res = save_uploaded_table("cfop_cst", up_cfop_cst.read(), vigente_desde=vigente_desde, usuario=_usuario)
+    st.success(res.message) if res.ok else st.error(res.message)
+
+with st.expander("Histórico de versões (vigência)"):
+    st.caption("Cada NF-e pode ser validada contra a versão em vigor no seu dhEmi (opção na tela principal). "
+               "Sem data de vigência, a versão vale a partir do upload; a mais antiga vale para qualquer data anterior.")
+    st.dataframe(get_timeline().rows(), use_container_width=True, hide_index=True)
+
 st.divider()
 st.markdown("""
 ### Colunas obrigatórias
@@ -58,5 +94,41 @@ st.markdown("""
 - `tipo` (CST ou CSOSN)
 - `descricao`
 
+**cfop_cst_regras.xlsx** (matriz de compatibilidade usada na correção V3)
+- `cfop`
+- `tipo` (CST ou CSOSN)
+- `codigo` (ex.: 060, 102; `*` = qualquer código sem linha própria para aquele CFOP)
+- `permitido` (SIM / NAO)
+- opcionais: `cfop_sugerido`, `codigo_sugerido`, `severidade` (ERRO / ALERTA), `justificativa`, `base_legal`
+
 > Dica: você pode manter outras colunas extras (ex.: observações). O app ignora o que não precisa.
 """)
+
+st.divider()
+st.subheader("⚙️ Perfis de regras (por cliente)")
+st.caption("Cada perfil desativa regras de validação (V2) e correção (V3) em lote. O analista escolhe o perfil na tela principal.")
+
+_rules = list_rules()
+_labels = {r.rule_id: f"{r.stage.upper()} · {r.rule_id} — {r.descricao}" for r in _rules}
+_perfis = load_profiles()
+_escolha = st.selectbox("Perfil", ["(novo perfil)"] + [n for n in _perfis if n != DEFAULT_PROFILE])
+_atual = _perfis.get(_escolha)
+_nome = st.text_input("Nome do perfil", value="" if _atual is None else _atual.nome, disabled=_atual is not None)
+_desat = st.multiselect(
+    "Regras desativadas",
+    list(_labels),
+    default=sorted(_atual.desativadas & set(_labels)) if _atual is not None else [],
+    format_func=_labels.get,
+)
+c_save, c_del = st.columns(2)
+with c_save:
+    if st.button("Salvar perfil", type="primary"):
+        try:
+            save_profile(_nome, _desat)
+            st.success(f"Perfil '{_nome}' salvo.")
+        except ValueError as e:
+            st.error(str(e))
+with c_del:
+    if _atual is not None and st.button("Excluir perfil"):
+        delete_profile(_atual.nome)
+        st.success(f"Perfil '{_atual.nome}' excluído.")
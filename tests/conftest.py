@@ -0,0 +1,13 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+# dados do app (Base Legal, catálogo, lotes) numa pasta temporária; definido antes de
+# importar utils, e herdado pelos workers dos pools
+if "NFE_DATA_DIR" not in os.environ:
+    os.environ["NFE_DATA_DIR"] = tempfile.mkdtemp(prefix="nfe_test_data_")
+    atexit.register(shutil.rmtree, os.environ["NFE_DATA_DIR"], ignore_errors=True)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,105 @@
+import io
+import json
+import zipfile
+
+import pytest
+
+from benchmarks.corpus import CorpusSpec, make_corpus
+from utils.service import ServiceClient, ValidationService
+
+MAX_BYTES = 1024 * 1024
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    return make_corpus(CorpusSpec(docs=3, items_per_doc=2, ncm_rows=50, catalog_size=20))
+
+
+@pytest.fixture(scope="module")
+def service():
+    svc = ValidationService(port=0, workers=1, max_bytes=MAX_BYTES, queue=2, timeout=120).start()
+    yield svc
+    svc.shutdown()
+
+
+@pytest.fixture
+def client(service):
+    return ServiceClient(service.url, timeout=120)
+
+
+def _zip(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, payload in files:
+            zf.writestr(name, payload)
+    return buf.getvalue()
+
+
+def test_health(client):
+    h = client.health()
+    assert h["status"] == "ok"
+    assert h["workers"] == 1
+    assert h["em_andamento"] == 0
+
+
+def test_validate_single_xml(client, corpus):
+    data = client.json("validate", corpus[0][1], "xml")
+    assert data["documentos"] == 1
+    assert data["total_itens"] == 2
+    assert len(data["itens"]) == 2
+    assert isinstance(data["achados_v2"], list)
+
+
+def test_parse_zip(client, corpus):
+    data = client.json("parse", _zip(corpus), "zip")
+    assert data["documentos"] == 3
+    assert len(data["itens"]) == 6
+    assert {i["arquivo"] for i in data["itens"]} == {name for name, _ in corpus}
+
+
+def test_correct_ndjson(client, corpus):
+    body = "\n".join(json.dumps({"arquivo": name, "xml": payload.decode("utf-8")})
+                     for name, payload in corpus[:2]).encode("utf-8")
+    data = client.json("correct", body, "ndjson")
+    assert data["documentos"] == 2
+    assert isinstance(data["achados_v3"], list)
+    assert isinstance(data["alteracoes"], dict)
+
+
+def test_rewrite_single_xml_returns_xml(client, corpus):
+    status, ctype, out = client.request("rewrite", corpus[0][1], "xml")
+    assert status == 200
+    assert ctype == "application/xml"
+    assert out.startswith(b"<?xml")
+
+
+def test_invalid_ndjson_is_400(client):
+    status, _, out = client.request("validate", b"{not json}\n", "ndjson")
+    assert status == 400
+    assert "NDJSON" in json.loads(out)["erro"]
+
+
+def test_unknown_profile_is_400(client, corpus):
+    status, _, out = client.request("validate", corpus[0][1], "xml", perfil="nao_existe")
+    assert status == 400
+    assert "nao_existe" in json.loads(out)["erro"]
+
+
+def test_body_over_limit_is_413(client):
+    status, _, _ = client.request("validate", b"<a/>" + b" " * MAX_BYTES, "xml")
+    assert status == 413
+
+
+def test_full_queue_is_503(service, client, corpus):
+    # ocupa todas as vagas de requisições em andamento
+    taken = 0
+    while service._slots.acquire(blocking=False):
+        taken += 1
+    try:
+        status, _, out = client.request("validate", corpus[0][1], "xml")
+    finally:
+        for _ in range(taken):
+            service._slots.release()
+    assert status == 503
+    assert "ocupado" in json.loads(out)["erro"]
+    assert client.json("validate", corpus[0][1], "xml")["documentos"] == 1
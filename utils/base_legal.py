@@ -1,23 +1,44 @@
 from __future__ import annotations
 
+import hashlib
+import json
 import os
+import threading
+import uuid
+import xml.etree.ElementTree as ET
+import zipfile
+from contextlib import contextmanager
 from pathlib import Path
-from dataclasses import dataclass
-from typing import Dict, Optional, Tuple
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, Iterator, List, Mapping, Optional, Tuple
 
 import pandas as pd
 
+try:
+    import fcntl
+except ImportError:  # Windows: só o lock entre threads do processo
+    fcntl = None
+
+from .instrumentation import instrumented
+
 BASE_DIR = Path(__file__).resolve().parents[2]  # project root (agente_leitor_xml_fiscal)
-DATA_DIR = BASE_DIR / "data"
+DATA_DIR = Path(os.environ.get("NFE_DATA_DIR") or BASE_DIR / "data")  # NFE_DATA_DIR: outra pasta (testes)
 BL_DIR = DATA_DIR / "base_legal"
 CURRENT_DIR = BL_DIR / "current"
 HISTORY_DIR = BL_DIR / "history"
+# Início de vigência informado no upload: {"current/ncm_regras.xlsx": "2025-01-01", "history/<ts>__...": ...}
+VIGENCIAS_PATH = BL_DIR / "vigencias.json"
+# Manifesto das planilhas publicadas (linhas, hash, colunas, publicação, usuário), por arquivo:
+# {"current/ncm_regras.xlsx": {"tabela": "ncm", "linhas": 10234, "sha256": "...", ...}}
+MANIFEST_PATH = BL_DIR / "manifest.json"
 
 # Expected filenames in CURRENT_DIR
 FILES = {
     "ncm": "ncm_regras.xlsx",
     "cfop": "cfop_regras.xlsx",
     "cst": "cst_csosn_regras.xlsx",
+    "cfop_cst": "cfop_cst_regras.xlsx",
 }
 
 # Required columns (case-insensitive)
@@ -25,6 +46,7 @@ REQUIRED_COLS = {
     "ncm": ["ncm", "descricao"],
     "cfop": ["cfop", "descricao"],
     "cst": ["codigo", "tipo", "descricao"],  # tipo: CST or CSOSN
+    "cfop_cst": ["cfop", "tipo", "codigo", "permitido"],  # matriz CFOP x CST/CSOSN (codigo '*' = demais)
 }
 
 @dataclass
@@ -33,10 +55,25 @@ class BaseLegalStatus:
     message: str
     rows: int = 0
     path: Optional[str] = None
+    manifest: Dict[str, Any] = field(default_factory=dict)  # entrada do manifesto (status)
+
+
+_ensured = False
+_ensure_lock = threading.Lock()
 
 
 def ensure_base_legal() -> None:
-    """Create folders and starter templates if missing."""
+    """Create folders and starter templates if missing (checked once per process)."""
+    global _ensured
+    if _ensured:
+        return
+    with _ensure_lock:
+        if not _ensured:
+            _create_missing()
+            _ensured = True
+
+
+def _create_missing() -> None:
     CURRENT_DIR.mkdir(parents=True, exist_ok=True)
     HISTORY_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -60,6 +97,11 @@ def ensure_base_legal() -> None:
         ])
         df.to_excel(CURRENT_DIR / FILES["cst"], index=False)
 
+    if not (CURRENT_DIR / FILES["cfop_cst"]).exists():
+        from v3_corrector.rules.cfop_cst_rules import default_rows
+        df = pd.DataFrame(default_rows())
+        df.to_excel(CURRENT_DIR / FILES["cfop_cst"], index=False)
+
 
 def _read_excel(path: Path) -> pd.DataFrame:
     return pd.read_excel(path, dtype=str).fillna("")
@@ -71,58 +113,389 @@ def _norm_cols(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+def load_table_file(path: Path) -> pd.DataFrame:
+    """One Base Legal sheet (current or history), empty when unreadable."""
+    try:
+        return _norm_cols(_read_excel(path))
+    except Exception:
+        return pd.DataFrame()
+
+
+@instrumented("load_tables")
 def load_tables() -> Dict[str, pd.DataFrame]:
     """Load base legal tables. Always returns keys ncm/cfop/cst (possibly empty)."""
     ensure_base_legal()
-    tables: Dict[str, pd.DataFrame] = {}
+    return {key: load_table_file(CURRENT_DIR / fname) for key, fname in FILES.items()}
+
+
+@dataclass(frozen=True)
+class SheetInfo:
+    colunas: Tuple[str, ...]
+    linhas: int
+    sha256: str
+
+
+_NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_NS_PKG = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+
+def _first_sheet_xml(zf: zipfile.ZipFile) -> str:
+    """Path inside the XLSX of the first worksheet (the one pd.read_excel reads)."""
+    wb = ET.fromstring(zf.read("xl/workbook.xml"))
+    rid = wb.find(f"{_NS_MAIN}sheets/{_NS_MAIN}sheet").get(f"{_NS_REL}id")
+    rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    target = next(r.get("Target") for r in rels.iter(f"{_NS_PKG}Relationship") if r.get("Id") == rid)
+    return target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+
+
+def _shared_strings(zf: zipfile.ZipFile, wanted: set) -> Dict[int, str]:
+    """Only the shared strings at the `wanted` positions (parsing stops after the last one)."""
+    out: Dict[int, str] = {}
+    if not wanted or "xl/sharedStrings.xml" not in zf.namelist():
+        return out
+    stop = max(wanted)
+    with zf.open("xl/sharedStrings.xml") as f:
+        i = 0
+        for _, el in ET.iterparse(f):
+            if el.tag == f"{_NS_MAIN}si":
+                if i in wanted:
+                    out[i] = "".join(t.text or "" for t in el.iter(f"{_NS_MAIN}t"))
+                el.clear()
+                if i >= stop:
+                    break
+                i += 1
+    return out
+
+
+def _scan_rows(zf: zipfile.ZipFile, sheet: str) -> Tuple[Tuple[str, ...], int]:
+    """(header, data rows) of a worksheet in one streaming pass, rows counted like pd.read_excel.
+
+    Data rows go from the header up to the last row with a value (blank rows
+    in between included).
+    """
+    first = last = 0
+    cells: List[Tuple[str, str]] = []      # (tipo, valor) das células do cabeçalho
+    with zf.open(sheet) as f:
+        for _, el in ET.iterparse(f):
+            if el.tag != f"{_NS_MAIN}row":
+                continue
+            filled = False
+            for c in el:
+                v = c.find(f"{_NS_MAIN}v")
+                inline = c.find(f"{_NS_MAIN}is")
+                if v is None and inline is None:
+                    continue
+                filled = True
+                if first:
+                    break
+                if inline is not None:
+                    cells.append(("inlineStr", "".join(t.text or "" for t in inline.iter(f"{_NS_MAIN}t"))))
+                else:
+                    cells.append((c.get("t", "n"), v.text or ""))
+            if filled:
+                r = int(el.get("r") or last + 1)
+                first = first or r
+                last = r
+            el.clear()
+    shared = _shared_strings(zf, {int(v) for t, v in cells if t == "s" and v.isdigit()})
+    header = tuple(
+        (shared.get(int(v), "") if t == "s" and v.isdigit() else v).strip().lower()
+        for t, v in cells
+    )
+    return tuple(h for h in header if h), (last - first if first else 0)
+
+
+def scan_sheet(path: Path) -> SheetInfo:
+    """Header, row count and content hash of an XLSX without building a DataFrame.
+
+    One streaming pass over the worksheet XML (iterparse, no cell
+    conversion); of the shared strings only the header's are read, so a
+    100k-row table costs a fraction of a full read.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    with zipfile.ZipFile(path) as zf:
+        cols, linhas = _scan_rows(zf, _first_sheet_xml(zf))
+    return SheetInfo(cols, linhas, h.hexdigest())
+
+
+def load_manifest() -> Dict[str, Dict[str, Any]]:
+    try:
+        return dict(json.loads(MANIFEST_PATH.read_text(encoding="utf-8")))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+_manifest_lock = threading.Lock()
+
+
+@contextmanager
+def _manifest_locked():
+    """Hold across load + update + write of manifest.json and vigencias.json.
+
+    Threads + an fcntl file lock where available, so concurrent uploads
+    neither lose entries nor publish over each other.
+    """
+    with _manifest_lock:
+        if fcntl is None:
+            yield
+            return
+        BL_DIR.mkdir(parents=True, exist_ok=True)
+        with open(BL_DIR / ".manifest.lock", "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _write_json(path: Path, data: Dict[str, Any]) -> None:
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True), encoding="utf-8")
+    tmp.replace(path)
+
+
+def _write_manifest(data: Dict[str, Dict[str, Any]]) -> None:
+    """Caller holds _manifest_locked()."""
+    _write_json(MANIFEST_PATH, data)
+
+
+def _manifest_entry(key: str, path: Path, info: SheetInfo, usuario: str = "", publicado_em: str = "") -> Dict[str, Any]:
+    st = path.stat()
+    return {
+        "tabela": key,
+        "linhas": info.linhas,
+        "sha256": info.sha256,
+        "colunas": list(info.colunas),
+        "publicado_em": publicado_em,
+        "enviado_por": usuario,
+        "mtime_ns": st.st_mtime_ns,   # confere se o arquivo ainda é o publicado
+        "tamanho": st.st_size,
+    }
+
+
+def _fresh(entry: Optional[Dict[str, Any]], path: Path) -> bool:
+    try:
+        st = path.stat()
+    except OSError:
+        return False
+    return bool(entry) and entry.get("mtime_ns") == st.st_mtime_ns and entry.get("tamanho") == st.st_size
+
+
+def load_vigencias() -> Dict[str, str]:
+    """Explicit start dates set at upload, by file (relative to BL_DIR)."""
+    try:
+        return dict(json.loads(VIGENCIAS_PATH.read_text(encoding="utf-8")))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_vigencias(data: Dict[str, str]) -> None:
+    """Caller holds _manifest_locked()."""
+    _write_json(VIGENCIAS_PATH, data)
+
+
+# ---------------------------------------------------------------------------
+# Base Legal compilada, compartilhada pelo processo
+# ---------------------------------------------------------------------------
+
+@dataclass(frozen=True, eq=False)
+class CompiledBaseLegal(Mapping):
+    """Read-only Base Legal: tables plus the lookup structures built from them.
+
+    One instance is shared by every session of the process (get_base_legal);
+    it must never be mutated. It is also a Mapping key -> DataFrame, so code
+    written for the load_tables() dict (``tables.get("ncm")``) keeps working.
+    """
+    version: Tuple = ()
+    tables: Mapping[str, pd.DataFrame] = field(default_factory=dict)
+    ncm_set: FrozenSet[str] = frozenset()        # validador: NCM só dígitos, zfill(8)
+    cfop_set: FrozenSet[str] = frozenset()
+    cst_set: FrozenSet[str] = frozenset()
+    csosn_set: FrozenSet[str] = frozenset()
+    allowed_ncms: FrozenSet[str] = frozenset()   # V3: NCM8 válidos (sem '00...')
+    ncm_index: Tuple[Tuple[str, str], ...] = ()  # (ncm8, descrição normalizada)
+    cfop_cst: Any = None                         # CfopCstMatrix (matriz CFOP x CST/CSOSN)
+
+    def __getitem__(self, key: str) -> pd.DataFrame:
+        return self.tables[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.tables)
+
+    def __len__(self) -> int:
+        return len(self.tables)
+
+
+def compile_base_legal(tables: Mapping[str, pd.DataFrame], version: Tuple = ()) -> CompiledBaseLegal:
+    """Build the lookup sets and NCM text index once for a set of tables."""
+    if isinstance(tables, CompiledBaseLegal):
+        return tables
+    from v3_corrector.rules.cfop_cst_rules import CfopCstMatrix, default_rows
+    from v3_corrector.rules.ncm_rules import build_ncm_text_index
+    from v3_corrector.text_utils import digits_only
+
+    tables = {k: (df if df is not None else pd.DataFrame()) for k, df in (tables or {}).items()}
+    ncm_tbl = tables.get("ncm", pd.DataFrame())
+    cfop_tbl = tables.get("cfop", pd.DataFrame())
+    cst_tbl = tables.get("cst", pd.DataFrame())
+
+    ncm_set: FrozenSet[str] = frozenset()
+    allowed: FrozenSet[str] = frozenset()
+    if not ncm_tbl.empty and "ncm" in ncm_tbl.columns:
+        raw = ncm_tbl["ncm"].astype(str)
+        ncm_set = frozenset(raw.str.replace(r"\D", "", regex=True).str.zfill(8))
+        ncm8 = {digits_only(x).zfill(8)[:8] for x in raw.tolist()}
+        # Filtra NCMs inválidos (ex.: começando com '00' ou zerado)
+        allowed = frozenset(n for n in ncm8 if n and n != "00000000" and not n.startswith("00"))
+
+    cfop_set: FrozenSet[str] = frozenset()
+    if not cfop_tbl.empty and "cfop" in cfop_tbl.columns:
+        cfop_set = frozenset(cfop_tbl["cfop"].astype(str).str.replace(r"\D", "", regex=True).str.zfill(4))
+
+    cst_set: FrozenSet[str] = frozenset()
+    csosn_set: FrozenSet[str] = frozenset()
+    if not cst_tbl.empty and {"codigo", "tipo"}.issubset(set(cst_tbl.columns)):
+        tipo = cst_tbl["tipo"].astype(str).str.upper().str.strip()
+        codigo = cst_tbl["codigo"].astype(str).str.strip()
+        cst_set = frozenset(codigo[tipo == "CST"])
+        csosn_set = frozenset(codigo[tipo == "CSOSN"])
+
+    return CompiledBaseLegal(
+        version=version,
+        tables=MappingProxyType(tables),
+        ncm_set=ncm_set,
+        cfop_set=cfop_set,
+        cst_set=cst_set,
+        csosn_set=csosn_set,
+        allowed_ncms=allowed,
+        ncm_index=build_ncm_text_index(ncm_tbl),
+        # sem a planilha (tabelas montadas em código): matriz padrão
+        cfop_cst=CfopCstMatrix.build(tables["cfop_cst"] if "cfop_cst" in tables else pd.DataFrame(default_rows())),
+    )
+
+
+_shared: Optional[CompiledBaseLegal] = None
+_shared_lock = threading.Lock()
+
+
+def _current_version() -> Tuple:
+    """(arquivo, mtime_ns, tamanho) of each current table: changes on every publish."""
+    out = []
     for key, fname in FILES.items():
-        path = CURRENT_DIR / fname
         try:
-            df = _read_excel(path)
-            df = _norm_cols(df)
-        except Exception:
-            df = pd.DataFrame()
-        tables[key] = df
-    return tables
+            st = (CURRENT_DIR / fname).stat()
+            out.append((key, st.st_mtime_ns, st.st_size))
+        except OSError:
+            out.append((key, 0, 0))
+    return tuple(out)
 
 
-def validate_table(key: str, df: pd.DataFrame) -> Tuple[bool, str]:
-    """Validate required columns for a given table."""
-    df = _norm_cols(df)
-    req = REQUIRED_COLS[key]
-    missing = [c for c in req if c not in df.columns]
+def get_base_legal() -> CompiledBaseLegal:
+    """Process-wide compiled Base Legal, rebuilt only when the files change.
+
+    Sessions (and job workers) all get the same immutable instance; a new
+    version is compiled aside and swapped in with a single assignment, so a
+    reader never sees a half-built Base Legal.
+    """
+    global _shared
+    cur = _shared
+    if cur is not None and cur.version == _current_version():
+        return cur
+    with _shared_lock:
+        ensure_base_legal()
+        version = _current_version()
+        if _shared is None or _shared.version != version:
+            _shared = compile_base_legal(load_tables(), version=version)
+        return _shared
+
+
+def _publish() -> None:
+    """Recompile after a new table was moved into CURRENT_DIR, off the upload request.
+
+    The version already changed on disk, so any get_base_legal() meanwhile
+    waits on the lock for this compilation instead of using the old tables.
+    """
+    threading.Thread(target=get_base_legal, name="base_legal_publish", daemon=True).start()
+
+
+def validate_columns(key: str, columns: List[str]) -> Tuple[bool, str]:
+    """Validate required columns (already lowercased/stripped) for a given table."""
+    missing = [c for c in REQUIRED_COLS[key] if c not in columns]
     if missing:
         return False, f"Colunas obrigatórias ausentes: {', '.join(missing)}"
     return True, "OK"
 
 
-def save_uploaded_table(key: str, uploaded_bytes: bytes) -> BaseLegalStatus:
+def validate_table(key: str, df: pd.DataFrame) -> Tuple[bool, str]:
+    """Validate required columns for a given table."""
+    return validate_columns(key, list(_norm_cols(df).columns))
+
+
+def save_uploaded_table(key: str, uploaded_bytes: bytes, vigente_desde: Optional[Any] = None,
+                        usuario: str = "") -> BaseLegalStatus:
     """
     Save an uploaded XLSX as the current table and keep a timestamped backup.
+    vigente_desde: date the new table takes effect (default: now); used by the
+    point-in-time validation (utils.base_legal_history).
+    usuario: who uploaded (goes to the manifest with rows, hash and columns).
     Returns status with message for UI.
     """
     ensure_base_legal()
     fname = FILES[key]
-    tmp_path = CURRENT_DIR / f"__tmp__{fname}"
+    tmp_path = CURRENT_DIR / f"__tmp__{os.getpid()}_{uuid.uuid4().hex[:8]}__{fname}"
 
     try:
         tmp_path.write_bytes(uploaded_bytes)
-        df = pd.read_excel(tmp_path, dtype=str).fillna("")
-        ok, msg = validate_table(key, df)
+        # cabeçalho e contagem de linhas numa leitura em streaming (sem montar o DataFrame)
+        info = scan_sheet(tmp_path)
+        ok, msg = validate_columns(key, list(info.colunas))
+        if not ok:
+            tmp_path.unlink(missing_ok=True)
+            return BaseLegalStatus(ok=False, message=msg)
+        # leitura completa antes de publicar: uma planilha que o pandas não abre viraria
+        # tabela vazia em load_tables (e desligaria as checagens dessa tabela)
+        ok, msg = validate_table(key, _read_excel(tmp_path))
         if not ok:
             tmp_path.unlink(missing_ok=True)
             return BaseLegalStatus(ok=False, message=msg)
 
-        # Backup current (if exists)
         cur_path = CURRENT_DIR / fname
-        ts = pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")
-        if cur_path.exists():
-            backup = HISTORY_DIR / f"{ts}__{fname}"
-            cur_path.replace(backup)
-
-        # Move tmp into place
-        tmp_path.replace(cur_path)
-        return BaseLegalStatus(ok=True, message="Base atualizada com sucesso.", rows=len(df), path=str(cur_path))
+        cur_rel = f"current/{fname}"
+        vig_iso = pd.Timestamp(vigente_desde).isoformat() if vigente_desde is not None and str(vigente_desde).strip() else None
+        # backup, troca do arquivo e manifesto/vigências num só trecho sob o lock
+        with _manifest_locked():
+            ts = pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")
+            vig = load_vigencias()
+            manifest = load_manifest()
+            cur = manifest.get(cur_rel)
+            if _fresh(cur, cur_path) and cur.get("sha256") == info.sha256 and vig.get(cur_rel) == vig_iso:
+                # mesmo conteúdo da vigente (ex.: o mesmo arquivo ainda no uploader após um rerun): nada a publicar
+                tmp_path.unlink(missing_ok=True)
+                return BaseLegalStatus(ok=True, message="Planilha idêntica à vigente; nada alterado.", rows=info.linhas,
+                                       path=str(cur_path), manifest=cur)
+            # Backup current (if exists)
+            if cur_path.exists():
+                backup = HISTORY_DIR / f"{ts}__{fname}"
+                cur_path.replace(backup)
+                if cur_rel in vig:
+                    vig[f"history/{backup.name}"] = vig[cur_rel]
+                if cur_rel in manifest:
+                    manifest[f"history/{backup.name}"] = manifest[cur_rel]
+
+            # Move tmp into place
+            tmp_path.replace(cur_path)
+            vig.pop(cur_rel, None)
+            if vig_iso:
+                vig[cur_rel] = vig_iso
+            _write_vigencias(vig)
+            manifest[cur_rel] = _manifest_entry(key, cur_path, info, usuario, pd.Timestamp.now().isoformat(timespec="seconds"))
+            _write_manifest(manifest)
+        _publish()
+        return BaseLegalStatus(ok=True, message="Base atualizada com sucesso.", rows=info.linhas, path=str(cur_path))
     except Exception as e:
         try:
             tmp_path.unlink(missing_ok=True)
@@ -132,17 +505,41 @@ def save_uploaded_table(key: str, uploaded_bytes: bytes) -> BaseLegalStatus:
 
 
 def get_status() -> Dict[str, BaseLegalStatus]:
-    """Return basic status about current base files."""
+    """Return basic status about current base files (from the manifest).
+
+    A file without a matching manifest entry (starter tables, a sheet copied
+    by hand) is scanned once and recorded.
+    """
     ensure_base_legal()
+    manifest = load_manifest()
+    changed = False
     out: Dict[str, BaseLegalStatus] = {}
     for key, fname in FILES.items():
         p = CURRENT_DIR / fname
+        rel = f"current/{fname}"
         if not p.exists():
             out[key] = BaseLegalStatus(ok=False, message="Arquivo não encontrado.")
             continue
+        entry = manifest.get(rel)
+        if not _fresh(entry, p):
+            try:
+                entry = _manifest_entry(key, p, scan_sheet(p))
+            except Exception as e:
+                out[key] = BaseLegalStatus(ok=False, message=f"Erro ao ler: {e}", path=str(p))
+                continue
+            manifest[rel] = entry
+            changed = True
+        out[key] = BaseLegalStatus(ok=True, message="OK", rows=int(entry.get("linhas", 0)), path=str(p), manifest=entry)
+    if changed:
         try:
-            df = pd.read_excel(p, dtype=str)
-            out[key] = BaseLegalStatus(ok=True, message="OK", rows=len(df), path=str(p))
-        except Exception as e:
-            out[key] = BaseLegalStatus(ok=False, message=f"Erro ao ler: {e}", path=str(p))
+            with _manifest_locked():
+                # relê sob o lock: só acrescenta as entradas escaneadas aqui
+                latest = load_manifest()
+                for key, fname in FILES.items():
+                    rel = f"current/{fname}"
+                    if key in out and out[key].ok and not _fresh(latest.get(rel), CURRENT_DIR / fname):
+                        latest[rel] = out[key].manifest
+                _write_manifest(latest)
+        except OSError:
+            pass
     return out
@@ -0,0 +1,216 @@
+"""Base Legal version timeline: validate each NF-e against the tables in force at its dhEmi.
+
+Every upload moves the previous sheet to ``history/<AAAAMMDD_HHMMSS>__<arquivo>``
+(the timestamp is the moment it stopped being current). Per table this gives
+the versions and the instant each one took effect:
+
+    1º backup     desde sempre (é o mais antigo conhecido)
+    backup i      desde o carimbo do backup i-1 (quando ele substituiu o anterior)
+    current       desde o carimbo do último backup
+
+An explicit "vigente desde" informed at upload (vigencias.json) overrides the
+publish instant, so a table uploaded today can take effect on the date of
+the legal act. Items are grouped by the combination of versions in force at
+their dhEmi; each combination is compiled once (LRU) and reused by the batch.
+"""
+from __future__ import annotations
+
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .base_legal import (
+    BL_DIR, CURRENT_DIR, FILES, HISTORY_DIR, CompiledBaseLegal, _current_version,
+    compile_base_legal, ensure_base_legal, get_base_legal, load_table_file, load_vigencias,
+)
+from .instrumentation import span
+
+DATE_COL = "dhEmi"
+_TS_FMT = "%Y%m%d_%H%M%S"
+_SEMPRE = pd.Timestamp.min
+
+
+@dataclass(frozen=True)
+class TableVersion:
+    key: str
+    path: Path
+    vigente_desde: pd.Timestamp   # _SEMPRE para a versão mais antiga conhecida
+    atual: bool = False           # arquivo em current/
+
+    @property
+    def arquivo(self) -> str:
+        return str(self.path.relative_to(BL_DIR))
+
+
+def _backups(fname: str) -> List[Tuple[pd.Timestamp, Path]]:
+    out = []
+    for p in HISTORY_DIR.glob(f"*__{fname}"):
+        ts = pd.to_datetime(p.name.split("__", 1)[0], format=_TS_FMT, errors="coerce")
+        if not pd.isna(ts):
+            out.append((ts, p))
+    return sorted(out)
+
+
+def _explicit(vig: Dict[str, str], rel: str) -> Optional[pd.Timestamp]:
+    ts = pd.to_datetime(vig.get(rel), errors="coerce")
+    return None if pd.isna(ts) else ts
+
+
+@dataclass(frozen=True)
+class BaseLegalTimeline:
+    """Versions of each table, ordered by start of validity."""
+    versions: Dict[str, Tuple[TableVersion, ...]]
+    signature: Tuple = ()
+
+    @classmethod
+    def scan(cls, signature: Tuple = ()) -> "BaseLegalTimeline":
+        vig = load_vigencias()
+        versions: Dict[str, Tuple[TableVersion, ...]] = {}
+        for key, fname in FILES.items():
+            vs: List[TableVersion] = []
+            desde = _SEMPRE
+            for ts, p in _backups(fname):
+                rel = f"history/{p.name}"
+                vs.append(TableVersion(key, p, _explicit(vig, rel) or desde))
+                desde = ts
+            cur = CURRENT_DIR / fname
+            vs.append(TableVersion(key, cur, _explicit(vig, f"current/{fname}") or desde, atual=True))
+            # ordem estável: com o mesmo início, a publicada depois prevalece
+            versions[key] = tuple(sorted(vs, key=lambda v: v.vigente_desde))
+        return cls(versions, signature)
+
+    def rows(self) -> pd.DataFrame:
+        """Timeline as a table (Admin)."""
+        return pd.DataFrame([
+            {"tabela": v.key, "arquivo": v.arquivo, "atual": v.atual,
+             "vigente_desde": "" if v.vigente_desde == _SEMPRE else v.vigente_desde.isoformat(sep=" ")}
+            for vs in self.versions.values() for v in vs
+        ])
+
+    def resolve(self, when: pd.Series) -> pd.DataFrame:
+        """Version position per table for each date (one column per table, same index).
+
+        Dates before every start fall back to the oldest version; missing or
+        unparseable dates use the current files.
+        """
+        d = pd.to_datetime(when, errors="coerce")
+        nat = d.isna().to_numpy()
+        vals = d.to_numpy(dtype="datetime64[ns]").view("int64")
+        out = {}
+        for key, vs in self.versions.items():
+            starts = np.array([v.vigente_desde.value for v in vs], dtype="int64")
+            pos = np.searchsorted(starts, vals, side="right") - 1
+            pos = np.clip(pos, 0, len(vs) - 1)
+            cur = next(i for i, v in enumerate(vs) if v.atual)
+            out[key] = np.where(nat, cur, pos)
+        return pd.DataFrame(out, index=when.index)
+
+    def compiled(self, combo: Tuple[int, ...]) -> CompiledBaseLegal:
+        """Compiled Base Legal for one combination of version positions (FILES order)."""
+        chosen = [self.versions[k][i] for k, i in zip(FILES, combo)]
+        if all(v.atual for v in chosen):
+            return get_base_legal()
+        return _compile_versions(tuple((v.key, str(v.path), _mtime(v.path)) for v in chosen))
+
+
+def _mtime(path: Path) -> int:
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return 0
+
+
+@lru_cache(maxsize=8)
+def _compile_versions(files: Tuple[Tuple[str, str, int], ...]) -> CompiledBaseLegal:
+    with span("base_legal_versao", arquivos=len(files)):
+        return compile_base_legal({k: load_table_file(Path(p)) for k, p, _ in files}, version=files)
+
+
+_timeline: Optional[BaseLegalTimeline] = None
+_timeline_lock = threading.Lock()
+
+
+def _signature() -> Tuple:
+    hist = tuple(sorted(p.name for p in HISTORY_DIR.glob("*__*")))
+    return hist, _current_version(), _mtime(BL_DIR / "vigencias.json")
+
+
+def get_timeline() -> BaseLegalTimeline:
+    """Process-wide timeline, rescanned only when history/current/vigências change."""
+    global _timeline
+    ensure_base_legal()
+    sig = _signature()
+    cur = _timeline
+    if cur is not None and cur.signature == sig:
+        return cur
+    with _timeline_lock:
+        if _timeline is None or _timeline.signature != sig:
+            _timeline = BaseLegalTimeline.scan(sig)
+        return _timeline
+
+
+def emission_dates(df_itens: pd.DataFrame, col: str = DATE_COL) -> pd.Series:
+    """dhEmi as naive local timestamps (the document's own clock; offset ignored)."""
+    s = df_itens.get(col, pd.Series("", index=df_itens.index)).fillna("").astype(str)
+    return pd.to_datetime(s.str[:19].str.replace("T", " ", regex=False), errors="coerce", format="ISO8601")
+
+
+def split_by_vigencia(df_itens: pd.DataFrame, timeline: Optional[BaseLegalTimeline] = None
+                      ) -> List[Tuple[CompiledBaseLegal, np.ndarray]]:
+    """[(Base Legal em vigor, posições dos itens)] — one entry per version combination.
+
+    Positions are 0..n-1 in df_itens order.
+    """
+    if df_itens is None or df_itens.empty:
+        return [(get_base_legal(), np.arange(0 if df_itens is None else len(df_itens)))]
+    timeline = timeline or get_timeline()
+    pos = timeline.resolve(emission_dates(df_itens))
+    codes = pos.to_numpy()
+    combos, inv = np.unique(codes, axis=0, return_inverse=True)
+    inv = np.asarray(inv).reshape(-1)
+    out = []
+    with span("vigencia", items=len(df_itens), versoes=len(combos)):
+        for i, combo in enumerate(combos):
+            out.append((timeline.compiled(tuple(int(x) for x in combo)), np.flatnonzero(inv == i)))
+    return out
+
+
+def find_version_files(version: Tuple) -> Optional[Dict[str, Path]]:
+    """Files (current or history) of a get_base_legal().version — ((key, mtime_ns, size), ...).
+
+    Uploads only rename the previous sheet into history/, which keeps its
+    mtime and size, so a recorded version can be found again. None when
+    any of its files is gone.
+    """
+    out: Dict[str, Path] = {}
+    for key, mtime_ns, size in version:
+        fname = FILES.get(key)
+        if fname is None:
+            return None
+        for p in [CURRENT_DIR / fname] + [p for _, p in _backups(fname)]:
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            if st.st_mtime_ns == mtime_ns and st.st_size == size:
+                out[key] = p
+                break
+        else:
+            return None
+    return out
+
+
+def compiled_for_version(version: Tuple) -> Optional[CompiledBaseLegal]:
+    """Compiled Base Legal of a recorded version (cached like the timeline combinations)."""
+    version = tuple(tuple(v) for v in version)
+    if version == _current_version():
+        return get_base_legal()
+    files = find_version_files(version)
+    if files is None:
+        return None
+    return _compile_versions(tuple((k, str(p), _mtime(p)) for k, p in files.items()))
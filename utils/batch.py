@@ -0,0 +1,156 @@
+"""Whole-batch processing outside the UI: parse -> V2 -> V3 for (nome, bytes) pairs.
+
+Shared by the background jobs, the HTTP service and the watch-folder daemon.
+Options are the keys the UI records for a job:
+
+    executar_validacao   (padrão True)
+    aplicar_correcao_v3  aplica as correções automáticas seguras
+    ncm_engine           motor de sugestão de NCM (None = padrão do servidor)
+    perfil_regras        perfil de regras do cliente
+    por_vigencia         cada NF-e contra a Base Legal vigente no seu dhEmi
+
+Findings come back compact (utils.validator.expand_v2 / v3_corrector.finding.expand_v3).
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from .pipeline import parse_files, to_numeric_cols
+
+# progress(etapa, arquivos lidos, itens, erros de leitura)
+Progress = Callable[[str, int, int, int], None]
+
+
+@dataclass
+class BatchResult:
+    cabecalho: pd.DataFrame
+    itens: pd.DataFrame
+    itens_corrigido: pd.DataFrame
+    achados_v2: pd.DataFrame = field(default_factory=pd.DataFrame)
+    achados_v3: pd.DataFrame = field(default_factory=pd.DataFrame)
+    erros: pd.DataFrame = field(default_factory=lambda: pd.DataFrame(columns=["arquivo", "erro"]))
+    base_legal: Tuple = ()          # get_base_legal().version usada nos achados
+
+    def tables(self) -> Dict[str, pd.DataFrame]:
+        """Tables by the names used on disk (utils.jobs.RESULT_TABLES)."""
+        return {
+            "itens": self.itens,
+            "itens_corrigido": self.itens_corrigido,
+            "cabecalho": self.cabecalho,
+            "achados_v2": self.achados_v2,
+            "achados_v3": self.achados_v3,
+            "erros": self.erros,
+        }
+
+
+def init_worker() -> None:
+    """Pool initializer: the Base Legal compiled up front (after a fork, only its version is checked)."""
+    from .base_legal import get_base_legal
+    get_base_legal()
+
+
+def _noop(stage: str, done: int, items: int, errors: int) -> None:
+    pass
+
+
+def parse_batch(files: Sequence[Tuple[str, bytes]], progress: Optional[Progress] = None, step: int = 200) -> BatchResult:
+    """Items, headers and read errors of a batch (no validation; itens_corrigido = itens)."""
+    progress = progress or _noop
+    headers: List[Dict] = []
+    itens_all: List[Dict] = []
+    errors: List[Tuple[str, str]] = []
+    for i in range(0, len(files), step):
+        h, it, err = parse_files(files[i:i + step])
+        headers.extend(h)
+        itens_all.extend(it)
+        errors.extend(err)
+        progress("parse", min(i + step, len(files)), len(itens_all), len(errors))
+
+    df_itens = to_numeric_cols(pd.DataFrame(itens_all))
+    del itens_all
+    return BatchResult(pd.DataFrame(headers), df_itens, df_itens,
+                       erros=pd.DataFrame(errors, columns=["arquivo", "erro"]))
+
+
+def validate_batch(
+    res: BatchResult,
+    options: Optional[Dict[str, Any]] = None,
+    correct: bool = True,
+    learn: bool = True,
+    progress: Optional[Progress] = None,
+) -> BatchResult:
+    """V2 (and V3 unless correct=False) over the whole batch, in place; learn feeds the product catalog."""
+    from .base_legal import get_base_legal
+    from .product_catalog import get_catalog
+    from .rule_profiles import get_profile
+    from .validator import validar_itens, validar_itens_por_vigencia
+    from v3_corrector.correction_engine import apply_corrections, apply_corrections_por_vigencia
+
+    progress = progress or _noop
+    opts = options or {}
+    df_itens = res.itens
+    if df_itens.empty:
+        return res
+    done, n_err = len(res.cabecalho) + len(res.erros), len(res.erros)
+    progress("validacao", done, len(df_itens), n_err)
+    tables = get_base_legal()
+    profile = get_profile(opts.get("perfil_regras"))
+    por_vigencia = bool(opts.get("por_vigencia"))
+    res.base_legal = tables.version
+    if por_vigencia:
+        res.achados_v2 = validar_itens_por_vigencia(df_itens, profile=profile, compact=True)
+    else:
+        res.achados_v2 = validar_itens(df_itens, tables, profile=profile, compact=True)
+    if not correct:
+        return res
+
+    progress("correcao", done, len(df_itens), n_err)
+    corr_kw = dict(auto_apply=bool(opts.get("aplicar_correcao_v3")), ncm_engine=opts.get("ncm_engine"),
+                   catalog=get_catalog().snapshot(), profile=profile, compact=True)
+    if por_vigencia:
+        res.itens_corrigido, res.achados_v3 = apply_corrections_por_vigencia(df_itens, **corr_kw)
+    else:
+        res.itens_corrigido, res.achados_v3 = apply_corrections(df_itens, tables, **corr_kw)
+    if learn:
+        get_catalog().learn(df_itens, tables.allowed_ncms)
+    return res
+
+
+def process_files(
+    files: Sequence[Tuple[str, bytes]],
+    options: Optional[Dict[str, Any]] = None,
+    correct: bool = True,
+    learn: bool = True,
+    progress: Optional[Progress] = None,
+    step: int = 200,
+) -> BatchResult:
+    """Parse, validate (V2) and correct (V3) one batch with the shared Base Legal.
+
+    correct=False stops after V2 (itens_corrigido = itens); learn feeds the
+    product catalog like the UI does.
+    """
+    res = parse_batch(files, progress, step)
+    if not (options or {}).get("executar_validacao", True):
+        return res
+    return validate_batch(res, options, correct, learn, progress)
+
+
+def rewrite_files(files: Iterable[Tuple[str, bytes]], itens: pd.DataFrame,
+                  itens_corrigido: pd.DataFrame) -> Iterator[Tuple[str, bytes]]:
+    """Corrected XMLs (`<nome>_corrigido.xml`), one at a time; a file that fails to rewrite is kept as is."""
+    from .pipeline import changes_by_file
+    from v3_corrector.xml_rewriter import rewrite_nfe_xml
+
+    all_changes = changes_by_file(itens, itens_corrigido)
+    for fname, payload in files:
+        try:
+            changes = all_changes.get(fname, {})
+            corrected = rewrite_nfe_xml(payload, changes) if changes else payload
+        except Exception:
+            # fallback: keep original if something fails for this file
+            yield fname, payload
+            continue
+        yield fname.replace(".xml", "_corrigido.xml"), corrected
@@ -0,0 +1,90 @@
+"""App bootstrap: one-time checks per process and background warm-up.
+
+Streamlit reruns the whole script on every interaction, so what only has to
+happen once per server process lives here instead of at the top of app.py:
+
+    bootstrap()   admin user + Base Legal folders/templates, once per process
+    warm_up()     imports the main-page modules and compiles the Base Legal in
+                  a daemon thread, while the login screen is on display
+
+The login screen needs only LOGIN_MODULES (no pandas). STARTUP_MODULES are
+what the main page imports after login; FEATURE_MODULES are imported by the
+branch that uses them (export, V3, XML rewrite, manual edits, vigência).
+benchmarks/run.py --stages startup times both groups in a fresh interpreter.
+"""
+from __future__ import annotations
+
+import importlib
+import logging
+import os
+import threading
+from typing import Set
+
+from .users import ensure_admin
+
+LOGIN_MODULES = ("streamlit", "utils.users", "utils.bootstrap")
+STARTUP_MODULES = (
+    "pandas",
+    "utils.instrumentation",
+    "utils.pipeline",
+    "utils.product_catalog",
+    "utils.rule_profiles",
+    "utils.base_legal",
+    "utils.validator",
+    "utils.consolidation",
+    "utils.jobs",
+    "utils.result_grid",
+    "utils.results_db",
+    "v3_corrector.finding",
+    "v3_corrector.rules.ncm_similarity",
+)
+FEATURE_MODULES = (
+    "v3_corrector.correction_engine",
+    "v3_corrector.xml_rewriter",
+    "utils.manual_corrections",
+    "utils.base_legal_history",
+    "utils.excel_export",
+    "utils.columnar_export",
+)
+
+WARMUP_ENV = "NFE_WARMUP"
+
+_log = logging.getLogger(__name__)
+_done: Set[str] = set()
+_lock = threading.Lock()
+
+
+def bootstrap(admin_username: str, admin_password: str) -> None:
+    """Admin user and Base Legal checks, once per process (per admin name), then warm_up()."""
+    if admin_username in _done:
+        return
+    with _lock:
+        if admin_username in _done:
+            return
+        ensure_admin(admin_username=admin_username, admin_password=admin_password)
+        _done.add(admin_username)
+    warm_up()
+
+
+def _warm() -> None:
+    try:
+        for name in STARTUP_MODULES:
+            importlib.import_module(name)
+        from .base_legal import ensure_base_legal, get_base_legal
+        ensure_base_legal()
+        get_base_legal()
+    except Exception:  # só aquece: a página refaz (e mostra) o que falhar
+        _log.exception("Falha no aquecimento do app")
+
+
+def warm_up() -> None:
+    """Start the warm-up thread once per process (NFE_WARMUP=0 runs the checks inline, no thread)."""
+    with _lock:
+        if "_warm" in _done:
+            return
+        _done.add("_warm")
+    if os.environ.get(WARMUP_ENV, "1").strip().lower() in ("0", "false", "no", "off"):
+        from .base_legal import ensure_base_legal
+        ensure_base_legal()
+        return
+    threading.Thread(target=_warm, name="app_warm_up", daemon=True).start()
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import io
+import zipfile
+from pathlib import Path
+from typing import Dict, List, Union
+
+import pandas as pd
+
+from .instrumentation import span
+
+# Formatos colunares suportados: extensão do arquivo por formato
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# Colunas numéricas conhecidas (itens, cabeçalho, consolidado)
+NUMERIC_COLS = {
+    "qCom", "vUnCom", "vProd", "pICMS", "vICMS", "vIPI", "vPIS", "vCOFINS", "vNF",
+    "tot_vBC", "tot_vICMS", "tot_vST", "tot_vProd", "tot_vFrete", "tot_vDesc",
+    "tot_vIPI", "tot_vPIS", "tot_vCOFINS",
+    "arquivos", "itens", "quantidade", "valor_total", "valor_unit_medio",
+}
+
+# Colunas texto com até esta fração de valores distintos viram category
+# (dicionário no Parquet/Arrow): NCM, CFOP, CST, severidade, regra, emitente...
+CATEGORY_MAX_RATIO = 0.5
+
+
+def typed_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Return a copy with numeric columns as float64 and repetitive text as category."""
+    if df is None:
+        return pd.DataFrame()
+    out = df.copy()
+    n = len(out)
+    for col in out.columns:
+        s = out[col]
+        if col in NUMERIC_COLS:
+            if not pd.api.types.is_numeric_dtype(s):
+                s = pd.to_numeric(s.astype(str).str.replace(",", ".", regex=False), errors="coerce")
+            out[col] = s.astype("float64")
+        elif s.dtype == object:
+            s = s.astype("string")
+            if n and s.nunique(dropna=True) <= CATEGORY_MAX_RATIO * n:
+                s = s.astype("category")
+            out[col] = s
+    return out.reset_index(drop=True)
+
+
+def _table(df: pd.DataFrame):
+    import pyarrow as pa  # declarado em requirements.txt
+    return pa.Table.from_pandas(typed_frame(df), preserve_index=False)
+
+
+def to_columnar_bytes(df: pd.DataFrame, fmt: str = "parquet") -> bytes:
+    """Serialize one table as Parquet (zstd) or Arrow IPC file (zstd)."""
+    import pyarrow as pa
+
+    table = _table(df)
+    buf = io.BytesIO()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(table, buf, compression="zstd")
+    elif fmt == "arrow":
+        opts = pa.ipc.IpcWriteOptions(compression="zstd")
+        with pa.ipc.new_file(buf, table.schema, options=opts) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Formato colunar não suportado: {fmt}")
+    return buf.getvalue()
+
+
+def write_columnar(tables: Dict[str, pd.DataFrame], out_dir: Union[str, Path], fmt: str = "parquet") -> List[Path]:
+    """Write each table to `<out_dir>/<nome><ext>` (batch path). Returns written paths."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths: List[Path] = []
+    with span("export_columnar", fmt=fmt):
+        for name, df in tables.items():
+            if df is None:
+                continue
+            p = out_dir / f"{name}{FORMATS[fmt]}"
+            tmp = p.with_name(p.name + ".tmp")
+            tmp.write_bytes(to_columnar_bytes(df, fmt))
+            tmp.replace(p)
+            paths.append(p)
+    return paths
+
+
+def columnar_zip(tables: Dict[str, pd.DataFrame], fmt: str = "parquet") -> bytes:
+    """ZIP with one columnar file per table (UI download). Files are already compressed."""
+    buf = io.BytesIO()
+    with span("export_columnar", fmt=fmt), zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as zf:
+        for name, df in tables.items():
+            if df is None:
+                continue
+            zf.writestr(f"{name}{FORMATS[fmt]}", to_columnar_bytes(df, fmt))
+    return buf.getvalue()
+
+
+def read_columnar(path: Union[str, Path]) -> pd.DataFrame:
+    """Read back a file written by write_columnar (by extension)."""
+    path = Path(path)
+    if path.suffix == FORMATS["arrow"]:
+        import pyarrow as pa
+        with pa.memory_map(str(path), "r") as src:
+            return pa.ipc.open_file(src).read_all().to_pandas()
+    return pd.read_parquet(path)
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import instrumented
+
+# Dimensões do cubo (grão mais fino) e agrupamentos oferecidos na UI
+CUBE_KEYS = ["xProd", "cProd", "NCM", "CFOP"]
+
+GROUPINGS: Dict[str, List[str]] = {
+    "xProd + NCM + CFOP": ["xProd", "NCM", "CFOP"],
+    "cProd + NCM + CFOP": ["cProd", "NCM", "CFOP"],
+    "NCM + CFOP": ["NCM", "CFOP"],
+    "xProd": ["xProd"],
+}
+
+
+def _combine(codes: Sequence[np.ndarray]) -> np.ndarray:
+    """Dense group id for a tuple of factor codes (re-factorized per step: no int64 overflow)."""
+    if not codes:
+        return np.zeros(0, dtype=np.int64)
+    gid = codes[0].astype(np.int64)
+    for c in codes[1:]:
+        width = int(c.max()) + 1 if len(c) else 1
+        gid, _ = pd.factorize(gid * width + c, sort=False)
+        gid = gid.astype(np.int64)
+    return gid
+
+
+def _first_index(gid: np.ndarray, n_groups: int) -> np.ndarray:
+    """Position of the first occurrence of each group id."""
+    dd = pd.Series(gid).drop_duplicates()
+    first = np.empty(n_groups, dtype=np.int64)
+    first[dd.to_numpy()] = dd.index.to_numpy()
+    return first
+
+
+def _numeric(df: pd.DataFrame, col: str) -> np.ndarray:
+    if col not in df.columns:
+        return np.full(len(df), np.nan)
+    return pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+
+@dataclass
+class ConsolidationCube:
+    """Finest-grain aggregate of the items over xProd × cProd × NCM × CFOP.
+
+    Built once per item table; `rollup()` regroups the (small) cube instead of
+    the full item table.
+    """
+    levels: Dict[str, np.ndarray]   # valores distintos por dimensão
+    cell_codes: np.ndarray          # (n_cells, len(CUBE_KEYS)) códigos por célula
+    itens: np.ndarray
+    quantidade: np.ndarray
+    valor_total: np.ndarray
+    vUnCom_sum: np.ndarray
+    vUnCom_n: np.ndarray
+    arq_cells: Optional[np.ndarray] = None  # pares distintos (célula, arquivo)
+    arq_codes: Optional[np.ndarray] = None
+    n_arquivos: int = 0
+
+    @classmethod
+    @instrumented("consolidation_cube", count=lambda cls, df_itens: None if df_itens is None else len(df_itens))
+    def build(cls, df_itens: pd.DataFrame) -> "ConsolidationCube":
+        n = 0 if df_itens is None else len(df_itens)
+        levels: Dict[str, np.ndarray] = {}
+        codes: List[np.ndarray] = []
+        for k in CUBE_KEYS:
+            if n and k in df_itens.columns:
+                c, u = pd.factorize(df_itens[k], sort=False, use_na_sentinel=False)
+            else:
+                c, u = np.zeros(n, dtype=np.int64), np.array([""], dtype=object)
+            codes.append(c.astype(np.int64))
+            levels[k] = np.asarray(u, dtype=object)
+
+        fine = _combine(codes)
+        n_cells = int(fine.max()) + 1 if n else 0
+        first = _first_index(fine, n_cells)
+        cell_codes = np.column_stack([c[first] for c in codes]) if n_cells else np.zeros((0, len(CUBE_KEYS)), dtype=np.int64)
+
+        q = _numeric(df_itens, "qCom") if n else np.zeros(0)
+        v = _numeric(df_itens, "vProd") if n else np.zeros(0)
+        u = _numeric(df_itens, "vUnCom") if n else np.zeros(0)
+        cube = cls(
+            levels=levels,
+            cell_codes=cell_codes,
+            itens=np.bincount(fine, minlength=n_cells).astype(np.int64),
+            quantidade=np.bincount(fine, weights=np.nan_to_num(q), minlength=n_cells),
+            valor_total=np.bincount(fine, weights=np.nan_to_num(v), minlength=n_cells),
+            vUnCom_sum=np.bincount(fine, weights=np.nan_to_num(u), minlength=n_cells),
+            vUnCom_n=np.bincount(fine, weights=~np.isnan(u), minlength=n_cells).astype(np.int64),
+        )
+
+        if n and "arquivo" in df_itens.columns:
+            arq, arq_u = pd.factorize(df_itens["arquivo"], sort=False, use_na_sentinel=False)
+            width = max(len(arq_u), 1)
+            pairs = pd.unique(fine * width + arq.astype(np.int64))
+            cube.arq_cells = pairs // width
+            cube.arq_codes = pairs % width
+            cube.n_arquivos = width
+        return cube
+
+    @property
+    def n_cells(self) -> int:
+        return len(self.itens)
+
+    @instrumented("consolidation_rollup", count=lambda self, key_cols: self.n_cells)
+    def rollup(self, key_cols: Sequence[str]) -> pd.DataFrame:
+        """Aggregate the cube to `key_cols` (subset of CUBE_KEYS), sorted by valor_total desc."""
+        key_cols = list(key_cols)
+        unknown = [k for k in key_cols if k not in CUBE_KEYS]
+        if unknown:
+            raise ValueError(f"Colunas fora do cubo de consolidação: {', '.join(unknown)}")
+
+        cols = key_cols + (["arquivos"] if self.arq_cells is not None else []) + [
+            "itens", "quantidade", "valor_total", "valor_unit_medio",
+        ]
+        if self.n_cells == 0:
+            return pd.DataFrame(columns=cols)
+
+        pos = [CUBE_KEYS.index(k) for k in key_cols]
+        coarse = _combine([self.cell_codes[:, p] for p in pos]) if pos else np.zeros(self.n_cells, dtype=np.int64)
+        n_groups = int(coarse.max()) + 1
+        first = _first_index(coarse, n_groups)
+
+        out = {k: self.levels[k][self.cell_codes[first, p]] for k, p in zip(key_cols, pos)}
+        if self.arq_cells is not None:
+            g = pd.unique(coarse[self.arq_cells] * self.n_arquivos + self.arq_codes) // self.n_arquivos
+            out["arquivos"] = np.bincount(g, minlength=n_groups)
+        out["itens"] = np.bincount(coarse, weights=self.itens, minlength=n_groups).astype(np.int64)
+        out["quantidade"] = np.bincount(coarse, weights=self.quantidade, minlength=n_groups)
+        out["valor_total"] = np.bincount(coarse, weights=self.valor_total, minlength=n_groups)
+        u_sum = np.bincount(coarse, weights=self.vUnCom_sum, minlength=n_groups)
+        u_n = np.bincount(coarse, weights=self.vUnCom_n, minlength=n_groups)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out["valor_unit_medio"] = np.where(u_n > 0, u_sum / np.where(u_n > 0, u_n, 1), np.nan)
+
+        return (
+            pd.DataFrame(out, columns=cols)
+            .sort_values(["valor_total"], ascending=False, kind="stable")
+            .reset_index(drop=True)
+        )
@@ -1,9 +1,23 @@
 import base64, hashlib, hmac, os
 
-def hash_password(password: str, salt: bytes | None = None, iterations: int = 200_000) -> str:
+# Custo do PBKDF2 (iterações) para hashes novos; hashes com custo menor são refeitos no próximo login.
+ITERATIONS_ENV = "NFE_PBKDF2_ITERATIONS"
+DEFAULT_ITERATIONS = 200_000
+MIN_ITERATIONS = 100_000   # piso: um valor baixo ou digitado errado não enfraquece os hashes
+
+
+def configured_iterations() -> int:
+    try:
+        return max(MIN_ITERATIONS, int(os.environ.get(ITERATIONS_ENV, "") or DEFAULT_ITERATIONS))
+    except ValueError:
+        return DEFAULT_ITERATIONS
+
+def hash_password(password: str, salt: bytes | None = None, iterations: int | None = None) -> str:
     """Return a compact string storing params+safely hashed password."""
     if salt is None:
         salt = os.urandom(16)
+    if iterations is None:
+        iterations = configured_iterations()
     dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations, dklen=32)
     return f"pbkdf2_sha256${iterations}${base64.b64encode(salt).decode()}${base64.b64encode(dk).decode()}"
 
@@ -18,4 +32,15 @@ def verify_password(password: str, stored: str) -> bool:
         dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations, dklen=len(dk_expected))
         return hmac.compare_digest(dk, dk_expected)
     except Exception:
-        return False
\ No newline at end of file
+        return False
+
+def needs_rehash(stored: str, iterations: int | None = None) -> bool:
+    """True when the stored hash was made with a lower cost than the configured one (never downgrades)."""
+    try:
+        return int(stored.split("$", 2)[1]) < (iterations or configured_iterations())
+    except (IndexError, ValueError):
+        return True
+
+def sign(payload: bytes, key: bytes) -> str:
+    """HMAC-SHA256 of payload, urlsafe base64 without padding."""
+    return base64.urlsafe_b64encode(hmac.new(key, payload, hashlib.sha256).digest()).rstrip(b"=").decode()
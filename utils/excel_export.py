@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import os
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Sequence, Union
+
+import pandas as pd
+
+from .instrumentation import span
+
+# Limite do Excel por aba (inclui a linha de cabeçalho)
+EXCEL_MAX_ROWS = 1_048_576
+DEFAULT_CHUNK_ROWS = 50_000
+
+
+@dataclass
+class ExcelSheet:
+    """One logical table to export.
+
+    data: a DataFrame or an iterable of DataFrame chunks (same columns).
+    n_rows: total rows when `data` is an iterator (decides the sheet naming);
+    for DataFrames it is taken from len(data).
+    """
+    name: str
+    data: Union[pd.DataFrame, Iterable[pd.DataFrame]]
+    n_rows: Optional[int] = None
+
+
+def iter_frame_chunks(df: pd.DataFrame, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+
+def _sheet_names(name: str, n_rows: Optional[int], per_sheet: int) -> Iterator[str]:
+    """'Itens_Bruto' when it fits in one sheet, else 'Itens_Bruto_1', 'Itens_Bruto_2', ..."""
+    if n_rows is not None and n_rows <= per_sheet:
+        yield name
+        return
+    i = 1
+    while True:
+        yield f"{name}_{i}"[:31]
+        i += 1
+
+
+def _rows(chunk: pd.DataFrame) -> Iterator[tuple]:
+    # NaN/NaT -> None (célula vazia, como no to_excel)
+    clean = chunk.astype(object).where(chunk.notna(), None)
+    return clean.itertuples(index=False, name=None)
+
+
+def write_excel_streaming(
+    sheets: Sequence[ExcelSheet],
+    path: Union[str, Path, None] = None,
+    max_rows: int = EXCEL_MAX_ROWS,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> Path:
+    """Write `sheets` to an .xlsx using xlsxwriter's constant_memory mode.
+
+    Rows are flushed to disk as they are written, so memory stays bounded by
+    one chunk. Tables longer than `max_rows - 1` are split across `<nome>_1..N`.
+    Returns the output path (a temp file when `path` is None).
+    """
+    import xlsxwriter  # optional heavy dependency, only needed on export
+
+    if path is None:
+        fd, tmp = tempfile.mkstemp(prefix="xml_fiscal_", suffix=".xlsx")
+        os.close(fd)
+        path = tmp
+    path = Path(path)
+
+    per_sheet = max_rows - 1  # uma linha para o cabeçalho
+    total_rows = 0
+    with span("export_excel") as sp:
+        wb = xlsxwriter.Workbook(str(path), {"constant_memory": True, "strings_to_numbers": False})
+        try:
+            header_fmt = wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+            for sheet in sheets:
+                if isinstance(sheet.data, pd.DataFrame):
+                    n_rows = len(sheet.data)
+                    chunks: Iterable[pd.DataFrame] = iter_frame_chunks(sheet.data, chunk_rows)
+                    columns: List[str] = [str(c) for c in sheet.data.columns]
+                else:
+                    n_rows = sheet.n_rows
+                    chunks = sheet.data
+                    columns = []
+
+                names = _sheet_names(sheet.name, n_rows, per_sheet)
+                ws = None
+                row = 0
+
+                def new_sheet():
+                    w = wb.add_worksheet(next(names))
+                    w.write_row(0, 0, columns, header_fmt)
+                    return w
+
+                if columns:
+                    ws, row = new_sheet(), 1
+                for chunk in chunks:
+                    if chunk is None or chunk.empty:
+                        if ws is None and chunk is not None:
+                            columns = [str(c) for c in chunk.columns]
+                        continue
+                    if ws is None:
+                        columns = [str(c) for c in chunk.columns]
+                        ws, row = new_sheet(), 1
+                    for values in _rows(chunk):
+                        if row > per_sheet:
+                            ws, row = new_sheet(), 1
+                        ws.write_row(row, 0, values)
+                        row += 1
+                    total_rows += len(chunk)
+                if ws is None:
+                    # fonte vazia: mantém a aba com cabeçalho (mesmo comportamento do to_excel)
+                    ws = new_sheet()
+        finally:
+            wb.close()
+        sp.set(items=total_rows, sheets=len(wb.worksheets()))
+    return path
@@ -0,0 +1,221 @@
+"""Hot-path instrumentation: stage spans with wall time, item counts and memory peak.
+
+Disabled by default; when disabled `span()` returns a shared no-op context and
+`instrumented` wrappers just call through, so the hooks cost one flag check.
+
+    NFE_INSTRUMENT=1          liga os spans (logs JSON no logger "nfe.perf")
+    NFE_INSTRUMENT_MEMORY=1   mede também o pico de memória (tracemalloc)
+
+Spans are kept per thread (each Streamlit session runs in its own thread).
+The tracemalloc peak is process-wide, so with several sessions running at the
+same time the memory figures include the other sessions' allocations. Tracing
+itself is shared too: enable()/disable() take an `owner` (the Streamlit
+session; reruns run on new threads) and tracemalloc stops only when no owner
+still wants it.
+"""
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set
+
+logger = logging.getLogger("nfe.perf")
+
+_TRUE = {"1", "true", "yes", "on", "sim"}
+# Ligado para o processo todo via ambiente, ou por thread/sessão via enable()
+_env_enabled = os.environ.get("NFE_INSTRUMENT", "").strip().lower() in _TRUE
+_env_memory = os.environ.get("NFE_INSTRUMENT_MEMORY", "").strip().lower() in _TRUE
+_local = threading.local()
+# Donos (sessões) que pediram tracemalloc; o rastreamento é do processo todo
+_mem_lock = threading.Lock()
+_mem_owners: Set[Hashable] = set()
+
+
+def _ensure_log_handler() -> None:
+    """Emit one JSON object per line on stderr unless logging is already configured."""
+    if not logger.handlers:
+        h = logging.StreamHandler()
+        h.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(h)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+
+def _memory_acquire(owner: Hashable) -> None:
+    with _mem_lock:
+        _mem_owners.add(owner)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+def _memory_release(owner: Hashable) -> None:
+    with _mem_lock:
+        if owner not in _mem_owners:
+            return
+        _mem_owners.discard(owner)
+        if not _mem_owners and not _env_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def enable(memory: bool = False, owner: Optional[Hashable] = None) -> None:
+    """Turn spans on for the current thread (sessão Streamlit).
+
+    owner: who holds the tracemalloc request (default: this thread); pass the
+    session id so a later rerun, on another thread, can release it.
+    """
+    _ensure_log_handler()
+    owner = threading.get_ident() if owner is None else owner
+    _local.enabled = True
+    _local.memory = bool(memory)
+    if memory:
+        _memory_acquire(owner)
+    else:
+        _memory_release(owner)
+
+
+def disable(owner: Optional[Hashable] = None) -> None:
+    """Turn spans off for the current thread (unless NFE_INSTRUMENT is set)."""
+    _memory_release(threading.get_ident() if owner is None else owner)
+    _local.enabled = False
+    _local.memory = False
+
+
+def is_enabled() -> bool:
+    return _env_enabled or getattr(_local, "enabled", False)
+
+
+def _memory_on() -> bool:
+    return (_env_memory or getattr(_local, "memory", False)) and tracemalloc.is_tracing()
+
+
+if _env_enabled:
+    _ensure_log_handler()
+    if _env_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def _state():
+    st = getattr(_local, "state", None)
+    if st is None:
+        st = _local.state = {"stack": [], "records": []}
+    return st
+
+
+def reset() -> None:
+    """Discard the spans recorded by the current thread."""
+    _state()["records"].clear()
+
+
+def get_spans() -> List[Dict[str, Any]]:
+    """Spans recorded by the current thread, in completion order."""
+    return list(_state()["records"])
+
+
+class _NoopSpan:
+    items = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("name", "items", "fields", "_t0", "_mem0", "_peak_acc", "_parent", "depth")
+
+    def __init__(self, name: str, items: Optional[int] = None, **fields):
+        self.name = name
+        self.items = items
+        self.fields = fields
+
+    def set(self, **fields) -> None:
+        """Attach extra fields (ex.: items=len(df)) before the span closes."""
+        if "items" in fields:
+            self.items = fields.pop("items")
+        self.fields.update(fields)
+
+    def __enter__(self):
+        st = _state()
+        self._parent = st["stack"][-1] if st["stack"] else None
+        self.depth = len(st["stack"])
+        self._peak_acc = 0
+        self._mem0 = None
+        if _memory_on():
+            cur, peak = tracemalloc.get_traced_memory()
+            if self._parent is not None:
+                self._parent._peak_acc = max(self._parent._peak_acc, peak)
+            tracemalloc.reset_peak()
+            self._mem0 = cur
+        st["stack"].append(self)
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._t0
+        st = _state()
+        if st["stack"] and st["stack"][-1] is self:
+            st["stack"].pop()
+        rec: Dict[str, Any] = {
+            "span": self.name,
+            "parent": self._parent.name if self._parent is not None else None,
+            "depth": self.depth,
+            "seconds": round(seconds, 6),
+            "items": self.items,
+        }
+        if self.items:
+            rec["items_per_s"] = round(self.items / seconds, 1) if seconds > 0 else None
+        if self._mem0 is not None and tracemalloc.is_tracing():
+            peak = max(self._peak_acc, tracemalloc.get_traced_memory()[1])
+            rec["peak_mb"] = round((peak - self._mem0) / 1e6, 3)
+            if self._parent is not None:
+                self._parent._peak_acc = max(self._parent._peak_acc, peak)
+        if exc_type is not None:
+            rec["error"] = exc_type.__name__
+        rec.update(self.fields)
+        st["records"].append(rec)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(rec, ensure_ascii=False, default=str))
+        return False
+
+
+def span(name: str, items: Optional[int] = None, **fields):
+    """Context manager timing a stage: `with span("parse", items=n): ...`."""
+    if not (_env_enabled or getattr(_local, "enabled", False)):
+        return _NOOP
+    return Span(name, items, **fields)
+
+
+def instrumented(name: str, count: Optional[Callable[..., Optional[int]]] = None):
+    """Decorator version of span(); `count(*args, **kwargs)` gives the item count."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not (_env_enabled or getattr(_local, "enabled", False)):
+                return fn(*args, **kwargs)
+            items = None
+            if count is not None:
+                try:
+                    items = count(*args, **kwargs)
+                except Exception:
+                    items = None
+            with Span(name, items):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def count_rows(df, *args, **kwargs) -> Optional[int]:
+    """`count` helper: rows of the first argument (DataFrame / list)."""
+    return None if df is None else len(df)
@@ -0,0 +1,550 @@
+"""Local background jobs: a batch of XMLs is processed in a worker process.
+
+Layout of a job on disk (DATA_DIR/jobs/<job_id>/):
+    input.zip      XMLs enviados (ZIP_STORED)
+    status.json    estado, progresso e opções (reescrito atomicamente)
+    manifest.json  blocos de leitura (início/fim no input.zip, estado, itens, erros)
+    chunks/NNNN/   itens, cabecalho e erros de cada bloco concluído (Parquet)
+    results/       itens, itens_corrigido, cabecalho, achados_v2, achados_v3 (Parquet;
+                   achados compactos: `item` = posição em itens + regra do catálogo)
+                   e consulta.sqlite (utils.results_db)
+
+Reading is split into blocks of NFE_JOB_CHUNK files, each written to disk as
+it finishes; a rerun (Retomar, or a server restart) skips the blocks marked ok,
+retries only the failed or pending ones, and assembles the results from the
+block outputs. Validation runs once over the assembled items, so lot-level
+rules see the whole batch exactly as in a single pass.
+
+The Streamlit process keeps one shared ProcessPoolExecutor; sessions only submit
+and poll status.json, so a long batch never blocks (or gets restarted by) a rerun.
+"""
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # Windows: um processo servidor por DATA_DIR
+    fcntl = None
+
+from .base_legal import DATA_DIR
+
+JOBS_DIR = DATA_DIR / "jobs"
+RESULT_TABLES = ["itens", "itens_corrigido", "cabecalho", "achados_v2", "achados_v3", "erros"]
+FINDING_TABLES = {"achados_v2", "achados_v3"}
+
+CHUNK_TABLES = ["itens", "cabecalho", "erros"]
+CHUNK_ENV = "NFE_JOB_CHUNK"
+DEFAULT_CHUNK = 2000        # arquivos por bloco
+
+# Estados: queued -> running -> done | failed
+ACTIVE_STATES = {"queued", "running"}
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+@dataclass
+class JobStatus:
+    job_id: str
+    owner: str
+    state: str = "queued"
+    created_at: str = ""
+    started_at: str = ""
+    finished_at: str = ""
+    total: int = 0          # arquivos XML
+    done: int = 0           # arquivos processados
+    items: int = 0
+    errors: int = 0
+    stage: str = ""
+    message: str = ""
+    options: Dict[str, Any] = field(default_factory=dict)
+    base_legal: List[Any] = field(default_factory=list)  # get_base_legal().version usada nos achados
+
+    @property
+    def progress(self) -> float:
+        if self.state == "done":
+            return 1.0
+        return (self.done / self.total) if self.total else 0.0
+
+
+def job_dir(job_id: str) -> Path:
+    return JOBS_DIR / job_id
+
+
+def _write_status(status: JobStatus) -> None:
+    d = job_dir(status.job_id)
+    d.mkdir(parents=True, exist_ok=True)
+    tmp = d / "status.json.tmp"
+    tmp.write_text(json.dumps(asdict(status), ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.replace(d / "status.json")
+
+
+def job_status(job_id: str) -> Optional[JobStatus]:
+    p = job_dir(job_id) / "status.json"
+    try:
+        data = json.loads(p.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return JobStatus(**data)
+
+
+def list_jobs(owner: Optional[str] = None) -> List[JobStatus]:
+    """Jobs on disk (most recent first), optionally filtered by owner."""
+    if not JOBS_DIR.exists():
+        return []
+    out = []
+    for d in JOBS_DIR.iterdir():
+        st = job_status(d.name) if d.is_dir() else None
+        if st is not None and (owner is None or st.owner == owner):
+            out.append(st)
+    return sorted(out, key=lambda s: s.created_at, reverse=True)
+
+
+def load_job_inputs(job_id: str) -> List[Tuple[str, bytes]]:
+    with zipfile.ZipFile(job_dir(job_id) / "input.zip") as zf:
+        return [(zi.filename, zf.read(zi)) for zi in zf.infolist()]
+
+
+def _read_table(p: Path, plain: bool = True) -> pd.DataFrame:
+    from .columnar_export import read_columnar
+
+    if not p.exists():
+        return pd.DataFrame()
+    df = read_columnar(p)
+    if plain:
+        for c in df.columns:
+            if isinstance(df[c].dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(df[c].dtype):
+                df[c] = df[c].astype(object).where(df[c].notna(), "")
+    return df
+
+
+def load_job_result(job_id: str) -> Dict[str, pd.DataFrame]:
+    """Result tables of a finished job, with text columns back as plain object dtype.
+
+    Findings keep their categorical columns (nulls mean "texto do catálogo").
+    """
+    res_dir = job_dir(job_id) / "results"
+    return {name: _read_table(res_dir / f"{name}.parquet", plain=name not in FINDING_TABLES)
+            for name in RESULT_TABLES}
+
+
+# ---------------------------------------------------------------------------
+# Blocos e manifesto
+# ---------------------------------------------------------------------------
+
+def chunk_size() -> int:
+    try:
+        return max(1, int(os.environ.get(CHUNK_ENV, "") or DEFAULT_CHUNK))
+    except ValueError:
+        return DEFAULT_CHUNK
+
+
+def _chunk_dir(job_id: str, idx: int) -> Path:
+    return job_dir(job_id) / "chunks" / f"{idx:04d}"
+
+
+def load_manifest(job_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads((job_dir(job_id) / "manifest.json").read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_manifest(job_id: str, manifest: Dict[str, Any]) -> None:
+    d = job_dir(job_id)
+    tmp = d / "manifest.json.tmp"
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.replace(d / "manifest.json")
+
+
+def _new_manifest(total: int, size: int) -> Dict[str, Any]:
+    return {
+        "total": total,
+        "tamanho_bloco": size,
+        "blocos": [{"bloco": i, "inicio": s, "fim": min(s + size, total), "estado": "pendente",
+                    "itens": 0, "erros": 0, "mensagem": ""}
+                   for i, s in enumerate(range(0, total, size))],
+    }
+
+
+def _read_chunk_inputs(job_id: str, start: int, end: int) -> Tuple[List[Tuple[str, bytes]], List[Tuple[str, str]]]:
+    """Members [start, end) of input.zip; an unreadable member becomes a read error, not a block failure."""
+    files: List[Tuple[str, bytes]] = []
+    errors: List[Tuple[str, str]] = []
+    with zipfile.ZipFile(job_dir(job_id) / "input.zip") as zf:
+        for zi in zf.infolist()[start:end]:
+            try:
+                files.append((zi.filename, zf.read(zi)))
+            except Exception as e:
+                errors.append((zi.filename, f"Falha ao ler do lote: {type(e).__name__}: {e}"))
+    return files, errors
+
+
+def _run_chunk(job_id: str, chunk: Dict[str, Any]) -> None:
+    """Parse one block and write its tables; the block is marked ok only after they are on disk."""
+    from .batch import parse_batch
+    from .columnar_export import write_columnar
+
+    files, read_errors = _read_chunk_inputs(job_id, chunk["inicio"], chunk["fim"])
+    res = parse_batch(files)
+    del files
+    if read_errors:
+        res.erros = pd.concat([res.erros, pd.DataFrame(read_errors, columns=["arquivo", "erro"])],
+                              ignore_index=True)
+    d = _chunk_dir(job_id, chunk["bloco"])
+    tmp = d.with_name(d.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    write_columnar({"itens": res.itens, "cabecalho": res.cabecalho, "erros": res.erros}, tmp, fmt="parquet")
+    shutil.rmtree(d, ignore_errors=True)
+    tmp.rename(d)
+    chunk.update(estado="ok", itens=len(res.itens), erros=len(res.erros), mensagem="")
+
+
+def _assemble(job_id: str, manifest: Dict[str, Any]) -> Dict[str, pd.DataFrame]:
+    """Block tables concatenated in input order (item positions renumbered over the whole batch)."""
+    out: Dict[str, pd.DataFrame] = {}
+    for name in CHUNK_TABLES:
+        parts = [_read_table(_chunk_dir(job_id, c["bloco"]) / f"{name}.parquet") for c in manifest["blocos"]]
+        parts = [p for p in parts if not p.empty]
+        out[name] = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+    if out["erros"].empty:
+        out["erros"] = pd.DataFrame(columns=["arquivo", "erro"])
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Worker (roda em processo separado)
+# ---------------------------------------------------------------------------
+
+def _run_job(job_id: str) -> str:
+    from .batch import BatchResult, validate_batch
+    from .columnar_export import write_columnar
+    from .results_db import DB_NAME, build_results_db
+
+    status = job_status(job_id)
+    if status is None:
+        return "missing"
+    status.state = "running"
+    status.started_at = _now()
+    status.stage = "parse"
+    _write_status(status)
+    last = [time.monotonic()]
+
+    def progress(stage: str, done: int, items: int, errors: int) -> None:
+        changed = stage != status.stage
+        status.stage, status.done, status.items, status.errors = stage, done, items, errors
+        if changed or time.monotonic() - last[0] > 0.5:
+            _write_status(status)
+            last[0] = time.monotonic()
+
+    try:
+        with zipfile.ZipFile(job_dir(job_id) / "input.zip") as zf:
+            status.total = len(zf.infolist())
+        manifest = load_manifest(job_id)
+        if manifest is None or manifest.get("total") != status.total:
+            manifest = _new_manifest(status.total, chunk_size())
+            _write_manifest(job_id, manifest)
+
+        blocks = manifest["blocos"]
+        for chunk in blocks:
+            if chunk["estado"] == "ok" and _chunk_dir(job_id, chunk["bloco"]).is_dir():
+                continue
+            try:
+                _run_chunk(job_id, chunk)
+            except Exception as e:
+                # os demais blocos seguem; só este será refeito ao retomar
+                chunk.update(estado="falha", mensagem=f"{type(e).__name__}: {e}")
+            _write_manifest(job_id, manifest)
+            ok = [c for c in blocks if c["estado"] == "ok"]
+            progress(f"parse {chunk['bloco'] + 1}/{len(blocks)}", sum(c["fim"] - c["inicio"] for c in ok),
+                     sum(c["itens"] for c in ok), sum(c["erros"] for c in ok))
+
+        failed = [c for c in blocks if c["estado"] != "ok"]
+        if failed:
+            detail = "; ".join(f"bloco {c['bloco'] + 1}: {c['mensagem'] or c['estado']}" for c in failed[:3])
+            raise RuntimeError(f"{len(failed)} de {len(blocks)} bloco(s) com falha ({detail}). "
+                               "Retomar reprocessa só esses blocos.")
+
+        status.stage = "montagem"
+        _write_status(status)
+        tables = _assemble(job_id, manifest)
+        itens = tables["itens"]     # colunas numéricas já convertidas em cada bloco
+        res = BatchResult(tables["cabecalho"], itens, itens, erros=tables["erros"])
+        status.done, status.items, status.errors = status.total, len(itens), len(res.erros)
+        if (status.options or {}).get("executar_validacao", True):
+            res = validate_batch(res, status.options or {}, progress=progress)
+        status.base_legal = [list(v) for v in res.base_legal]
+
+        status.stage = "gravando"
+        _write_status(status)
+        write_columnar(res.tables(), job_dir(job_id) / "results", fmt="parquet")
+        status.stage = "indexando"
+        _write_status(status)
+        build_results_db(job_dir(job_id) / "results" / DB_NAME, res.itens, res.cabecalho, res.achados_v2, res.achados_v3)
+        # results/ passa a ser a cópia definitiva; o manifesto fica como registro dos blocos
+        manifest["montado_em"] = _now()
+        _write_manifest(job_id, manifest)
+        shutil.rmtree(job_dir(job_id) / "chunks", ignore_errors=True)
+
+        status.state = "done"
+        status.stage = ""
+        status.done = status.total
+        status.message = f"{status.done} arquivo(s), {status.items} item(ns), {status.errors} erro(s) de leitura."
+    except Exception as e:
+        status.state = "failed"
+        status.message = f"{type(e).__name__}: {e}"
+    status.finished_at = _now()
+    _write_status(status)
+    return status.state
+
+
+def _revalidate_job(job_id: str) -> str:
+    """Refresh a finished job's findings against the current Base Legal.
+
+    Only the items affected by the diff between the recorded version and the
+    current one are recomputed (utils.revalidation). Jobs validated by
+    vigência, or whose recorded version is no longer on disk, are recomputed
+    in full from the stored items (no re-upload either way).
+    """
+    from .base_legal import get_base_legal
+    from .base_legal_history import compiled_for_version
+    from .columnar_export import write_columnar
+    from .product_catalog import get_catalog
+    from .results_db import DB_NAME, build_results_db
+    from .revalidation import revalidate
+    from .rule_profiles import get_profile
+    from .validator import is_compact_v2, validar_itens, validar_itens_por_vigencia
+    from v3_corrector.correction_engine import apply_corrections, apply_corrections_por_vigencia
+    from v3_corrector.finding import is_compact_v3
+
+    status = job_status(job_id)
+    if status is None:
+        return "missing"
+    status.state = "running"
+    status.stage = "revalidacao"
+    status.started_at = _now()
+    _write_status(status)
+    try:
+        res = load_job_result(job_id)
+        df_itens = res["itens"]
+        opts = status.options or {}
+        new = get_base_legal()
+        profile = get_profile(opts.get("perfil_regras"))
+        corr_kw = dict(auto_apply=bool(opts.get("aplicar_correcao_v3")), ncm_engine=opts.get("ncm_engine"),
+                       catalog=get_catalog().snapshot(), profile=profile)
+        old = compiled_for_version(status.base_legal) if status.base_legal else None
+        has_refs = is_compact_v2(res["achados_v2"]) and is_compact_v3(res["achados_v3"])
+        if old is not None and has_refs and not opts.get("por_vigencia"):
+            r = revalidate(df_itens, res["achados_v2"], res["achados_v3"], res["itens_corrigido"], old, new, **corr_kw)
+            out = {"achados_v2": r.achados_v2, "achados_v3": r.achados_v3, "itens_corrigido": r.itens_corrigido}
+            status.message = f"Revalidado com a Base Legal atual: {r.afetados} de {len(df_itens)} item(ns) afetado(s)."
+        else:
+            if opts.get("por_vigencia"):
+                v2 = validar_itens_por_vigencia(df_itens, profile=profile, compact=True)
+                corr, v3 = apply_corrections_por_vigencia(df_itens, compact=True, **corr_kw)
+            else:
+                v2 = validar_itens(df_itens, new, profile=profile, compact=True)
+                corr, v3 = apply_corrections(df_itens, new, compact=True, **corr_kw)
+            out = {"achados_v2": v2, "achados_v3": v3, "itens_corrigido": corr}
+            status.message = f"Revalidado por completo: {len(df_itens)} item(ns)."
+        write_columnar(out, job_dir(job_id) / "results", fmt="parquet")
+        build_results_db(job_dir(job_id) / "results" / DB_NAME, df_itens, res["cabecalho"],
+                         out["achados_v2"], out["achados_v3"])
+        status.base_legal = [list(v) for v in new.version]
+    except Exception as e:
+        # os resultados anteriores continuam válidos (e o lote continua desatualizado)
+        status.message = f"Falha na revalidação ({type(e).__name__}: {e}); achados anteriores mantidos."
+    status.state = "done"
+    status.stage = ""
+    status.finished_at = _now()
+    _write_status(status)
+    return status.state
+
+
+def is_stale(status: JobStatus) -> bool:
+    """Done job whose findings were computed with another Base Legal version."""
+    from .base_legal import get_base_legal
+
+    if status.state != "done" or not (status.options or {}).get("executar_validacao", True):
+        return False
+    return tuple(tuple(v) for v in status.base_legal) != get_base_legal().version
+
+
+# ---------------------------------------------------------------------------
+# Fila (processo do Streamlit)
+# ---------------------------------------------------------------------------
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+_recovered = False
+# job_id -> arquivo jobs/<id>/.owner com flock: o lote é deste processo enquanto está na fila
+# ou rodando; o lock some sozinho se o processo morrer
+_claims: Dict[str, Any] = {}
+_claims_lock = threading.Lock()
+
+
+def mp_context():
+    """Start method for worker pools created inside a threaded server.
+
+    forkserver where the platform has it (a plain fork would inherit locks
+    held by the other threads), spawn otherwise (Windows).
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def max_workers() -> int:
+    try:
+        return max(1, int(os.environ.get("NFE_JOB_WORKERS", "")))
+    except ValueError:
+        return max(1, min(4, (os.cpu_count() or 2) - 1))
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=max_workers(), mp_context=mp_context())
+            if not _recovered:
+                _recover_locked()
+        return _executor
+
+
+def _claim(job_id: str) -> bool:
+    """Take ownership of a job for this process; False when another live process (or this one) has it."""
+    with _claims_lock:
+        if job_id in _claims:
+            return False
+        fh = None
+        if fcntl is not None:
+            fh = open(job_dir(job_id) / ".owner", "a")
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                fh.close()
+                return False
+        _claims[job_id] = fh
+        return True
+
+
+def _release(job_id: str) -> None:
+    with _claims_lock:
+        fh = _claims.pop(job_id, None)
+    if fh is not None:
+        fh.close()  # fechar libera o flock
+
+
+def _on_done(job_id: str):
+    def cb(fut):
+        _release(job_id)
+        exc = fut.exception()
+        if exc is None:
+            return
+        # worker morreu (OOM, kill): registra a falha para a UI
+        st = job_status(job_id)
+        if st is not None and st.state in ACTIVE_STATES:
+            st.state = "failed"
+            st.message = f"Worker interrompido: {type(exc).__name__}: {exc}"
+            st.finished_at = _now()
+            _write_status(st)
+        if isinstance(exc, BrokenProcessPool):
+            global _executor
+            with _executor_lock:
+                _executor = None
+    return cb
+
+
+def _enqueue(job_id: str, fn=_run_job) -> None:
+    """Submit a job this process already claimed."""
+    try:
+        fut = _get_executor().submit(fn, job_id)
+    except BaseException:
+        _release(job_id)
+        raise
+    fut.add_done_callback(_on_done(job_id))
+
+
+def _recover_locked() -> None:
+    """Requeue jobs left queued/running by a dead server process (once per process).
+
+    A job still claimed by a live process sharing DATA_DIR is left alone.
+    """
+    global _recovered
+    _recovered = True
+    for st in list_jobs():
+        if st.state in ACTIVE_STATES and _claim(st.job_id):
+            jid = st.job_id
+            st = job_status(jid)  # relido com o lote já nosso
+            if st is None or st.state not in ACTIVE_STATES:
+                _release(jid)
+                continue
+            # revalidação volta como revalidação (os blocos de leitura já podem ter sido apagados)
+            fn = _revalidate_job if st.stage == "revalidacao" else _run_job
+            st.state = "queued"
+            st.done = 0
+            _write_status(st)
+            fut = _executor.submit(fn, st.job_id)
+            fut.add_done_callback(_on_done(st.job_id))
+
+
+def submit_job(xml_files: Iterable[Tuple[str, bytes]], owner: str, options: Optional[Dict[str, Any]] = None) -> str:
+    """Persist the batch and queue it. Returns the job id."""
+    _get_executor()  # recupera jobs pendentes antes de registrar o novo
+    job_id = f"{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}"
+    d = job_dir(job_id)
+    d.mkdir(parents=True, exist_ok=True)
+    total = 0
+    with zipfile.ZipFile(d / "input.zip", "w", compression=zipfile.ZIP_STORED) as zf:
+        for name, payload in xml_files:
+            zf.writestr(name, payload)
+            total += 1
+    _claim(job_id)
+    _write_status(JobStatus(job_id=job_id, owner=owner, created_at=_now(), total=total, options=dict(options or {})))
+    _enqueue(job_id)
+    return job_id
+
+
+def submit_revalidation(job_id: str) -> None:
+    """Queue the incremental revalidation of a finished job (Base Legal atual)."""
+    if not _claim(job_id):
+        return  # já na fila ou rodando (aqui ou em outro processo)
+    status = job_status(job_id)
+    if status is None or status.state != "done":
+        _release(job_id)
+        return
+    status.state = "queued"
+    status.stage = "revalidacao"
+    _write_status(status)
+    _enqueue(job_id, _revalidate_job)
+
+
+def submit_resume(job_id: str) -> None:
+    """Requeue a failed job: blocks already on disk are kept, only the failed or pending ones are read again."""
+    if not _claim(job_id):
+        return
+    status = job_status(job_id)
+    if status is None or status.state != "failed":
+        _release(job_id)
+        return
+    status.state = "queued"
+    status.stage = "retomada"
+    status.message = ""
+    _write_status(status)
+    _enqueue(job_id)
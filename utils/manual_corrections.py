@@ -0,0 +1,164 @@
+"""Manual NCM corrections (V3 edit panel): indexed lookup, bulk apply, incremental findings.
+
+A batch keeps one ManualState (per session, per validation run):
+
+    itens      itens originais com os NCMs manuais já aplicados (fonte do recálculo)
+    corrigido  itens corrigidos (V3 + manuais), base do XML corrigido
+    achados    V2/V3 compactos (`item` = posição no lote + regra do catálogo)
+
+Edits are located through an (arquivo, nItem) -> posição index and written
+in one shot; V2/V3 are then recomputed only for the edited items and the
+items sharing their description (the batch heuristics group by it).
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import span
+from .revalidation import norm_descriptions, recompute_items
+
+_SEP = "\x1f"
+
+
+def ncm8(s: pd.Series) -> pd.Series:
+    """re.sub(r'\\D+', '', x).zfill(8)[:8], vectorized."""
+    return s.fillna("").astype(str).str.replace(r"\D+", "", regex=True).str.zfill(8).str[:8]
+
+
+def desc_key(s: pd.Series) -> pd.Series:
+    """Loose description key used to spot NCM divergence in the batch."""
+    return (
+        s.fillna("").astype(str).str.lower()
+        .str.replace(r"[^a-z0-9]+", " ", regex=True)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+
+
+def _keys(df: pd.DataFrame) -> pd.Series:
+    nitem = df["nItem"].astype(str) if "nItem" in df.columns else pd.Series("", index=df.index)
+    if "arquivo" in df.columns:
+        return df["arquivo"].astype(str) + _SEP + nitem
+    return nitem
+
+
+def _first_pos(keys: pd.Series) -> pd.Series:
+    pos = pd.Series(np.arange(len(keys)), index=keys.to_numpy())
+    # o primeiro item com a chave prevalece (como a busca antiga)
+    return pos[~pos.index.duplicated(keep="first")]
+
+
+@dataclass(frozen=True)
+class ItemIndex:
+    """(arquivo, nItem) -> first row position (nItem alone when there is no arquivo)."""
+    pos: pd.Series
+    nitem: pd.Series       # nItem -> first row position (edições sem arquivo)
+    by_arquivo: bool
+
+    @classmethod
+    def build(cls, df: pd.DataFrame) -> "ItemIndex":
+        nitem = df["nItem"].astype(str) if "nItem" in df.columns else pd.Series("", index=df.index)
+        return cls(_first_pos(_keys(df)), _first_pos(nitem), "arquivo" in df.columns)
+
+    def locate(self, edits: pd.DataFrame) -> np.ndarray:
+        """Row positions for the edit rows (-1 when not found)."""
+        if self.by_arquivo and "arquivo" in edits.columns:
+            idx, keys = self.pos, _keys(edits)
+        else:
+            idx, keys = self.nitem, edits["nItem"].astype(str)
+        return idx.reindex(keys.to_numpy()).fillna(-1).astype(int).to_numpy()
+
+
+@dataclass
+class ManualState:
+    itens: pd.DataFrame
+    corrigido: pd.DataFrame
+    achados_v2: pd.DataFrame
+    achados_v3: pd.DataFrame
+    index: Optional[ItemIndex] = None
+    desc_norm: Optional[pd.Series] = None      # norm_text(xProd) (heurísticas do lote)
+    desc_key: Optional[pd.Series] = None       # chave solta (divergência no painel)
+    ncm8: Optional[pd.Series] = None           # NCM8 dos itens corrigidos
+    manuais: Dict[int, str] = field(default_factory=dict)
+
+    def __post_init__(self):
+        with span("manual_index", items=len(self.itens)):
+            self.index = ItemIndex.build(self.itens)
+            self.desc_norm = norm_descriptions(self.itens)
+            self.desc_key = desc_key(self.itens.get("xProd", pd.Series("", index=self.itens.index)))
+            self.ncm8 = ncm8(self.corrigido.get("NCM", pd.Series("", index=self.corrigido.index)))
+
+    def candidates(self, allowed_ncms: FrozenSet[str]) -> np.ndarray:
+        """Positions offered for manual NCM: zerado, fora da Tabela NCM, or diverging by description."""
+        n8 = self.ncm8
+        try:
+            nun = pd.Series(n8.to_numpy()).groupby(self.desc_key.to_numpy()).nunique(dropna=False)
+            div = self.desc_key.isin(nun.index[nun > 1])
+        except Exception:
+            div = pd.Series(False, index=n8.index)
+        mask = (n8 == "00000000") | div
+        if allowed_ncms:
+            mask = mask | ~n8.isin(allowed_ncms)
+        return np.flatnonzero(mask.to_numpy())
+
+
+@dataclass
+class ManualResult:
+    aplicados: int = 0
+    rejeitados: int = 0
+    posicoes: np.ndarray = field(default_factory=lambda: np.array([], dtype=int))
+
+
+def apply_manual_ncm(
+    state: ManualState,
+    edited: pd.DataFrame,
+    allowed_ncms: FrozenSet[str],
+    groups: Callable[[pd.DataFrame, np.ndarray], List[Tuple[object, np.ndarray]]],
+    **kw,
+) -> ManualResult:
+    """Apply the edit rows (correcao_sugerida) in bulk and refresh the affected findings.
+
+    groups(itens, posições) -> [(Base Legal, posições)] picks the Base Legal
+    for the recomputation (current one, or per vigência). kw goes to
+    recompute_items (auto_apply, ncm_engine, catalog, profile).
+    """
+    if edited is None or edited.empty or "correcao_sugerida" not in edited.columns:
+        return ManualResult()
+    sug = ncm8(edited["correcao_sugerida"])
+    raw = edited["correcao_sugerida"].fillna("").astype(str).str.replace(r"\D+", "", regex=True)
+    ok = (raw != "") & (sug != "00000000") & ~sug.str.startswith("00")
+    rejected = ok & ~sug.isin(allowed_ncms) if allowed_ncms else pd.Series(False, index=sug.index)
+    ok &= ~rejected
+    if not ok.any():
+        return ManualResult(0, int(rejected.sum()))
+    pos = state.index.locate(edited[ok])
+    found = pos >= 0
+    pos, vals = pos[found], sug[ok].to_numpy()[found]
+    # a última edição do mesmo item prevalece
+    last = pd.Series(vals).groupby(pos).last()
+    pos, vals = last.index.to_numpy(), last.to_numpy()
+    if not len(pos):
+        return ManualResult(0, int(rejected.sum()))
+
+    with span("manual_apply", items=len(pos)):
+        if not state.manuais:
+            state.itens = state.itens.copy()  # não altera os itens lidos do XML
+        itens = state.itens
+        itens.iloc[pos, itens.columns.get_loc("NCM")] = vals
+        state.manuais.update(zip(pos.tolist(), vals.tolist()))
+        # itens editados + mesma descrição (recorrência/divergência no lote)
+        affected = np.flatnonzero(state.desc_norm.isin(set(state.desc_norm.iloc[pos])).to_numpy())
+        affected = np.union1d(affected, pos)
+        state.achados_v2, state.achados_v3, corr = recompute_items(
+            itens, groups(itens, affected), state.achados_v2, state.achados_v3, state.corrigido,
+            desc_norm=state.desc_norm, **kw,
+        )
+        # o NCM manual vale sobre a correção automática
+        corr.iloc[pos, corr.columns.get_loc("NCM")] = vals
+        state.corrigido = corr
+        state.ncm8.iloc[affected] = ncm8(corr["NCM"].iloc[affected]).to_numpy()
+    return ManualResult(len(pos), int(rejected.sum()), pos)
@@ -1,116 +1,217 @@
 from __future__ import annotations
 import xml.etree.ElementTree as ET
-from typing import Dict, Any, List, Optional
-import re
-
-def _strip_ns(tag: str) -> str:
-    return tag.split("}", 1)[-1] if "}" in tag else tag
-
-def _find_text(root: ET.Element, path: str) -> str:
-    """Find text by walking tag names ignoring namespaces. path like 'ide/nNF'."""
-    parts = path.split("/")
-    cur = root
-    for part in parts:
-        found = None
-        for child in cur:
-            if _strip_ns(child.tag) == part:
-                found = child
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Sequence, Tuple, Union
+
+from .xml_backend import get_backend, local_name
+
+# ---------------------------------------------------------------------------
+# Declarative field schema
+#
+# Each entry is (coluna, caminho). Paths are relative to the element being
+# extracted (infNFe for the header, det for items) and use local tag names
+# (namespaces are ignored):
+#   - "prod/NCM"          -> text of the first prod/NCM
+#   - "@nItem"            -> attribute of the current element
+#   - "imposto/ICMS/*/CST" -> "*" matches any child (ICMS00, ICMSSN102, ...)
+# Repeating a column gives fallback paths, tried in order: the first non-empty
+# value wins (e.g. dhEmi -> dEmi). Extend by concatenating lists, e.g.
+#   parse_nfe_xml(xml, item_schema=ITEM_SCHEMA + [("xPed", "prod/xPed")])
+# ---------------------------------------------------------------------------
+FieldSpec = Tuple[str, str]
+
+HEADER_SCHEMA: List[FieldSpec] = [
+    ("nNF", "ide/nNF"),
+    ("serie", "ide/serie"),
+    ("dhEmi", "ide/dhEmi"),
+    ("dhEmi", "ide/dEmi"),
+    ("emit_xNome", "emit/xNome"),
+    ("emit_CNPJ", "emit/CNPJ"),
+    ("emit_CNPJ", "emit/CPF"),
+    ("dest_xNome", "dest/xNome"),
+    ("dest_CNPJ", "dest/CNPJ"),
+    ("dest_CNPJ", "dest/CPF"),
+    ("vNF", "total/ICMSTot/vNF"),
+    # Componentes do total (prefixo tot_ para não colidir com colunas de item)
+    ("tot_vBC", "total/ICMSTot/vBC"),
+    ("tot_vICMS", "total/ICMSTot/vICMS"),
+    ("tot_vST", "total/ICMSTot/vST"),
+    ("tot_vProd", "total/ICMSTot/vProd"),
+    ("tot_vFrete", "total/ICMSTot/vFrete"),
+    ("tot_vDesc", "total/ICMSTot/vDesc"),
+    ("tot_vIPI", "total/ICMSTot/vIPI"),
+    ("tot_vPIS", "total/ICMSTot/vPIS"),
+    ("tot_vCOFINS", "total/ICMSTot/vCOFINS"),
+]
+
+ITEM_SCHEMA: List[FieldSpec] = [
+    ("nItem", "@nItem"),
+    ("cProd", "prod/cProd"),
+    ("xProd", "prod/xProd"),
+    ("NCM", "prod/NCM"),
+    ("CFOP", "prod/CFOP"),
+    ("uCom", "prod/uCom"),
+    ("qCom", "prod/qCom"),
+    ("vUnCom", "prod/vUnCom"),
+    ("vProd", "prod/vProd"),
+    # ICMS node can be ICMS00/ICMS10/ICMSSN102 etc
+    ("CST_ICMS", "imposto/ICMS/*/CST"),
+    ("CSOSN", "imposto/ICMS/*/CSOSN"),
+    ("orig", "imposto/ICMS/*/orig"),
+    ("pICMS", "imposto/ICMS/*/pICMS"),
+    ("vICMS", "imposto/ICMS/*/vICMS"),
+    ("CEST", "prod/CEST"),
+    ("cBenef", "prod/cBenef"),
+    # IPI: IPITrib / IPINT
+    ("CST_IPI", "imposto/IPI/*/CST"),
+    ("vIPI", "imposto/IPI/*/vIPI"),
+    # PIS/COFINS: PISAliq / PISOutr / PISNT ... (idem COFINS)
+    ("CST_PIS", "imposto/PIS/*/CST"),
+    ("vPIS", "imposto/PIS/*/vPIS"),
+    ("CST_COFINS", "imposto/COFINS/*/CST"),
+    ("vCOFINS", "imposto/COFINS/*/vCOFINS"),
+]
+
+
+@dataclass
+class _Node:
+    children: Dict[str, "_Node"] = field(default_factory=dict)
+    any: Optional["_Node"] = None
+    slots: List[int] = field(default_factory=list)             # text of this element
+    attrs: Dict[str, List[int]] = field(default_factory=dict)  # attributes of this element
+
+
+@dataclass
+class CompiledSchema:
+    """Schema compiled into a dispatch tree keyed by local tag name."""
+    columns: List[str]               # output columns, in schema order
+    column_slots: List[List[int]]    # per column: slots in fallback order
+    root: _Node
+    n_slots: int
+
+
+def _compile(schema: Tuple[FieldSpec, ...]) -> CompiledSchema:
+    root = _Node()
+    columns: List[str] = []
+    column_slots: Dict[str, List[int]] = {}
+    for slot, (col, path) in enumerate(schema):
+        if col not in column_slots:
+            columns.append(col)
+            column_slots[col] = []
+        column_slots[col].append(slot)
+
+        node = root
+        parts = [p for p in path.split("/") if p]
+        attr = None
+        if parts and parts[-1].startswith("@"):
+            attr = parts.pop()[1:]
+        for part in parts:
+            if part == "*":
+                if node.any is None:
+                    node.any = _Node()
+                node = node.any
+            else:
+                node = node.children.setdefault(part, _Node())
+        if attr is not None:
+            node.attrs.setdefault(attr, []).append(slot)
+        else:
+            node.slots.append(slot)
+    return CompiledSchema(
+        columns=columns,
+        column_slots=[column_slots[c] for c in columns],
+        root=root,
+        n_slots=len(schema),
+    )
+
+
+@lru_cache(maxsize=32)
+def _compile_cached(schema: Tuple[FieldSpec, ...]) -> CompiledSchema:
+    return _compile(schema)
+
+
+def compile_schema(schema: Union[Sequence[FieldSpec], CompiledSchema]) -> CompiledSchema:
+    """Compile (and cache) a list of (coluna, caminho) specs."""
+    if isinstance(schema, CompiledSchema):
+        return schema
+    return _compile_cached(tuple((str(c), str(p)) for c, p in schema))
+
+
+def _walk(elem: ET.Element, node: _Node, vals: List[Optional[str]]) -> None:
+    for attr, slots in node.attrs.items():
+        v = elem.get(attr, "")
+        for s in slots:
+            if vals[s] is None:
+                vals[s] = v
+    if node.slots:
+        text = (elem.text or "").strip()
+        for s in node.slots:
+            if vals[s] is None:
+                vals[s] = text
+    if not node.children and node.any is None:
+        return
+    seen = set()
+    for child in elem:
+        tag = local_name(child.tag)
+        if not tag:
+            continue
+        sub = node.children.get(tag)
+        # same semantics as a path lookup: only the first child with a given name is followed
+        if sub is not None and tag not in seen:
+            seen.add(tag)
+            _walk(child, sub, vals)
+        if node.any is not None:
+            _walk(child, node.any, vals)
+
+
+def extract_fields(elem: ET.Element, schema: Union[Sequence[FieldSpec], CompiledSchema]) -> Dict[str, str]:
+    """Extract every schema column from `elem` in a single traversal."""
+    compiled = compile_schema(schema)
+    vals: List[Optional[str]] = [None] * compiled.n_slots
+    _walk(elem, compiled.root, vals)
+    out: Dict[str, str] = {}
+    for col, slots in zip(compiled.columns, compiled.column_slots):
+        v = ""
+        for s in slots:
+            if vals[s]:
+                v = vals[s]
                 break
-        if found is None:
-            return ""
-        cur = found
-    return (cur.text or "").strip()
+        out[col] = v
+    return out
+
+
+def parse_nfe_xml(
+    xml_bytes: bytes,
+    header_schema: Union[Sequence[FieldSpec], CompiledSchema, None] = None,
+    item_schema: Union[Sequence[FieldSpec], CompiledSchema, None] = None,
+    backend: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Parse a Brazilian NF-e XML (NFe/infNFe) and return header + item rows.
+
+    Fields come from HEADER_SCHEMA / ITEM_SCHEMA (or the schemas passed in).
+    `backend`: "lxml" / "etree" / "auto" (default: NFE_XML_BACKEND setting).
+    """
+    header_c = compile_schema(HEADER_SCHEMA if header_schema is None else header_schema)
+    item_c = compile_schema(ITEM_SCHEMA if item_schema is None else item_schema)
 
-def parse_nfe_xml(xml_bytes: bytes) -> Dict[str, Any]:
-    """Parse a Brazilian NF-e XML (NFe/infNFe) and return header + item rows."""
     # NF-e can include many namespaces. We'll ignore them by stripping.
-    root = ET.fromstring(xml_bytes)
+    xb = get_backend(backend)
+    root = xb.fromstring(xml_bytes)
 
     # Find infNFe
-    infNFe = None
-    for el in root.iter():
-        if _strip_ns(el.tag) == "infNFe":
-            infNFe = el
-            break
+    infNFe = xb.find_first(root, "infNFe")
     if infNFe is None:
         raise ValueError("XML não parece ser uma NF-e (infNFe não encontrado).")
 
-    ide = None
-    emit = None
-    dest = None
-    total = None
-    for child in infNFe:
-        name = _strip_ns(child.tag)
-        if name == "ide": ide = child
-        elif name == "emit": emit = child
-        elif name == "dest": dest = child
-        elif name == "total": total = child
-
-    header = {
-        "chave": infNFe.attrib.get("Id","").replace("NFe",""),
-        "nNF": _find_text(infNFe, "ide/nNF"),
-        "serie": _find_text(infNFe, "ide/serie"),
-        "dhEmi": _find_text(infNFe, "ide/dhEmi") or _find_text(infNFe, "ide/dEmi"),
-        "emit_xNome": _find_text(infNFe, "emit/xNome"),
-        "emit_CNPJ": _find_text(infNFe, "emit/CNPJ") or _find_text(infNFe, "emit/CPF"),
-        "dest_xNome": _find_text(infNFe, "dest/xNome"),
-        "dest_CNPJ": _find_text(infNFe, "dest/CNPJ") or _find_text(infNFe, "dest/CPF"),
-        "vNF": "",
-    }
-    # total/vNF
-    header["vNF"] = _find_text(infNFe, "total/ICMSTot/vNF")
+    header = {"chave": infNFe.attrib.get("Id","").replace("NFe","")}
+    header.update(extract_fields(infNFe, header_c))
 
     items: List[Dict[str, Any]] = []
     for det in infNFe:
-        if _strip_ns(det.tag) != "det":
+        if local_name(det.tag) != "det":
             continue
-        nItem = det.attrib.get("nItem","")
-        prod = None
-        imposto = None
-        for c in det:
-            n = _strip_ns(c.tag)
-            if n == "prod": prod = c
-            elif n == "imposto": imposto = c
-        if prod is None:
+        if not any(local_name(c.tag) == "prod" for c in det):
             continue
+        items.append(extract_fields(det, item_c))
 
-        row = {
-            "nItem": nItem,
-            "cProd": _find_text(det, "prod/cProd"),
-            "xProd": _find_text(det, "prod/xProd"),
-            "NCM": _find_text(det, "prod/NCM"),
-            "CFOP": _find_text(det, "prod/CFOP"),
-            "uCom": _find_text(det, "prod/uCom"),
-            "qCom": _find_text(det, "prod/qCom"),
-            "vUnCom": _find_text(det, "prod/vUnCom"),
-            "vProd": _find_text(det, "prod/vProd"),
-            "CST_ICMS": "",
-            "CSOSN": "",
-            "orig": "",
-            "pICMS": "",
-            "vICMS": "",
-        }
-
-        # ICMS node can be ICMS00/ICMS10/ICMSSN102 etc
-        icms = None
-        if imposto is not None:
-            for child in imposto:
-                if _strip_ns(child.tag) == "ICMS":
-                    icms = child
-                    break
-        if icms is not None:
-            # first child inside ICMS is the modality node
-            icms_mod = None
-            for child in icms:
-                icms_mod = child
-                break
-            if icms_mod is not None:
-                row["orig"] = _find_text(icms_mod, "orig")
-                row["CST_ICMS"] = _find_text(icms_mod, "CST")
-                row["CSOSN"] = _find_text(icms_mod, "CSOSN")
-                row["pICMS"] = _find_text(icms_mod, "pICMS")
-                row["vICMS"] = _find_text(icms_mod, "vICMS")
-
-        items.append(row)
-
-    return {"header": header, "items": items}
\ No newline at end of file
+    return {"header": header, "items": items}
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Tuple
+
+import pandas as pd
+
+from .instrumentation import span
+from .nfe_parser import parse_nfe_xml
+
+# Colunas convertidas para número após a leitura (best-effort)
+NUMERIC_COLS = ["qCom", "vUnCom", "vProd", "pICMS", "vICMS", "vIPI", "vPIS", "vCOFINS", "vNF"]
+
+# Coluna do item -> tag alterada em rewrite_nfe_xml
+REWRITE_COLS = [("NCM", "NCM"), ("CFOP", "CFOP"), ("CST_ICMS", "CST"), ("CSOSN", "CSOSN")]
+
+
+def to_numeric_cols(df: pd.DataFrame, cols: Iterable[str] = NUMERIC_COLS) -> pd.DataFrame:
+    """Convert value columns in place (vírgula decimal aceita)."""
+    for c in cols:
+        if c in df.columns:
+            df[c] = pd.to_numeric(
+                df[c].astype(str).str.replace(",", ".", regex=False),
+                errors="coerce",
+            )
+    return df
+
+
+def parse_files(xml_files: Iterable[Tuple[str, bytes]]) -> Tuple[List[Dict], List[Dict], List[Tuple[str, str]]]:
+    """Parse (nome, bytes) pairs. Returns (headers, item rows, errors).
+
+    Each item row carries the header fields (rastreabilidade) plus `arquivo`.
+    """
+    headers: List[Dict] = []
+    itens_all: List[Dict] = []
+    errors: List[Tuple[str, str]] = []
+    with span("parse") as sp:
+        for fname, payload in xml_files:
+            try:
+                parsed = parse_nfe_xml(payload)
+            except Exception as e:
+                errors.append((fname, str(e)))
+                continue
+            h = parsed["header"]
+            h["arquivo"] = fname
+            headers.append(h)
+            for it in parsed["items"]:
+                row = {}
+                row.update(h)  # include header fields for traceability
+                row.update(it)
+                itens_all.append(row)
+        sp.set(items=len(itens_all), docs=len(headers), errors=len(errors))
+    return headers, itens_all, errors
+
+
+def items_frame(xml_files: Iterable[Tuple[str, bytes]]) -> Tuple[List[Dict], pd.DataFrame, List[Tuple[str, str]]]:
+    """parse_files + DataFrame of items with numeric columns converted."""
+    headers, itens_all, errors = parse_files(xml_files)
+    with span("items_frame", items=len(itens_all)):
+        df_itens = to_numeric_cols(pd.DataFrame(itens_all))
+    return headers, df_itens, errors
+
+
+def changes_by_file(df_orig: pd.DataFrame, df_corr: pd.DataFrame) -> Dict[str, Dict[str, Dict[str, str]]]:
+    """Diff original vs corrected items -> {arquivo: {nItem: {'NCM': ..., 'CST': ...}}}.
+
+    Rows are matched by index (apply_corrections preserves it); only the
+    columns rewrite_nfe_xml knows about are compared.
+    """
+    out: Dict[str, Dict[str, Dict[str, str]]] = {}
+    if df_orig is None or df_corr is None or df_orig.empty or df_corr.empty:
+        return out
+    if "arquivo" not in df_orig.columns or "nItem" not in df_orig.columns:
+        return out
+    common = df_orig.index.intersection(df_corr.index)
+    o = df_orig.loc[common]
+    c = df_corr.loc[common]
+
+    diffs = {}
+    any_diff = pd.Series(False, index=common)
+    for col, key in REWRITE_COLS:
+        if col not in o.columns or col not in c.columns:
+            continue
+        v0 = o[col].fillna("").astype(str).str.strip()
+        v1 = c[col].fillna("").astype(str)
+        m = v0 != v1.str.strip()
+        if m.any():
+            diffs[key] = (m, v1)
+            any_diff |= m
+    if not any_diff.any():
+        return out
+
+    arquivos = o["arquivo"].astype(str)
+    nitens = o["nItem"].astype(str)
+    for idx in common[any_diff.to_numpy()]:
+        ch = {key: v1.at[idx] for key, (m, v1) in diffs.items() if m.at[idx]}
+        out.setdefault(arquivos.at[idx], {})[nitens.at[idx]] = ch
+    return out
@@ -0,0 +1,222 @@
+"""Persistent product catalog: NCMs confirmed across batches.
+
+Stored in DATA_DIR/catalogo_produtos.sqlite with two keys per product:
+    (emit_CNPJ, cProd)      código do produto no emitente
+    xProd normalizado       descrição (norm_text)
+each with per-NCM counts and last-seen date. It learns from items whose NCM
+exists in the Tabela NCM (once per NF-e chave) and from manual corrections
+accepted in the app; apply_corrections reads an in-memory snapshot (dicts).
+"""
+from __future__ import annotations
+
+import sqlite3
+import threading
+from contextlib import closing
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import AbstractSet, Dict, Iterable, Optional, Tuple, Union
+
+import pandas as pd
+
+from v3_corrector.text_utils import digits_only, norm_text
+
+from .base_legal import DATA_DIR
+from .instrumentation import instrumented
+
+CATALOG_PATH = DATA_DIR / "catalogo_produtos.sqlite"
+
+# Um NCM só vira sugestão se for maioria clara para a chave
+MIN_SHARE = 0.60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS por_codigo (
+    emit_CNPJ TEXT NOT NULL, cProd TEXT NOT NULL, ncm TEXT NOT NULL,
+    n INTEGER NOT NULL, last_seen TEXT NOT NULL,
+    PRIMARY KEY (emit_CNPJ, cProd, ncm)
+);
+CREATE TABLE IF NOT EXISTS por_descricao (
+    descricao TEXT NOT NULL, ncm TEXT NOT NULL,
+    n INTEGER NOT NULL, last_seen TEXT NOT NULL,
+    PRIMARY KEY (descricao, ncm)
+);
+CREATE TABLE IF NOT EXISTS documentos (chave TEXT PRIMARY KEY, learned_at TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (k, v) VALUES ('versao', 0);
+"""
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    """Read-only view used by apply_corrections: key -> (ncm8, vezes confirmado)."""
+    versao: int = 0
+    by_code: Dict[Tuple[str, str], Tuple[str, int]] = field(default_factory=dict)
+    by_desc: Dict[str, Tuple[str, int]] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return len(self.by_code) + len(self.by_desc)
+
+    def lookup(self, emit_cnpj: str, cprod: str, desc_norm: str) -> Optional[Tuple[str, int, str]]:
+        """(ncm8, n, 'codigo'|'descricao') — emitente + código first, then description."""
+        cnpj = digits_only(emit_cnpj)
+        cprod = str(cprod or "").strip()
+        if cnpj and cprod:
+            hit = self.by_code.get((cnpj, cprod))
+            if hit:
+                return hit[0], hit[1], "codigo"
+        if desc_norm:
+            hit = self.by_desc.get(desc_norm)
+            if hit:
+                return hit[0], hit[1], "descricao"
+        return None
+
+
+def _ncm8(x) -> str:
+    return digits_only(x).zfill(8)[:8]
+
+
+def _col(df: pd.DataFrame, c: str) -> pd.Series:
+    return df[c].astype(str) if c in df.columns else pd.Series("", index=df.index)
+
+
+def _dominant(rows: Iterable[Tuple]) -> Dict:
+    """rows (key..., ncm, n) -> {key: (ncm, n)} for keys whose top NCM has >= MIN_SHARE of the count."""
+    totals: Dict = {}
+    best: Dict = {}
+    for *key, ncm, n in rows:
+        k = key[0] if len(key) == 1 else tuple(key)
+        totals[k] = totals.get(k, 0) + n
+        if k not in best or n > best[k][1]:
+            best[k] = (ncm, n)
+    return {k: v for k, v in best.items() if v[1] / totals[k] >= MIN_SHARE}
+
+
+class ProductCatalog:
+    def __init__(self, path: Union[str, Path, None] = None):
+        self.path = Path(path) if path is not None else CATALOG_PATH
+        self._lock = threading.Lock()
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(str(self.path), timeout=30)
+        if not self._ready:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.executescript(_SCHEMA)
+            con.commit()
+            self._ready = True
+        return con
+
+    def _upsert(self, con: sqlite3.Connection, rows: Iterable[Tuple[str, str, str, str]]) -> int:
+        """rows: (emit_CNPJ, cProd, descricao normalizada, ncm8)."""
+        now = datetime.now().isoformat(timespec="seconds")
+        by_code: Dict[Tuple[str, str, str], int] = {}
+        by_desc: Dict[Tuple[str, str], int] = {}
+        for cnpj, cprod, desc, ncm in rows:
+            if cnpj and cprod:
+                by_code[(cnpj, cprod, ncm)] = by_code.get((cnpj, cprod, ncm), 0) + 1
+            if desc:
+                by_desc[(desc, ncm)] = by_desc.get((desc, ncm), 0) + 1
+        con.executemany(
+            "INSERT INTO por_codigo (emit_CNPJ, cProd, ncm, n, last_seen) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (emit_CNPJ, cProd, ncm) DO UPDATE SET n = n + excluded.n, last_seen = excluded.last_seen",
+            [(c, p, m, n, now) for (c, p, m), n in by_code.items()],
+        )
+        con.executemany(
+            "INSERT INTO por_descricao (descricao, ncm, n, last_seen) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (descricao, ncm) DO UPDATE SET n = n + excluded.n, last_seen = excluded.last_seen",
+            [(d, m, n, now) for (d, m), n in by_desc.items()],
+        )
+        if by_code or by_desc:
+            con.execute("UPDATE meta SET v = v + 1 WHERE k = 'versao'")
+        return max(len(by_code), len(by_desc))
+
+    @instrumented("catalog_learn", count=lambda self, df, *a, **k: None if df is None else len(df))
+    def learn(self, df_itens: pd.DataFrame, allowed_ncms: AbstractSet[str]) -> int:
+        """Record items whose NCM exists in the Tabela NCM; each NF-e chave counts once.
+
+        Items without a chave are skipped (their NF-e could not be marked as learned).
+        Without a usable Tabela NCM (allowed_ncms empty) nothing is learned.
+        Returns the number of NF-e newly learned.
+        """
+        if df_itens is None or df_itens.empty or not allowed_ncms or "NCM" not in df_itens.columns:
+            return 0
+        df = df_itens
+        ncm8 = df["NCM"].map(_ncm8)
+        chaves = _col(df, "chave").str.strip()
+        # sem chave não há como marcar a NF-e em documentos: seria recontada a cada chamada
+        valid = ncm8.isin(allowed_ncms) & (chaves != "")
+        if not valid.any():
+            return 0
+        with self._lock, closing(self._connect()) as con, con:
+            uniq = list(pd.unique(chaves[valid]))
+            known = set()
+            for i in range(0, len(uniq), 500):
+                part = uniq[i:i + 500]
+                known.update(r[0] for r in con.execute(
+                    f"SELECT chave FROM documentos WHERE chave IN ({','.join('?' * len(part))})", part))
+            new = valid & ~chaves.isin(known)
+            if not new.any():
+                return 0
+            sub = df.loc[new]
+            rows = zip(
+                _col(df, "emit_CNPJ")[new].map(digits_only),
+                _col(df, "cProd")[new].str.strip(),
+                sub["xProd"].map(norm_text) if "xProd" in sub.columns else [""] * len(sub),
+                ncm8[new],
+            )
+            self._upsert(con, rows)
+            now = datetime.now().isoformat(timespec="seconds")
+            learned = list(pd.unique(chaves[new]))
+            con.executemany("INSERT OR IGNORE INTO documentos (chave, learned_at) VALUES (?, ?)", [(c, now) for c in learned])
+            return len(learned)
+
+    def confirm(self, rows: Iterable[Tuple[str, str, str, str]]) -> int:
+        """Record manual corrections: (emit_CNPJ, cProd, xProd, ncm) already accepted by the user."""
+        clean = [
+            (digits_only(cnpj), str(cprod or "").strip(), norm_text(xprod), _ncm8(ncm))
+            for cnpj, cprod, xprod, ncm in rows
+        ]
+        clean = [r for r in clean if r[3] != "00000000"]
+        if not clean:
+            return 0
+        with self._lock, closing(self._connect()) as con, con:
+            return self._upsert(con, clean)
+
+    def snapshot(self) -> CatalogSnapshot:
+        """Current catalog as dicts; rebuilt only after a write (any process)."""
+        if not self.path.exists():
+            return CatalogSnapshot()
+        with self._lock, closing(self._connect()) as con:
+            versao = con.execute("SELECT v FROM meta WHERE k = 'versao'").fetchone()[0]
+            if self._snapshot is not None and self._snapshot.versao == versao:
+                return self._snapshot
+            by_code = _dominant(con.execute("SELECT emit_CNPJ, cProd, ncm, n FROM por_codigo"))
+            by_desc = _dominant(con.execute("SELECT descricao, ncm, n FROM por_descricao"))
+            self._snapshot = CatalogSnapshot(versao=versao, by_code=by_code, by_desc=by_desc)
+            return self._snapshot
+
+    def stats(self) -> Dict[str, int]:
+        if not self.path.exists():
+            return {"produtos": 0, "descricoes": 0, "documentos": 0}
+        queries = {
+            "produtos": "SELECT COUNT(*) FROM (SELECT DISTINCT emit_CNPJ, cProd FROM por_codigo)",
+            "descricoes": "SELECT COUNT(DISTINCT descricao) FROM por_descricao",
+            "documentos": "SELECT COUNT(*) FROM documentos",
+        }
+        with self._lock, closing(self._connect()) as con:
+            return {k: con.execute(sql).fetchone()[0] for k, sql in queries.items()}
+
+
+_catalog: Optional[ProductCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> ProductCatalog:
+    """Process-wide catalog (shared by sessions, like the compiled Base Legal)."""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = ProductCatalog()
+        return _catalog
@@ -0,0 +1,164 @@
+"""Paginated result grids for the Streamlit UI.
+
+The data stays on the server: a grid asks its source for the row count and
+one page (filters and sort applied there) and only that window is serialized
+to the browser. Sources:
+
+    SqlSource     a table of the results SQLite (utils.results_db), indexed
+    FrameSource   an in-memory frame (consolidado), sliced with pandas
+
+Grid state (page, size, sort, filters) lives in st.session_state under the
+grid key; changing a filter or the sort goes back to the first page.
+"""
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import pandas as pd
+import streamlit as st
+
+from .results_db import Filters, ResultsDB
+
+PAGE_SIZES = [50, 100, 250, 500]
+MAX_CHOICES = 500          # acima disso o filtro vira campo de texto
+
+
+class SqlSource:
+    def __init__(self, db: ResultsDB, table: str):
+        self.db, self.table = db, table
+
+    def columns(self) -> List[str]:
+        return self.db.columns(self.table)
+
+    def count(self, filters: Filters) -> int:
+        return self.db.count(self.table, filters)
+
+    def page(self, filters: Filters, columns: Sequence[str], order_by: Optional[str], descending: bool,
+             limit: int, offset: int) -> pd.DataFrame:
+        return self.db.select(self.table, filters, columns, order_by, descending, limit, offset)
+
+    def choices(self, column: str) -> List[str]:
+        return self.db.distinct(self.table, column, limit=MAX_CHOICES + 1)
+
+
+class FrameSource:
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._key = None
+        self._filtered = df
+
+    def columns(self) -> List[str]:
+        return list(self.df.columns)
+
+    def _apply(self, filters: Filters) -> pd.DataFrame:
+        if self._key != filters:
+            self._filtered = self.df[filters.mask(self.df)]
+            self._key = filters
+        return self._filtered
+
+    def count(self, filters: Filters) -> int:
+        return len(self._apply(filters))
+
+    def page(self, filters: Filters, columns: Sequence[str], order_by: Optional[str], descending: bool,
+             limit: int, offset: int) -> pd.DataFrame:
+        df = self._apply(filters)
+        if order_by in df.columns:
+            df = df.sort_values(order_by, ascending=not descending, kind="stable")
+        return df.iloc[offset:offset + limit][[c for c in columns if c in df.columns]]
+
+    def choices(self, column: str) -> List[str]:
+        if column not in self.df.columns:
+            return []
+        vals = self.df[column].dropna().astype(str).unique()
+        return sorted(vals[:MAX_CHOICES + 1])
+
+
+@dataclass
+class GridPage:
+    """What the grid showed: filters in effect, total rows and the visible window."""
+    filters: Filters
+    total: int
+    offset: int
+    rows: pd.DataFrame
+
+
+def _filter_widgets(source, key: str, filters: Sequence[str]) -> Filters:
+    """One widget per filter (multiselect for few values, text otherwise), laid out in a row."""
+    flt = Filters()
+    if not filters:
+        return flt
+    cols = st.columns(len(filters))
+    for box, name in zip(cols, filters):
+        with box:
+            if name in ("severidade", "campo", "regra"):
+                choices = source.choices(name)
+                if len(choices) <= MAX_CHOICES:
+                    setattr(flt, name, st.multiselect(name, choices, key=f"{key}_f_{name}"))
+                    continue
+                value = st.text_input(name, key=f"{key}_f_{name}")
+                setattr(flt, name, [value] if value else [])
+            elif name == "arquivo":
+                choices = source.choices("arquivo")
+                if len(choices) <= MAX_CHOICES:
+                    flt.arquivo = st.selectbox("arquivo", [""] + choices, key=f"{key}_f_arquivo")
+                else:
+                    flt.arquivo = st.text_input("arquivo", key=f"{key}_f_arquivo")
+            elif name == "NCM":
+                flt.ncm = st.text_input("NCM (prefixo)", key=f"{key}_f_ncm")
+            elif name == "emit_CNPJ":
+                flt.emitente = st.text_input("Emitente (CNPJ)", key=f"{key}_f_emit")
+            elif name == "CFOP":
+                flt.cfop = st.text_input("CFOP", key=f"{key}_f_cfop")
+            elif name == "texto":
+                flt.texto = st.text_input("Texto", key=f"{key}_f_texto")
+    return flt
+
+
+def pager(key: str, total: int, page_size: int = 100, sig: object = None) -> Tuple[int, int]:
+    """Page size and page number widgets; (offset, size) of the visible window. A new sig resets to page 1."""
+    c1, c2 = st.columns([1, 1])
+    with c1:
+        size = st.selectbox("Linhas por página", PAGE_SIZES,
+                            index=PAGE_SIZES.index(page_size) if page_size in PAGE_SIZES else 1, key=f"{key}_size")
+    pages = max(1, math.ceil(total / size))
+    # filtro, ordem ou tamanho novos: volta para a primeira página
+    if st.session_state.get(f"{key}_sig") != (sig, size):
+        st.session_state[f"{key}_sig"] = (sig, size)
+        st.session_state[f"{key}_pag"] = 1
+    st.session_state[f"{key}_pag"] = min(st.session_state.get(f"{key}_pag", 1), pages)
+    with c2:
+        page = st.number_input(f"Página (de {pages})", min_value=1, max_value=pages, step=1, key=f"{key}_pag")
+    return (int(page) - 1) * size, size
+
+
+def window_caption(offset: int, shown: int, total: int) -> None:
+    st.caption(f"Linhas {offset + 1 if total else 0}–{offset + shown} de {total}")
+
+
+def result_grid(
+    source,
+    key: str,
+    columns: Optional[Sequence[str]] = None,
+    filters: Sequence[str] = ("severidade", "campo", "arquivo", "NCM"),
+    height: int = 360,
+    page_size: int = 100,
+) -> GridPage:
+    """Render filters, sort, pager and the current page of `source`; returns what was shown."""
+    all_cols = source.columns()
+    show = [c for c in (columns or all_cols) if c in all_cols]
+    flt = _filter_widgets(source, key, [f for f in filters if f == "texto" or f in all_cols])
+
+    c1, c2 = st.columns([3, 1])
+    with c1:
+        order_by = st.selectbox("Ordenar por", ["(ordem do lote)"] + show, key=f"{key}_ord")
+    with c2:
+        descending = st.checkbox("Decrescente", key=f"{key}_desc")
+    total = source.count(flt)
+    offset, size = pager(key, total, page_size, sig=(repr(flt), order_by, descending))
+
+    rows = source.page(flt, show, None if order_by == "(ordem do lote)" else order_by, descending, size, offset)
+    st.dataframe(rows, use_container_width=True, hide_index=True, height=height)
+    window_caption(offset, len(rows), total)
+    return GridPage(flt, total, offset, rows)
@@ -0,0 +1,465 @@
+"""Embedded SQL layer over processed results (SQLite, stdlib).
+
+One file per batch with the readable tables:
+    itens        uma linha por item; `item` = posição no lote (a mesma dos achados compactos)
+    cabecalho    uma linha por NF-e
+    achados_v2   achados V2 expandidos
+    achados_v3   sugestões V3 expandidas
+    achados      visão V2 + V3 (origem, regra, severidade, campo e dimensões do item)
+
+Findings carry the item dimensions (chave, emit_CNPJ, NCM, CFOP, dhEmi, arquivo)
+so filters and GROUP BY need no join; those columns and `regra` are indexed.
+The UI and the CLI only pull the filtered page or the aggregate out of the file:
+
+    python -m utils.results_db FONTE --emitente 12345678000199 --ncm 84 --agrupar regra
+
+FONTE is a .sqlite file, a background job id, or a results folder with the
+Parquet tables (jobs `results/`, watcher `SAIDA/<lote>/`); the .sqlite is built
+next to the tables on first use and rebuilt when they change.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+import uuid
+from contextlib import closing
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import pandas as pd
+
+from .base_legal import DATA_DIR
+from .instrumentation import span
+
+DB_NAME = "consulta.sqlite"
+# dados fiscais: pasta só do usuário do app (0o700), arquivos 0o600
+SESSION_DIR = DATA_DIR / "consultas"
+SESSION_MAX_AGE_S = 24 * 3600
+
+ITEM_DIMS = ["chave", "emit_CNPJ", "NCM", "CFOP", "dhEmi", "arquivo", "nItem", "cProd", "xProd"]
+INDEXED = ["chave", "emit_CNPJ", "NCM", "CFOP", "dhEmi"]
+FINDING_INDEXED = INDEXED + ["regra", "severidade", "arquivo"]
+TABLES = ["itens", "cabecalho", "achados_v2", "achados_v3", "achados"]
+
+# Agrupamentos oferecidos (nome -> expressão SQL sobre colunas da tabela)
+GROUPINGS = {
+    "regra": "regra",
+    "severidade": "severidade",
+    "campo": "campo",
+    "origem": "origem",
+    "emit_CNPJ": "emit_CNPJ",
+    "NCM": "NCM",
+    "capitulo": "substr(NCM, 1, 2)",
+    "CFOP": "CFOP",
+    "mes": "substr(dhEmi, 1, 7)",
+    "arquivo": "arquivo",
+}
+_GROUP_NEEDS = {"capitulo": "NCM", "mes": "dhEmi"}   # coluna de que o agrupamento deriva
+
+
+def _q(col: str) -> str:
+    return '"' + col.replace('"', '""') + '"'
+
+
+def _prefix_range(prefix: str) -> Tuple[str, str]:
+    """[lo, hi) covering every text starting with prefix (index-friendly LIKE 'prefix%')."""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+@dataclass
+class Filters:
+    """Server-side filters; empty fields do not filter. de/ate are dates (AAAA-MM-DD, inclusive)."""
+    emitente: str = ""
+    de: str = ""
+    ate: str = ""
+    ncm: str = ""                     # prefixo: capítulo (2), posição (4) ou código completo
+    cfop: str = ""
+    chave: str = ""
+    arquivo: str = ""
+    regra: List[str] = field(default_factory=list)
+    severidade: List[str] = field(default_factory=list)
+    campo: List[str] = field(default_factory=list)
+    texto: str = ""                   # busca em xProd (e mensagem/problema nos achados)
+
+    def where(self, columns: Sequence[str]) -> Tuple[str, List[Any]]:
+        """WHERE clause (or "") and its parameters, for the filters the table has columns for."""
+        cols = set(columns)
+        sql: List[str] = []
+        params: List[Any] = []
+
+        def eq(col: str, value: str) -> None:
+            if value and col in cols:
+                sql.append(f'"{col}" = ?')
+                params.append(value.strip())
+
+        def one_of(col: str, values: Sequence[str]) -> None:
+            if values and col in cols:
+                sql.append(f'"{col}" IN ({", ".join("?" * len(values))})')
+                params.extend(values)
+
+        eq("emit_CNPJ", "".join(ch for ch in self.emitente if ch.isdigit()) or self.emitente)
+        eq("CFOP", self.cfop)
+        eq("chave", self.chave)
+        eq("arquivo", self.arquivo)
+        ncm = "".join(ch for ch in self.ncm if ch.isdigit())
+        if ncm and "NCM" in cols:
+            lo, hi = _prefix_range(ncm)
+            sql.append('"NCM" >= ? AND "NCM" < ?')
+            params.extend([lo, hi])
+        if "dhEmi" in cols:
+            if self.de:
+                sql.append('"dhEmi" >= ?')
+                params.append(self.de)
+            if self.ate:
+                # dhEmi traz hora e fuso: "~" fecha o dia (ou mês) informado por inteiro
+                sql.append('"dhEmi" < ?')
+                params.append(self.ate + "~")
+        one_of("regra", self.regra)
+        one_of("severidade", self.severidade)
+        one_of("campo", self.campo)
+        if self.texto:
+            text_cols = [c for c in ("xProd", "mensagem", "problema") if c in cols]
+            if text_cols:
+                sql.append("(" + " OR ".join(f'"{c}" LIKE ?' for c in text_cols) + ")")
+                params.extend([f"%{self.texto}%"] * len(text_cols))
+        return (" WHERE " + " AND ".join(sql)) if sql else "", params
+
+    def mask(self, df: pd.DataFrame) -> pd.Series:
+        """Same filters over an in-memory frame (tables that never go to SQLite, e.g. the consolidated view)."""
+        m = pd.Series(True, index=df.index)
+
+        def text(col: str) -> pd.Series:
+            return df[col].astype(str)
+
+        emit = "".join(ch for ch in self.emitente if ch.isdigit()) or self.emitente.strip()
+        for col, value in (("emit_CNPJ", emit), ("CFOP", self.cfop.strip()), ("chave", self.chave.strip()),
+                           ("arquivo", self.arquivo.strip())):
+            if value and col in df.columns:
+                m &= text(col) == value
+        ncm = "".join(ch for ch in self.ncm if ch.isdigit())
+        if ncm and "NCM" in df.columns:
+            m &= text("NCM").str.startswith(ncm)
+        if "dhEmi" in df.columns:
+            if self.de:
+                m &= text("dhEmi") >= self.de
+            if self.ate:
+                m &= text("dhEmi") < self.ate + "~"
+        for col, values in (("regra", self.regra), ("severidade", self.severidade), ("campo", self.campo)):
+            if values and col in df.columns:
+                m &= text(col).isin(values)
+        if self.texto:
+            text_cols = [c for c in ("xProd", "mensagem", "problema") if c in df.columns]
+            if text_cols:
+                hit = pd.Series(False, index=df.index)
+                for c in text_cols:
+                    hit |= text(c).str.contains(self.texto, case=False, regex=False)
+                m &= hit
+        return m
+
+
+# ---------------------------------------------------------------------------
+# Montagem
+# ---------------------------------------------------------------------------
+
+def _plain(df: pd.DataFrame) -> pd.DataFrame:
+    """Columns SQLite can bind: category/string -> object, bool -> int."""
+    out = {}
+    for c in df.columns:
+        s = df[c]
+        if isinstance(s.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(s.dtype):
+            out[c] = s.astype(object).where(s.notna(), None)
+        elif pd.api.types.is_bool_dtype(s.dtype):
+            out[c] = s.astype("int64")
+        else:
+            out[c] = s
+    return pd.DataFrame(out, index=df.index)
+
+
+def _with_dims(findings: pd.DataFrame, itens: pd.DataFrame) -> pd.DataFrame:
+    """Expanded findings plus the item dimensions they lack (looked up by `item`)."""
+    rows = findings["item"].to_numpy(dtype="int64")
+    dims = itens.reindex(columns=ITEM_DIMS, fill_value="").iloc[rows]
+    out = findings.copy()
+    for c in ITEM_DIMS:
+        if c not in out.columns:
+            out[c] = dims[c].to_numpy()
+    return out
+
+
+def _expanded(achados_v2: Optional[pd.DataFrame], achados_v3: Optional[pd.DataFrame],
+              itens: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    from v3_corrector.finding import expand_v3, is_compact_v3
+    from .validator import expand_v2, is_compact_v2
+
+    v2 = pd.DataFrame() if achados_v2 is None else achados_v2
+    v3 = pd.DataFrame() if achados_v3 is None else achados_v3
+    if not v2.empty and is_compact_v2(v2):
+        v2 = expand_v2(v2, itens, item_ref=True)
+    if not v3.empty and is_compact_v3(v3):
+        v3 = expand_v3(v3, item_ref=True).assign(regra=v3["regra"].astype(object).to_numpy())
+    if "item" in v2.columns:
+        v2 = _with_dims(v2, itens)
+    if "item" in v3.columns:
+        v3 = _with_dims(v3, itens)
+    return v2, v3
+
+
+_VIEW_COLS = ["origem", "item", "regra", "severidade", "campo"] + ITEM_DIMS
+
+
+def _view_sql(present: Dict[str, List[str]]) -> str:
+    parts = []
+    for table, origem in (("achados_v2", "V2"), ("achados_v3", "V3")):
+        cols = present.get(table)
+        if not cols:
+            continue
+        sel = [f"'{origem}' AS origem"] + [f'"{c}"' if c in cols else f'NULL AS "{c}"' for c in _VIEW_COLS[1:]]
+        parts.append(f"SELECT {', '.join(sel)} FROM {table}")
+    if not parts:
+        return "CREATE VIEW achados AS SELECT " + ", ".join(f'NULL AS "{c}"' for c in _VIEW_COLS) + " WHERE 0"
+    return "CREATE VIEW achados AS " + " UNION ALL ".join(parts)
+
+
+def build_results_db(
+    path: Union[str, Path],
+    itens: pd.DataFrame,
+    cabecalho: Optional[pd.DataFrame] = None,
+    achados_v2: Optional[pd.DataFrame] = None,
+    achados_v3: Optional[pd.DataFrame] = None,
+) -> Path:
+    """Write the query file for one batch (findings compact or expanded); replaced atomically."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.unlink(missing_ok=True)
+    os.close(os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))  # SQLite abre o arquivo vazio
+    v2, v3 = _expanded(achados_v2, achados_v3, itens)
+    tables = {
+        "itens": itens.reset_index(drop=True).rename_axis("item").reset_index(),
+        "cabecalho": cabecalho if cabecalho is not None else pd.DataFrame(),
+        "achados_v2": v2,
+        "achados_v3": v3,
+    }
+    present: Dict[str, List[str]] = {}
+    with span("results_db", items=len(itens)), closing(sqlite3.connect(tmp)) as conn:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        for name, df in tables.items():
+            if df is None or df.empty:
+                continue
+            _plain(df).to_sql(name, conn, index=False, chunksize=20_000)
+            present[name] = list(df.columns)
+            for c in (INDEXED if name in ("itens", "cabecalho") else FINDING_INDEXED):
+                if c in df.columns:
+                    conn.execute(f'CREATE INDEX "ix_{name}_{c}" ON {name} ("{c}")')
+        if "itens" in present:
+            conn.execute('CREATE UNIQUE INDEX ix_itens_item ON itens (item)')
+        for name in ("achados_v2", "achados_v3"):
+            if "item" in present.get(name, []):
+                conn.execute(f'CREATE INDEX "ix_{name}_item" ON {name} (item)')
+        conn.execute(_view_sql(present))
+        conn.execute("PRAGMA analysis_limit=1000")   # estatísticas por amostra: ANALYZE rápido em lotes grandes
+        conn.execute("ANALYZE")
+        conn.commit()
+    tmp.replace(path)
+    return path
+
+
+def session_file_path(suffix: str = ".sqlite") -> Path:
+    """New private file (0o600) for a session's results or exports; stale ones (> 1 day) are removed on the way."""
+    SESSION_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    os.chmod(SESSION_DIR, 0o700)
+    now = time.time()
+    for p in SESSION_DIR.iterdir():
+        try:
+            if now - p.stat().st_mtime > SESSION_MAX_AGE_S:
+                p.unlink()
+        except OSError:
+            pass
+    path = SESSION_DIR / f"{uuid.uuid4().hex}{suffix}"
+    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+    return path
+
+
+def session_db_path() -> Path:
+    """New file for an interactive session's results (see session_file_path)."""
+    path = session_file_path(".sqlite")
+    path.unlink()  # build_results_db cria o arquivo (0o600) e troca atomicamente
+    return path
+
+
+def ensure_dir_db(results_dir: Union[str, Path]) -> Path:
+    """consulta.sqlite for a folder of Parquet result tables, rebuilt when any table is newer."""
+    from .columnar_export import read_columnar
+
+    results_dir = Path(results_dir)
+    db = results_dir / DB_NAME
+    sources = [results_dir / f"{n}.parquet" for n in ("itens", "cabecalho", "achados_v2", "achados_v3")]
+    newest = max((p.stat().st_mtime_ns for p in sources if p.exists()), default=None)
+    if newest is None:
+        raise FileNotFoundError(f"Nenhuma tabela de resultado em {results_dir}")
+    if db.exists() and db.stat().st_mtime_ns >= newest:
+        return db
+    t = {p.stem: read_columnar(p) for p in sources if p.exists()}
+    return build_results_db(db, t.get("itens", pd.DataFrame()), t.get("cabecalho"),
+                            t.get("achados_v2"), t.get("achados_v3"))
+
+
+# ---------------------------------------------------------------------------
+# Consulta
+# ---------------------------------------------------------------------------
+
+class ResultsDB:
+    """Read-only queries over one results file (a short-lived connection per call)."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._columns: Dict[str, List[str]] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=30)
+
+    def query(self, sql: str, params: Sequence[Any] = ()) -> pd.DataFrame:
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(sql, conn, params=list(params))
+
+    def tables(self) -> List[str]:
+        df = self.query("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY name")
+        return [n for n in df["name"] if n in TABLES]
+
+    def columns(self, table: str) -> List[str]:
+        if table not in TABLES:
+            raise ValueError(f"Tabela desconhecida: {table}")
+        if table not in self._columns:
+            with closing(self._connect()) as conn:
+                self._columns[table] = [r[1] for r in conn.execute(f'PRAGMA table_info("{table}")')]
+        return self._columns[table]
+
+    def count(self, table: str, filters: Optional[Filters] = None) -> int:
+        where, params = (filters or Filters()).where(self.columns(table))
+        with closing(self._connect()) as conn:
+            return int(conn.execute(f"SELECT COUNT(*) FROM {table}{where}", params).fetchone()[0])
+
+    def select(
+        self,
+        table: str,
+        filters: Optional[Filters] = None,
+        columns: Optional[Sequence[str]] = None,
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        limit: Optional[int] = 500,
+        offset: int = 0,
+    ) -> pd.DataFrame:
+        """Filtered rows (one page when limit is set), in stored order unless order_by is given."""
+        cols = self.columns(table)
+        wanted = [c for c in (columns or cols) if c in cols]
+        where, params = (filters or Filters()).where(cols)
+        sql = f"SELECT {', '.join(_q(c) for c in wanted)} FROM {table}{where}"
+        if order_by in cols:
+            sql += f" ORDER BY {_q(order_by)} {'DESC' if descending else 'ASC'}"
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [int(limit), int(offset)]
+        return self.query(sql, params)
+
+    def aggregate(self, table: str, by: Sequence[str], filters: Optional[Filters] = None,
+                  limit: Optional[int] = None) -> pd.DataFrame:
+        """Row counts (and distinct NF-e/items) per group; `by` takes GROUPINGS names."""
+        cols = self.columns(table)
+        keys = [b for b in by if b in GROUPINGS and _GROUP_NEEDS.get(b, b) in cols]
+        if not keys:
+            raise ValueError("Nenhum agrupamento válido para esta tabela.")
+        where, params = (filters or Filters()).where(cols)
+        sel = [f'{GROUPINGS[k]} AS "{k}"' for k in keys]
+        extra = ["COUNT(*) AS linhas"]
+        if "chave" in cols:
+            extra.append("COUNT(DISTINCT chave) AS nfes")
+        if "item" in cols and table != "itens":
+            extra.append("COUNT(DISTINCT item) AS itens")
+        sql = (f"SELECT {', '.join(sel + extra)} FROM {table}{where} "
+               f"GROUP BY {', '.join(str(i + 1) for i in range(len(keys)))} ORDER BY linhas DESC")
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return self.query(sql, params)
+
+    def distinct(self, table: str, column: str, limit: int = 1000) -> List[str]:
+        if column not in self.columns(table):
+            return []
+        df = self.query(f'SELECT DISTINCT "{column}" AS v FROM {table} WHERE "{column}" IS NOT NULL '
+                        f'ORDER BY 1 LIMIT {int(limit)}')
+        return [str(v) for v in df["v"]]
+
+
+def open_source(source: str) -> ResultsDB:
+    """ResultsDB for a .sqlite file, a results folder or a background job id."""
+    p = Path(source)
+    if p.is_file():
+        return ResultsDB(p)
+    if p.is_dir():
+        return ResultsDB(ensure_dir_db(p / "results" if (p / "results").is_dir() else p))
+    from .jobs import job_dir
+    d = job_dir(source) / "results"
+    if d.is_dir():
+        return ResultsDB(ensure_dir_db(d))
+    raise FileNotFoundError(f"Fonte não encontrada: {source}")
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Consultas SQL sobre o resultado de um lote de NF-e")
+    ap.add_argument("fonte", help="arquivo .sqlite, pasta de resultados (Parquet) ou id de lote em segundo plano")
+    ap.add_argument("--tabela", default="achados", choices=TABLES)
+    ap.add_argument("--emitente", default="", help="CNPJ do emitente")
+    ap.add_argument("--de", default="", help="dhEmi a partir de (AAAA-MM-DD)")
+    ap.add_argument("--ate", default="", help="dhEmi até (AAAA-MM-DD, inclusive)")
+    ap.add_argument("--ncm", default="", help="prefixo do NCM (capítulo, posição ou código)")
+    ap.add_argument("--cfop", default="")
+    ap.add_argument("--chave", default="")
+    ap.add_argument("--regra", action="append", default=[])
+    ap.add_argument("--severidade", action="append", default=[])
+    ap.add_argument("--texto", default="", help="trecho da descrição/mensagem")
+    ap.add_argument("--agrupar", default="", help=f"agrupamentos separados por vírgula ({', '.join(GROUPINGS)})")
+    ap.add_argument("--ordenar", default=None, help="coluna de ordenação")
+    ap.add_argument("--desc", action="store_true", help="ordem decrescente")
+    ap.add_argument("--limite", type=int, default=50)
+    ap.add_argument("--pular", type=int, default=0)
+    ap.add_argument("--sql", default="", help="consulta SQL livre (somente leitura)")
+    ap.add_argument("--formato", default="tabela", choices=["tabela", "csv", "json"])
+    args = ap.parse_args(argv)
+
+    try:
+        db = open_source(args.fonte)
+        if args.sql:
+            df = db.query(args.sql)
+        else:
+            flt = Filters(emitente=args.emitente, de=args.de, ate=args.ate, ncm=args.ncm, cfop=args.cfop,
+                          chave=args.chave, regra=args.regra, severidade=args.severidade, texto=args.texto)
+            if args.agrupar:
+                df = db.aggregate(args.tabela, [b.strip() for b in args.agrupar.split(",") if b.strip()],
+                                  flt, limit=args.limite)
+            else:
+                df = db.select(args.tabela, flt, order_by=args.ordenar, descending=args.desc,
+                               limit=args.limite, offset=args.pular)
+                print(f"# {db.count(args.tabela, flt)} linha(s) no filtro", file=sys.stderr)
+    except (FileNotFoundError, ValueError, sqlite3.Error) as e:
+        print(f"erro: {e}", file=sys.stderr)
+        return 2
+    if args.formato == "csv":
+        df.to_csv(sys.stdout, index=False)
+    elif args.formato == "json":
+        print(df.to_json(orient="records", force_ascii=False))
+    else:
+        with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+            print(df.to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
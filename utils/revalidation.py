@@ -0,0 +1,275 @@
+"""Incremental revalidation: refresh stored findings after a Base Legal change.
+
+diff_base_legal() compares two compiled versions (codes added / removed /
+description changed, per table). affected_items() maps that diff onto a
+batch — only items whose result can change:
+
+    NCM      código incluído/removido; NCM zerado quando a Tabela NCM mudou
+             (sugestão por descrição / NCMs aceitos)
+    CFOP     código incluído/removido
+    CST      código incluído/removido (CSOSN idem)
+    matriz   CFOP com alguma linha da matriz CFOP x CST/CSOSN alterada
+
+revalidate() reruns V2/V3 for those items only (the batch-level heuristics
+still see every item with the same description) and splices the new findings into the stored
+ones, in the same order a full run would produce. Findings stay in the compact form
+(validator.compact_v2 / finding.compact_v3).
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from v3_corrector.finding import compact_v3
+from v3_corrector.rules.registry import RuleProfile
+
+from v3_corrector.text_utils import norm_text
+
+from .base_legal import CompiledBaseLegal
+from .instrumentation import span
+from .validator import ITEM_COL, compact_v2
+
+
+@dataclass(frozen=True)
+class TableDiff:
+    incluidos: FrozenSet[str] = frozenset()
+    removidos: FrozenSet[str] = frozenset()
+    alterados: FrozenSet[str] = frozenset()   # mesmo código, descrição/regra diferente
+
+    def __bool__(self) -> bool:
+        return bool(self.incluidos or self.removidos or self.alterados)
+
+    @property
+    def codigos(self) -> FrozenSet[str]:
+        """Codes whose membership changed (what the validator checks)."""
+        return self.incluidos | self.removidos
+
+
+@dataclass(frozen=True)
+class BaseLegalDiff:
+    tabelas: Dict[str, TableDiff] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return any(self.tabelas.values())
+
+    def get(self, key: str) -> TableDiff:
+        return self.tabelas.get(key, TableDiff())
+
+    def resumo(self) -> pd.DataFrame:
+        return pd.DataFrame([
+            {"tabela": k, "incluidos": len(d.incluidos), "removidos": len(d.removidos), "alterados": len(d.alterados)}
+            for k, d in self.tabelas.items()
+        ])
+
+
+def _code_desc(df: pd.DataFrame, col: str, width: int) -> Dict[str, str]:
+    if df is None or df.empty or col not in df.columns:
+        return {}
+    codes = df[col].astype(str).str.replace(r"\D", "", regex=True).str.zfill(width)
+    desc = df["descricao"].astype(str).str.strip() if "descricao" in df.columns else pd.Series("", index=df.index)
+    return dict(zip(codes, desc))
+
+
+def _diff_maps(old: Dict, new: Dict) -> TableDiff:
+    common = old.keys() & new.keys()
+    return TableDiff(
+        incluidos=frozenset(map(str, new.keys() - old.keys())),
+        removidos=frozenset(map(str, old.keys() - new.keys())),
+        alterados=frozenset(str(k) for k in common if old[k] != new[k]),
+    )
+
+
+def _matrix_map(bl: CompiledBaseLegal) -> Dict[str, Tuple]:
+    """'<cfop>:<tipo>:<codigo|*>' -> rule row of the compiled CFOP x CST/CSOSN matrix."""
+    m = bl.cfop_cst
+    if m is None or not len(m):
+        return {}
+    rows = [tuple(r) for r in m.rules.itertuples(index=False, name=None)]
+    keys = [f"{k // 10000:04d}:{(k // 1000) % 10}:{k % 1000:03d}" for k in m.exact.tolist()]
+    keys += [f"{k // 10:04d}:{k % 10}:*" for k in m.wild.tolist()]
+    return dict(zip(keys, rows))
+
+
+def diff_base_legal(old: CompiledBaseLegal, new: CompiledBaseLegal) -> BaseLegalDiff:
+    """Per-table diff between two compiled Base Legal versions."""
+    with span("base_legal_diff"):
+        ncm = _diff_maps(_code_desc(old.get("ncm"), "ncm", 8), _code_desc(new.get("ncm"), "ncm", 8))
+        # códigos que o validador/V3 enxergam de fato (ncm_set / allowed_ncms)
+        ncm = TableDiff(
+            ncm.incluidos | (new.ncm_set - old.ncm_set) | (new.allowed_ncms - old.allowed_ncms),
+            ncm.removidos | (old.ncm_set - new.ncm_set) | (old.allowed_ncms - new.allowed_ncms),
+            ncm.alterados,
+        )
+        cfop = _diff_maps(_code_desc(old.get("cfop"), "cfop", 4), _code_desc(new.get("cfop"), "cfop", 4))
+        cfop = TableDiff(cfop.incluidos | (new.cfop_set - old.cfop_set),
+                         cfop.removidos | (old.cfop_set - new.cfop_set), cfop.alterados)
+        cst = TableDiff(
+            frozenset(f"CST:{c}" for c in new.cst_set - old.cst_set) | frozenset(f"CSOSN:{c}" for c in new.csosn_set - old.csosn_set),
+            frozenset(f"CST:{c}" for c in old.cst_set - new.cst_set) | frozenset(f"CSOSN:{c}" for c in old.csosn_set - new.csosn_set),
+        )
+        matriz = _diff_maps(_matrix_map(old), _matrix_map(new))
+        return BaseLegalDiff({"ncm": ncm, "cfop": cfop, "cst": cst, "cfop_cst": matriz})
+
+
+def _digits(s: pd.Series) -> pd.Series:
+    return s.fillna("").astype(str).str.strip().str.replace(r"\D", "", regex=True)
+
+
+def affected_items(df_itens: pd.DataFrame, old: CompiledBaseLegal, new: CompiledBaseLegal,
+                   diff: Optional[BaseLegalDiff] = None) -> np.ndarray:
+    """Boolean mask of the items whose V2/V3 findings may change from `old` to `new`."""
+    n = len(df_itens)
+    hit = np.zeros(n, dtype=bool)
+    if not n:
+        return hit
+    diff = diff if diff is not None else diff_base_legal(old, new)
+    col = lambda c: df_itens.get(c, pd.Series("", index=df_itens.index))  # noqa: E731
+
+    ncm = _digits(col("NCM"))
+    d = diff.get("ncm")
+    if d or old.ncm_index != new.ncm_index:
+        ncm8 = ncm.str.zfill(8)
+        # tabela vazia desliga as regras de existência: qualquer NCM informado muda
+        if bool(old.ncm_set) != bool(new.ncm_set) or bool(old.allowed_ncms) != bool(new.allowed_ncms):
+            hit |= (ncm != "").to_numpy()
+        hit |= (ncm8.isin(d.codigos) | ncm8.str[:8].isin(d.codigos)).to_numpy()
+        # NCM zerado: sugestão por descrição e NCMs aceitos dependem da tabela inteira
+        hit |= ncm8.str[:8].eq("00000000").to_numpy()
+
+    d = diff.get("cfop")
+    cfop = _digits(col("CFOP"))
+    if d:
+        if bool(old.cfop_set) != bool(new.cfop_set):
+            hit |= (cfop != "").to_numpy()
+        hit |= cfop.str.zfill(4).isin(d.codigos).to_numpy()
+
+    d = diff.get("cst")
+    if d:
+        cst = col("CST_ICMS").fillna("").astype(str).str.strip()
+        csosn = col("CSOSN").fillna("").astype(str).str.strip()
+        if bool(old.cst_set) != bool(new.cst_set):
+            hit |= (cst != "").to_numpy()
+        if bool(old.csosn_set) != bool(new.csosn_set):
+            hit |= (csosn != "").to_numpy()
+        hit |= (("CST:" + cst).isin(d.codigos) | ("CSOSN:" + csosn).isin(d.codigos)).to_numpy()
+
+    d = diff.get("cfop_cst")
+    if d:
+        cfops = {k.split(":", 1)[0] for k in d.incluidos | d.removidos | d.alterados}
+        hit |= cfop.str.zfill(4).str[:4].isin(cfops).to_numpy()
+    return hit
+
+
+def _splice(stored: pd.DataFrame, fresh: pd.DataFrame, affected: np.ndarray, sort_cols=()) -> pd.DataFrame:
+    """Stored findings minus the affected items, plus the fresh ones, in full-run order (compact form)."""
+    keep = stored
+    if not stored.empty and ITEM_COL in stored.columns:
+        keep = stored[~stored[ITEM_COL].isin(np.flatnonzero(affected))]
+    parts = [p for p in (keep, fresh) if p is not None and not p.empty]
+    if not parts:
+        return stored.iloc[0:0]
+    out = pd.concat(parts, ignore_index=True)
+    if "severidade" in sort_cols:
+        out["_o"] = out["severidade"].astype(object).map({"ERRO": 0, "ALERTA": 1}).fillna(9)
+        out["_c"] = out["campo"].astype(object)
+        out = out.sort_values(["_o", "_c", ITEM_COL], kind="mergesort").drop(columns=["_o", "_c"])
+        return compact_v3(out.reset_index(drop=True))
+    out = out.sort_values(ITEM_COL, kind="mergesort")
+    return compact_v2(out.reset_index(drop=True))
+
+
+@dataclass
+class Revalidation:
+    achados_v2: pd.DataFrame
+    achados_v3: pd.DataFrame
+    itens_corrigido: pd.DataFrame
+    afetados: int
+    diff: BaseLegalDiff
+
+
+def norm_descriptions(df_itens: pd.DataFrame) -> pd.Series:
+    """norm_text(xProd) per item (computed once per distinct description)."""
+    x = df_itens.get("xProd", pd.Series("", index=df_itens.index)).fillna("").astype(str)
+    uniq = pd.unique(x)
+    return x.map(dict(zip(uniq, map(norm_text, uniq))))
+
+
+def recompute_items(
+    df_itens: pd.DataFrame,
+    groups: List[Tuple[CompiledBaseLegal, np.ndarray]],
+    achados_v2: pd.DataFrame,
+    achados_v3: pd.DataFrame,
+    itens_corrigido: Optional[pd.DataFrame],
+    auto_apply: bool = False,
+    ncm_engine: Optional[str] = None,
+    catalog=None,
+    profile: Optional[RuleProfile] = None,
+    desc_norm: Optional[pd.Series] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Rerun V2/V3 for the item positions of each (Base Legal, posições) group.
+
+    Returns (achados_v2, achados_v3, itens_corrigido) with those items'
+    findings replaced. The batch-level heuristics only compare items with
+    the same normalized description, so they get just the items sharing a
+    description with the recomputed ones (desc_norm: norm_text(xProd), if
+    already at hand).
+    """
+    from v3_corrector.correction_engine import _apply_corrections, sort_findings
+    from .validator import _validate
+
+    corr = itens_corrigido if itens_corrigido is not None and len(itens_corrigido) == len(df_itens) else df_itens.copy()
+    groups = [(bl, np.asarray(pos)) for bl, pos in groups if len(pos)]
+    if not groups:
+        return achados_v2, achados_v3, corr
+    mask = np.zeros(len(df_itens), dtype=bool)
+    for _, pos in groups:
+        mask[pos] = True
+    if desc_norm is None:
+        desc_norm = norm_descriptions(df_itens)
+    lote = df_itens[desc_norm.isin(set(desc_norm[mask])).to_numpy()]
+    v2_parts, v3_parts = [], []
+    corr = corr.copy()
+    with span("recalculo_itens", items=int(mask.sum())):
+        for bl, pos in groups:
+            sub = df_itens.iloc[pos]
+            v2 = _validate(sub, bl, profile)
+            if not v2.empty:
+                v2["_row"] = pos[v2["_row"].to_numpy()]
+                v2_parts.append(v2)
+            sub_corr, v3 = _apply_corrections(sub, bl, auto_apply, ncm_engine, catalog, profile, lote=lote)
+            if not v3.empty:
+                v3["_row"] = pos[v3["_row"].to_numpy()]
+                v3_parts.append(v3)
+            for j, c in enumerate(corr.columns):
+                if c in sub_corr.columns:
+                    corr.iloc[pos, j] = sub_corr[c].to_numpy()
+    v2 = pd.concat(v2_parts, ignore_index=True).sort_values("_row", kind="mergesort") if v2_parts else pd.DataFrame()
+    v3 = pd.concat(v3_parts, ignore_index=True).sort_values(["_row", "_ord"], kind="mergesort") if v3_parts else pd.DataFrame()
+    return (
+        _splice(achados_v2, v2.rename(columns={"_row": ITEM_COL}), mask),
+        _splice(achados_v3, sort_findings(v3, item_ref=True), mask, sort_cols=("severidade",)),
+        corr,
+    )
+
+
+def revalidate(
+    df_itens: pd.DataFrame,
+    achados_v2: pd.DataFrame,
+    achados_v3: pd.DataFrame,
+    itens_corrigido: Optional[pd.DataFrame],
+    old: CompiledBaseLegal,
+    new: CompiledBaseLegal,
+    auto_apply: bool = False,
+    ncm_engine: Optional[str] = None,
+    catalog=None,
+    profile: Optional[RuleProfile] = None,
+) -> Revalidation:
+    """Recompute V2/V3 only for the items affected by old -> new (findings must carry `item`)."""
+    diff = diff_base_legal(old, new)
+    pos = np.flatnonzero(affected_items(df_itens, old, new, diff))
+    v2, v3, corr = recompute_items(df_itens, [(new, pos)], achados_v2, achados_v3, itens_corrigido,
+                                   auto_apply, ncm_engine, catalog, profile)
+    return Revalidation(v2, v3, corr, int(len(pos)), diff)
@@ -0,0 +1,59 @@
+"""Per-client rule profiles (DATA_DIR/perfis_regras.json).
+
+    {"perfis": {"Cliente X": {"desativadas": ["FORMATO_CFOP"], "ativadas": []}}}
+"""
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from v3_corrector.rules.registry import RuleProfile
+
+from .base_legal import DATA_DIR
+
+PROFILES_PATH = DATA_DIR / "perfis_regras.json"
+DEFAULT_PROFILE = "padrão"
+
+
+def load_profiles(path: Path = PROFILES_PATH) -> Dict[str, RuleProfile]:
+    """Saved profiles by name (always includes the default, with every rule on)."""
+    out = {DEFAULT_PROFILE: RuleProfile(DEFAULT_PROFILE)}
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return out
+    for nome, p in (data.get("perfis") or {}).items():
+        out[nome] = RuleProfile(nome, frozenset(p.get("desativadas", [])), frozenset(p.get("ativadas", [])))
+    return out
+
+
+def get_profile(nome: Optional[str], path: Path = PROFILES_PATH) -> RuleProfile:
+    return load_profiles(path).get(nome or DEFAULT_PROFILE) or RuleProfile(DEFAULT_PROFILE)
+
+
+def _write(profiles: Dict[str, RuleProfile], path: Path) -> None:
+    data = {"perfis": {
+        p.nome: {"desativadas": sorted(p.desativadas), "ativadas": sorted(p.ativadas)}
+        for p in profiles.values() if p.nome != DEFAULT_PROFILE
+    }}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.replace(path)
+
+
+def save_profile(nome: str, desativadas: Iterable[str], ativadas: Iterable[str] = (), path: Path = PROFILES_PATH) -> RuleProfile:
+    nome = (nome or "").strip()
+    if not nome or nome == DEFAULT_PROFILE:
+        raise ValueError("Informe um nome de perfil (o perfil padrão não é editável).")
+    profiles = load_profiles(path)
+    profiles[nome] = RuleProfile(nome, frozenset(desativadas), frozenset(ativadas))
+    _write(profiles, path)
+    return profiles[nome]
+
+
+def delete_profile(nome: str, path: Path = PROFILES_PATH) -> None:
+    profiles = load_profiles(path)
+    if profiles.pop(nome, None) is not None:
+        _write(profiles, path)
@@ -0,0 +1,408 @@
+"""Local HTTP validation service: python -m utils.service [--host 127.0.0.1] [--port 8765]
+
+Endpoints (POST, corpo = lote):
+
+    /parse      itens, cabeçalhos e erros de leitura
+    /validate   itens + achados V2 (`item` = posição em itens)
+    /correct    achados V2/V3 e as alterações por arquivo/nItem
+    /rewrite    XMLs corrigidos (um XML -> XML; vários -> ZIP)
+    /health     GET: workers, capacidade, requisições em andamento
+
+Body by Content-Type: application/xml (um XML), application/zip (XMLs do
+ZIP) or application/x-ndjson (uma linha por NF-e: {"arquivo": ..., "xml": ...}
+or "xml_base64"). Query options follow the job options (utils.batch):
+perfil, motor_ncm, aplicar=1, vigencia=1.
+
+Requests run on a process pool started up front (forkserver, or spawn where
+there is none: utils.jobs.mp_context), each worker compiling the Base Legal
+once in its initializer. An unknown `perfil` gets 400. Bodies above
+NFE_SERVICE_MAX_MB get 413; when NFE_SERVICE_QUEUE requests are already in
+flight the service answers 503 with Retry-After instead of queueing without
+bound. ServiceClient talks to it locally (tests, ERP integration).
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import io
+import json
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+OPERATIONS = ("parse", "validate", "correct", "rewrite")
+MAX_MB_ENV = "NFE_SERVICE_MAX_MB"
+MAX_FILES_ENV = "NFE_SERVICE_MAX_FILES"
+WORKERS_ENV = "NFE_SERVICE_WORKERS"
+QUEUE_ENV = "NFE_SERVICE_QUEUE"
+TIMEOUT_ENV = "NFE_SERVICE_TIMEOUT_S"
+ZIP_RATIO = 20  # XML descompactado até 20x o limite do corpo (ZIP bomb)
+DRAIN_RATIO = 4  # corpo recusado até 4x o limite é lido e descartado (o cliente recebe o 413)
+
+
+class RequestError(Exception):
+    """Client error with its HTTP status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(1, int(os.environ.get(name, "") or default))
+    except ValueError:
+        return default
+
+
+# ---------------------------------------------------------------------------
+# Corpo da requisição -> [(nome, bytes)]
+# ---------------------------------------------------------------------------
+
+def read_body(content_type: str, body: bytes, max_bytes: int, max_files: int,
+              name: str = "documento.xml") -> List[Tuple[str, bytes]]:
+    """XML files of a request body (single XML, ZIP or NDJSON)."""
+    ctype = (content_type or "").split(";")[0].strip().lower()
+    if ctype in ("application/zip", "application/x-zip-compressed") or body[:4] == b"PK\x03\x04":
+        try:
+            zf = zipfile.ZipFile(io.BytesIO(body))
+        except zipfile.BadZipFile as e:
+            raise RequestError(400, f"ZIP inválido: {e}")
+        members = [zi for zi in zf.infolist() if zi.filename.lower().endswith(".xml")]
+        if len(members) > max_files:
+            raise RequestError(413, f"ZIP com {len(members)} XMLs (máximo {max_files}).")
+        if sum(zi.file_size for zi in members) > max_bytes * ZIP_RATIO:
+            raise RequestError(413, "Conteúdo descompactado do ZIP acima do limite.")
+        return [(zi.filename, zf.read(zi)) for zi in members]
+    if ctype in ("application/x-ndjson", "application/jsonl", "application/ndjson"):
+        out = []
+        for n, line in enumerate(body.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                obj = json.loads(line)
+                payload = (base64.b64decode(obj["xml_base64"]) if "xml_base64" in obj
+                           else obj["xml"].encode("utf-8"))
+            except Exception as e:
+                raise RequestError(400, f"Linha {n} do NDJSON inválida: {e}")
+            out.append((str(obj.get("arquivo") or f"linha_{n}.xml"), payload))
+            if len(out) > max_files:
+                raise RequestError(413, f"NDJSON com mais de {max_files} NF-e.")
+        return out
+    if not body.strip():
+        raise RequestError(400, "Corpo vazio.")
+    return [(name, body)]
+
+
+def options_from_query(query: Dict[str, List[str]]) -> Dict[str, Any]:
+    """Job options (utils.batch) from the query string."""
+    def flag(key: str) -> bool:
+        return (query.get(key) or [""])[0].strip().lower() in ("1", "true", "sim", "yes")
+
+    perfil = (query.get("perfil") or [None])[0]
+    if perfil:
+        from .rule_profiles import load_profiles
+
+        if perfil not in load_profiles():
+            # sem isso o perfil cairia no padrão (todas as regras) sem aviso
+            raise RequestError(400, f"Perfil de regras desconhecido: {perfil}")
+    return {
+        "executar_validacao": True,
+        "aplicar_correcao_v3": flag("aplicar"),
+        "ncm_engine": (query.get("motor_ncm") or [None])[0],
+        "perfil_regras": perfil,
+        "por_vigencia": flag("vigencia"),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Worker (processo do pool)
+# ---------------------------------------------------------------------------
+
+def _ready() -> int:
+    return os.getpid()
+
+
+def _records(df) -> str:
+    return "[]" if df is None or df.empty else df.to_json(orient="records", force_ascii=False)
+
+
+def _json_doc(parts: Dict[str, str]) -> bytes:
+    """JSON object from already serialized values (tables go straight through to_json)."""
+    return ("{" + ",".join(f"{json.dumps(k)}:{v}" for k, v in parts.items()) + "}").encode("utf-8")
+
+
+def handle(op: str, files: List[Tuple[str, bytes]], options: Dict[str, Any]) -> Tuple[str, bytes]:
+    """(Content-Type, corpo) of one operation; runs in a pool worker."""
+    from .batch import process_files, rewrite_files
+
+    if op == "parse":
+        res = process_files(files, dict(options, executar_validacao=False), learn=False)
+        return "application/json", _json_doc({
+            "documentos": str(len(res.cabecalho)), "itens": _records(res.itens),
+            "cabecalhos": _records(res.cabecalho), "erros": _records(res.erros),
+        })
+    if op == "rewrite":
+        options = dict(options, aplicar_correcao_v3=True)
+    res = process_files(files, options, correct=op != "validate")
+    if op == "rewrite":
+        out = list(rewrite_files(files, res.itens, res.itens_corrigido))
+        if len(out) == 1:
+            return "application/xml", out[0][1]
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, payload in out:
+                zf.writestr(name, payload)
+        return "application/zip", buf.getvalue()
+
+    from .validator import expand_v2
+    parts = {
+        "documentos": str(len(res.cabecalho)), "total_itens": str(len(res.itens)),
+        "base_legal": json.dumps([list(v) for v in res.base_legal]),
+        "erros": _records(res.erros),
+        "achados_v2": _records(expand_v2(res.achados_v2, res.itens, item_ref=True)),
+    }
+    if op == "validate":
+        parts["itens"] = _records(res.itens)
+        return "application/json", _json_doc(parts)
+
+    from .pipeline import changes_by_file
+    from v3_corrector.finding import expand_v3
+    parts["achados_v3"] = _records(expand_v3(res.achados_v3, item_ref=True))
+    parts["alteracoes"] = json.dumps(changes_by_file(res.itens, res.itens_corrigido), ensure_ascii=False)
+    return "application/json", _json_doc(parts)
+
+
+# ---------------------------------------------------------------------------
+# Servidor
+# ---------------------------------------------------------------------------
+
+class ValidationService:
+    """HTTP server + pre-started worker pool. start() returns once the workers are up."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, workers: Optional[int] = None,
+                 max_bytes: Optional[int] = None, max_files: Optional[int] = None,
+                 queue: Optional[int] = None, timeout: Optional[float] = None):
+        from .jobs import max_workers
+
+        self.workers = workers or _env_int(WORKERS_ENV, max_workers())
+        self.max_bytes = max_bytes or _env_int(MAX_MB_ENV, 50) * 1024 * 1024
+        self.max_files = max_files or _env_int(MAX_FILES_ENV, 20_000)
+        self.queue = queue or _env_int(QUEUE_ENV, 2 * self.workers)
+        self.timeout = timeout or float(_env_int(TIMEOUT_ENV, 600))
+        self._slots = threading.BoundedSemaphore(self.queue)
+        self._in_flight = 0
+        self._count_lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        from .batch import init_worker
+        from .jobs import mp_context
+
+        # recriado de dentro de uma thread de requisição após BrokenProcessPool: nada de fork direto
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, mp_context=mp_context())
+        # sobe todos os workers agora (o pool só cria processos sob demanda)
+        for f in [pool.submit(_ready) for _ in range(self.workers)]:
+            f.result()
+        return pool
+
+    def pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = self._new_pool()
+            return self._pool
+
+    def _reset_pool(self, broken: ProcessPoolExecutor) -> None:
+        with self._pool_lock:
+            if self._pool is broken:
+                self._pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, op: str, files: List[Tuple[str, bytes]], options: Dict[str, Any]) -> Tuple[str, bytes]:
+        """One operation on the pool, within the in-flight limit (RequestError 503 when full)."""
+        if not self._slots.acquire(blocking=False):
+            raise RequestError(503, "Serviço ocupado; tente novamente.")
+        with self._count_lock:
+            self._in_flight += 1
+        try:
+            pool = self.pool()
+            try:
+                return pool.submit(handle, op, files, options).result(timeout=self.timeout)
+            except FutureTimeout:
+                raise RequestError(504, f"Tempo limite ({self.timeout:.0f}s) excedido.")
+            except BrokenProcessPool:
+                # worker morreu (OOM, kill): o próximo pedido recria o pool
+                self._reset_pool(pool)
+                raise RequestError(500, "Worker interrompido; pool reiniciado.")
+        finally:
+            with self._count_lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    def health(self) -> Dict[str, Any]:
+        return {"status": "ok", "workers": self.workers, "capacidade": self.queue,
+                "em_andamento": self._in_flight, "max_mb": self.max_bytes // (1024 * 1024)}
+
+    def start(self) -> "ValidationService":
+        self.pool()
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="nfe_service", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self.pool()
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self) -> None:
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread = None
+        self.httpd.server_close()
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _make_handler(service: ValidationService):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):  # silencioso (o ERP registra do lado dele)
+            pass
+
+        def _send(self, status: int, body: bytes, ctype: str = "application/json", headers: Dict[str, str] = None):
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _discard(self, length: int) -> bool:
+            """Drain a rejected body (so the client reads the answer); too large -> just close."""
+            if length > DRAIN_RATIO * service.max_bytes:
+                return False
+            while length > 0:
+                chunk = self.rfile.read(min(length, 1 << 16))
+                if not chunk:
+                    return False
+                length -= len(chunk)
+            return True
+
+        def _error(self, status: int, message: str, unread: int = 0):
+            headers = {"Retry-After": "1"} if status == 503 else {}
+            if status == 411 or (unread and not self._discard(unread)):
+                # corpo não lido: a conexão não pode ser reaproveitada
+                self.close_connection = True
+                headers["Connection"] = "close"
+            self._send(status, json.dumps({"erro": message}, ensure_ascii=False).encode("utf-8"), headers=headers)
+
+        def do_GET(self):
+            if urllib.parse.urlsplit(self.path).path.rstrip("/") == "/health":
+                self._send(200, json.dumps(service.health()).encode("utf-8"))
+            else:
+                self._error(404, "Rota não encontrada.")
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            op = url.path.strip("/")
+            try:
+                if op not in OPERATIONS:
+                    raise RequestError(404, "Rota não encontrada.")
+                length = self.headers.get("Content-Length")
+                if length is None:
+                    raise RequestError(411, "Content-Length obrigatório.")
+                if int(length) > service.max_bytes:
+                    self._error(413, f"Corpo acima de {service.max_bytes // (1024 * 1024)} MB.", unread=int(length))
+                    return
+                body = self.rfile.read(int(length))
+                query = urllib.parse.parse_qs(url.query)
+                files = read_body(self.headers.get("Content-Type", ""), body, service.max_bytes,
+                                  service.max_files, name=(query.get("arquivo") or ["documento.xml"])[0])
+                ctype, out = service.run(op, files, options_from_query(query))
+                self._send(200, out, ctype)
+            except RequestError as e:
+                self._error(e.status, str(e))
+            except ValueError as e:
+                self._error(400, str(e))
+            except Exception as e:
+                self._error(500, f"{type(e).__name__}: {e}")
+
+    return Handler
+
+
+# ---------------------------------------------------------------------------
+# Cliente local
+# ---------------------------------------------------------------------------
+
+class ServiceClient:
+    """Minimal client (urllib) for the service: tests and ERP scripts."""
+
+    CONTENT_TYPES = {"xml": "application/xml", "zip": "application/zip", "ndjson": "application/x-ndjson"}
+
+    def __init__(self, base_url: str = "http://127.0.0.1:8765", timeout: float = 600):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, op: str, body: bytes = None, kind: str = "xml", **options) -> Tuple[int, str, bytes]:
+        """(status, Content-Type, corpo); options go to the query string (perfil=..., aplicar=1...)."""
+        query = urllib.parse.urlencode({k: v for k, v in options.items() if v is not None})
+        url = f"{self.base_url}/{op}" + (f"?{query}" if query else "")
+        req = urllib.request.Request(url, data=body, method="POST" if body is not None else "GET")
+        if body is not None:
+            req.add_header("Content-Type", self.CONTENT_TYPES.get(kind, kind))
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return resp.status, resp.headers.get("Content-Type", ""), resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get("Content-Type", ""), e.read()
+
+    def json(self, op: str, body: bytes = None, kind: str = "xml", **options) -> Dict[str, Any]:
+        status, _, out = self.request(op, body, kind, **options)
+        data = json.loads(out or b"{}")
+        if status != 200:
+            raise RequestError(status, data.get("erro", ""))
+        return data
+
+    def health(self) -> Dict[str, Any]:
+        return self.json("health")
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Serviço HTTP local de validação de NF-e")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--workers", type=int, default=None, help=f"processos worker (padrão: {WORKERS_ENV} ou NFE_JOB_WORKERS)")
+    args = ap.parse_args(argv)
+    service = ValidationService(args.host, args.port, workers=args.workers)
+    print(f"Serviço de validação em {service.url} ({service.workers} worker(s))", flush=True)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
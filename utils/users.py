@@ -1,72 +1,169 @@
+"""User store (data/users.json) and signed session tokens.
+
+The file is parsed once per process and cached by (mtime, size); every change
+is a read-modify-write under a lock (threads + an fcntl file lock where
+available) written atomically (temp file + replace), so concurrent admin
+actions neither lose updates nor leave a half-written file.
+
+After login the session keeps a signed token (HMAC) instead of the password:
+verify_token costs one HMAC and a cached lookup per rerun or page switch, and
+still ends the session when the user is deactivated or the password changes.
+Hashes made with a lower PBKDF2 cost than NFE_PBKDF2_ITERATIONS are redone
+at the next successful login.
+"""
+import base64
+import copy
+import hashlib
+import hmac
 import json
 import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any
-from .crypto import hash_password, verify_password
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: só o lock entre threads do processo
+    fcntl = None
+
+from .crypto import hash_password, needs_rehash, sign, verify_password
 
 DEFAULT_USERS_FILE = Path(__file__).resolve().parents[2] / "data" / "users.json"
+SECRET_ENV = "NFE_SESSION_SECRET"      # chave dos tokens (vários servidores: a mesma em todos)
+TTL_ENV = "NFE_SESSION_TTL_H"
+DEFAULT_TTL_H = 12.0
 
-def load_users(path: Path = DEFAULT_USERS_FILE) -> Dict[str, Any]:
-    if not path.exists():
-        path.parent.mkdir(parents=True, exist_ok=True)
-        # default admin user will be created by bootstrap in app startup
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump({"users": {}}, f, ensure_ascii=False, indent=2)
+_lock = threading.RLock()
+_cache: Dict[Path, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+_keys: Dict[Path, bytes] = {}
+
+
+def _stamp(path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _read(path: Path) -> Dict[str, Any]:
+    """Parsed users file, shared by every caller (do not mutate); re-read only when it changes."""
+    stamp = _stamp(path)
+    if stamp is None:
+        return {"users": {}}
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
     with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+        data = json.load(f)
+    _cache[path] = (stamp, data)
+    return data
 
-def save_users(data: Dict[str, Any], path: Path = DEFAULT_USERS_FILE) -> None:
+
+def _write(path: Path, data: Dict[str, Any]) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    tmp.replace(path)
+    _cache[path] = (_stamp(path), data)
+
+
+@contextmanager
+def _locked(path: Path):
+    with _lock:
+        if fcntl is None:
+            yield
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path.with_name(path.name + ".lock"), "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _update(path: Path, fn: Callable[[Dict[str, Any]], bool]) -> None:
+    """fn edits a copy of the current data under the lock; written only when it returns True."""
+    with _locked(path):
+        data = copy.deepcopy(_read(path))
+        if fn(data):
+            _write(path, data)
+
+
+def _new_user(password: str, role: str, active: bool) -> Dict[str, Any]:
+    return {
+        "password_hash": hash_password(password),
+        "role": role,
+        "active": active,
+        "created_at": datetime.utcnow().isoformat() + "Z",
+    }
+
+
+def load_users(path: Path = DEFAULT_USERS_FILE) -> Dict[str, Any]:
+    return copy.deepcopy(_read(path))
+
+def save_users(data: Dict[str, Any], path: Path = DEFAULT_USERS_FILE) -> None:
+    with _locked(path):
+        _write(path, copy.deepcopy(data))
 
 def ensure_admin(path: Path = DEFAULT_USERS_FILE, admin_username: str = "admin", admin_password: str = "admin123") -> None:
     """Create admin user if missing. Use secrets/env for password in production."""
-    data = load_users(path)
-    users = data.setdefault("users", {})
-    if admin_username not in users:
-        users[admin_username] = {
-            "password_hash": hash_password(admin_password),
-            "role": "admin",
-            "active": True,
-            "created_at": __import__("datetime").datetime.utcnow().isoformat() + "Z"
-        }
-        save_users(data, path)
+    if admin_username in _read(path).get("users", {}):
+        return
+
+    def add(data):
+        users = data.setdefault("users", {})
+        if admin_username in users:
+            return False
+        users[admin_username] = _new_user(admin_password, "admin", True)
+        return True
+    _update(path, add)
 
 def authenticate(username: str, password: str, path: Path = DEFAULT_USERS_FILE):
-    data = load_users(path)
-    u = data.get("users", {}).get(username)
+    u = _read(path).get("users", {}).get(username)
     if not u or not u.get("active", True):
         return None
-    if verify_password(password, u.get("password_hash", "")):
-        return {"username": username, "role": u.get("role", "user")}
-    return None
+    stored = u.get("password_hash", "")
+    if not verify_password(password, stored):
+        return None
+    if needs_rehash(stored):
+        # custo do PBKDF2 subiu: refaz o hash com a senha que acabou de ser conferida
+        def rehash(data):
+            cur = data.get("users", {}).get(username)
+            if not cur or cur.get("password_hash") != stored:
+                return False
+            cur["password_hash"] = hash_password(password)
+            return True
+        _update(path, rehash)
+    return {"username": username, "role": u.get("role", "user"), "token": issue_token(username, path)}
 
 def add_user(username: str, password: str, role: str = "user", active: bool = True, path: Path = DEFAULT_USERS_FILE) -> None:
-    data = load_users(path)
-    users = data.setdefault("users", {})
-    if username in users:
-        raise ValueError("Usuário já existe.")
-    users[username] = {
-        "password_hash": hash_password(password),
-        "role": role,
-        "active": active,
-        "created_at": __import__("datetime").datetime.utcnow().isoformat() + "Z"
-    }
-    save_users(data, path)
+    def add(data):
+        users = data.setdefault("users", {})
+        if username in users:
+            raise ValueError("Usuário já existe.")
+        users[username] = _new_user(password, role, active)
+        return True
+    _update(path, add)
 
 def set_user_active(username: str, active: bool, path: Path = DEFAULT_USERS_FILE) -> None:
-    data = load_users(path)
-    users = data.setdefault("users", {})
-    if username not in users:
-        raise ValueError("Usuário não encontrado.")
-    users[username]["active"] = active
-    save_users(data, path)
+    def set_active(data):
+        users = data.setdefault("users", {})
+        if username not in users:
+            raise ValueError("Usuário não encontrado.")
+        users[username]["active"] = active
+        return True
+    _update(path, set_active)
 
 def list_users(path: Path = DEFAULT_USERS_FILE):
-    data = load_users(path)
     out = []
-    for uname, u in data.get("users", {}).items():
+    for uname, u in _read(path).get("users", {}).items():
         out.append({
             "username": uname,
             "role": u.get("role","user"),
@@ -75,15 +172,87 @@ def list_users(path: Path = DEFAULT_USERS_FILE):
         })
     return out
 
+# --- Session tokens ---
+
+def _secret(path: Path) -> bytes:
+    """NFE_SESSION_SECRET, or a random key kept next to users.json (created once, mode 600)."""
+    env = os.environ.get(SECRET_ENV, "")
+    if env:
+        return env.encode("utf-8")
+    key_path = path.with_name("session.key")
+    key = _keys.get(key_path)
+    if key is None:
+        if not key_path.exists():
+            # gravada à parte e ligada no nome final: quem chegar junto lê a mesma chave, inteira
+            key_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = key_path.with_name(f"{key_path.name}.{os.getpid()}.tmp")
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+            try:
+                os.link(tmp, key_path)
+            except FileExistsError:
+                pass
+            finally:
+                tmp.unlink(missing_ok=True)
+        key = _keys[key_path] = key_path.read_text().strip().encode("utf-8")
+    return key
+
+
+def _ttl_seconds() -> float:
+    try:
+        return float(os.environ.get(TTL_ENV, "") or DEFAULT_TTL_H) * 3600
+    except ValueError:
+        return DEFAULT_TTL_H * 3600
+
+
+def _fingerprint(u: Dict[str, Any]) -> str:
+    # troca de senha (ou rehash) invalida os tokens emitidos antes
+    return hashlib.sha256(u.get("password_hash", "").encode("utf-8")).hexdigest()[:16]
+
+
+def issue_token(username: str, path: Path = DEFAULT_USERS_FILE) -> str:
+    """Signed session token: user, expiry and a fingerprint of the current password hash."""
+    u = _read(path).get("users", {}).get(username, {})
+    body = base64.urlsafe_b64encode(json.dumps(
+        [username, int(time.time() + _ttl_seconds()), _fingerprint(u)], separators=(",", ":"),
+    ).encode("utf-8")).rstrip(b"=").decode()
+    return f"{body}.{sign(body.encode(), _secret(path))}"
+
+
+def verify_token(token: str, path: Path = DEFAULT_USERS_FILE) -> Optional[Dict[str, Any]]:
+    """{"username", "role", "token"} for a valid token of an active user, else None (no PBKDF2)."""
+    try:
+        body, mac = token.rsplit(".", 1)
+        if not hmac.compare_digest(mac, sign(body.encode(), _secret(path))):
+            return None
+        username, exp, fp = json.loads(base64.urlsafe_b64decode(body + "=" * (-len(body) % 4)))
+    except Exception:
+        return None
+    u = _read(path).get("users", {}).get(username)
+    if exp < time.time() or not u or not u.get("active", True) or _fingerprint(u) != fp:
+        return None
+    return {"username": username, "role": u.get("role", "user"), "token": token}
+
 # --- Streamlit helpers (UI access control) ---
 
+def session_auth():
+    """Login of the current session, checked through its token; a revoked one is cleared."""
+    import streamlit as st
+    auth = st.session_state.get("auth")
+    if not auth:
+        return None
+    checked = verify_token(auth.get("token", ""))
+    st.session_state["auth"] = checked   # papel atualizado a cada execução
+    return checked
+
 def require_admin():
     """Stop execution if current session is not admin."""
     try:
         import streamlit as st
     except Exception:
         return
-    auth = st.session_state.get('auth')
+    auth = session_auth()
     if not auth or auth.get('role') != 'admin':
         st.error('Acesso restrito: apenas ADMIN.')
         st.stop()
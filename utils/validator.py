@@ -1,10 +1,24 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from typing import Mapping, Optional
 
 import pandas as pd
 
+from v3_corrector.rules.catalog import categorize, from_catalog, render_messages
+from v3_corrector.rules.registry import RuleProfile, run_rules
+
+from .base_legal import compile_base_legal
+from .instrumentation import instrumented, count_rows
+
+META_COLS = ["chave", "nNF", "serie", "dEmi", "nItem", "cProd", "xProd"]
+FINDING_COLS = ["severidade", "campo", "mensagem", "regra", "base"]
+ITEM_COL = "item"  # posição do item no lote (achados gravados: revalidação incremental)
+# Achados compactos: item + regra (catálogo) + valor; severidade/campo/mensagem/base vêm do
+# catálogo na exibição (colunas de FINDING_COLS presentes e não nulas prevalecem).
+COMPACT_COLS = ["regra", "valor"]
+_OVERRIDES = ["severidade", "campo", "mensagem", "base"]
+
 @dataclass
 class Finding:
     severidade: str  # ERRO / ALERTA
@@ -18,104 +32,108 @@ def _norm_code(x: str) -> str:
     return str(x or "").strip()
 
 
-def validar_itens(df_itens: pd.DataFrame, tables: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+def _validate(df_itens: pd.DataFrame, bl, profile: Optional[RuleProfile]) -> pd.DataFrame:
+    """Compact findings with the item position (_row) kept."""
+    f = run_rules(df_itens, bl, "v2", profile).findings
+    if f.empty:
+        return pd.DataFrame()
+    return compact_v2(f)
+
+
+def compact_v2(f: pd.DataFrame) -> pd.DataFrame:
+    """Compact V2 findings (_row or item, regra, valor and any override), text as category."""
+    if f is None or f.empty:
+        return pd.DataFrame()
+    cols = [c for c in ("_row", ITEM_COL) if c in f.columns]
+    cols += COMPACT_COLS + [c for c in _OVERRIDES if c in f.columns]
+    out = f.reindex(columns=cols)
+    if ITEM_COL in out.columns:
+        out[ITEM_COL] = out[ITEM_COL].astype("int32")
+    out["valor"] = out["valor"].astype(object).fillna("")
+    return categorize(out, COMPACT_COLS + _OVERRIDES)
+
+
+def expand_v2(compact: pd.DataFrame, df_itens: pd.DataFrame, item_ref: bool = False) -> pd.DataFrame:
+    """Readable V2 findings (META_COLS + FINDING_COLS) from the compact form, same index and order.
+
+    df_itens is the batch the `item` positions refer to; item_ref keeps `item`.
+    """
+    if compact is None or compact.empty:
+        return pd.DataFrame()
+    rows = compact[ITEM_COL if ITEM_COL in compact.columns else "_row"].to_numpy(dtype="int64")
+    meta = df_itens.reindex(columns=META_COLS, fill_value="").iloc[rows]
+    out = pd.DataFrame({c: meta[c].map(_norm_code).to_numpy() for c in META_COLS}, index=compact.index)
+    regra = compact["regra"]
+    out["severidade"] = from_catalog(regra, "severidade", compact.get("severidade"))
+    out["campo"] = from_catalog(regra, "campo", compact.get("campo"))
+    out["mensagem"] = render_messages(regra, compact["valor"], compact.get("mensagem"))
+    out["regra"] = regra.astype(object).to_numpy()
+    out["base"] = from_catalog(regra, "base", compact.get("base"))
+    if item_ref:
+        out[ITEM_COL] = rows
+    return out
+
+
+def is_compact_v2(df: Optional[pd.DataFrame]) -> bool:
+    """Stored findings in the compact form (results saved before it carry the full text)."""
+    return df is None or df.empty or ({ITEM_COL, "valor"}.issubset(df.columns) and "chave" not in df.columns)
+
+
+@instrumented("validar_itens", count=count_rows)
+def validar_itens(
+    df_itens: pd.DataFrame,
+    tables: Mapping[str, pd.DataFrame],
+    profile: Optional[RuleProfile] = None,
+    item_ref: bool = False,
+    compact: bool = False,
+) -> pd.DataFrame:
     """
     Valida itens do XML contra a base legal (tabelas) e também checks de formato.
     Retorna um dataframe de achados (0..n linhas).
+    item_ref=True mantém a coluna `item` (posição do item em df_itens).
+    compact=True devolve os achados compactos (item, regra, valor); expand_v2 monta o texto.
     """
-    findings: List[Dict[str, str]] = []
 
     # Se ainda não há itens processados (ex.: após login, antes do upload/processamento do XML),
     # evite exceções e retorne um dataframe vazio.
     if df_itens is None:
-        return pd.DataFrame(columns=["chave","nNF","serie","dEmi","nItem","cProd","xProd","severidade","campo","mensagem","regra","base"])
-
-    ncm_tbl = tables.get("ncm", pd.DataFrame()).copy()
-    cfop_tbl = tables.get("cfop", pd.DataFrame()).copy()
-    cst_tbl = tables.get("cst", pd.DataFrame()).copy()
-
-    # Build lookup sets
-    ncm_set = set()
-    if not ncm_tbl.empty and "ncm" in ncm_tbl.columns:
-        ncm_set = set(ncm_tbl["ncm"].astype(str).str.replace(r"\D", "", regex=True).str.zfill(8))
-
-    cfop_set = set()
-    if not cfop_tbl.empty and "cfop" in cfop_tbl.columns:
-        cfop_set = set(cfop_tbl["cfop"].astype(str).str.replace(r"\D", "", regex=True).str.zfill(4))
-
-    cst_set = set()
-    csosn_set = set()
-    if not cst_tbl.empty and {"codigo","tipo"}.issubset(set(cst_tbl.columns)):
-        tmp = cst_tbl.copy()
-        tmp["tipo"] = tmp["tipo"].astype(str).str.upper().str.strip()
-        tmp["codigo"] = tmp["codigo"].astype(str).str.strip()
-        cst_set = set(tmp.loc[tmp["tipo"]=="CST","codigo"])
-        csosn_set = set(tmp.loc[tmp["tipo"]=="CSOSN","codigo"])
-
-    # Ensure expected cols exist
-    for col in ["NCM","CFOP","CST_ICMS","CSOSN","xProd","cProd","nItem","chave","nNF","serie","dEmi"]:
-        if col not in df_itens.columns:
-            df_itens[col] = ""
-
-    for idx, r in df_itens.iterrows():
-        ncm = _norm_code(r.get("NCM",""))
-        cfop = _norm_code(r.get("CFOP",""))
-        cst = _norm_code(r.get("CST_ICMS",""))
-        csosn = _norm_code(r.get("CSOSN",""))
-
-        meta = {
-            "chave": _norm_code(r.get("chave","")),
-            "nNF": _norm_code(r.get("nNF","")),
-            "serie": _norm_code(r.get("serie","")),
-            "dEmi": _norm_code(r.get("dEmi","")),
-            "nItem": _norm_code(r.get("nItem","")),
-            "cProd": _norm_code(r.get("cProd","")),
-            "xProd": _norm_code(r.get("xProd","")),
-        }
-
-        def add(severidade, campo, mensagem, regra="", base=""):
-            row = dict(meta)
-            row.update({
-                "severidade": severidade,
-                "campo": campo,
-                "mensagem": mensagem,
-                "regra": regra,
-                "base": base,
-            })
-            findings.append(row)
-
-        # Basic format validations
-        ncm_digits = "".join([c for c in ncm if c.isdigit()])
-        if ncm_digits and len(ncm_digits) != 8:
-            add("ALERTA", "NCM", f"NCM com tamanho incomum ({len(ncm_digits)} dígitos): {ncm}", regra="FORMATO_NCM")
-        if ncm_digits == "" or ncm_digits == "00000000":
-            add("ALERTA", "NCM", f"NCM ausente ou zerado: {ncm or '(vazio)'}", regra="NCM_AUSENTE_OU_ZERADO")
-
-        cfop_digits = "".join([c for c in cfop if c.isdigit()])
-        if cfop_digits and len(cfop_digits) != 4:
-            add("ALERTA", "CFOP", f"CFOP com tamanho incomum ({len(cfop_digits)} dígitos): {cfop}", regra="FORMATO_CFOP")
-        if cfop_digits == "":
-            add("ALERTA", "CFOP", "CFOP ausente", regra="CFOP_AUSENTE")
-
-        # CST/CSOSN presence
-        if csosn:
-            if csosn_set and csosn not in csosn_set:
-                add("ERRO", "CSOSN", f"CSOSN '{csosn}' não encontrado na base.", regra="CSOSN_NAO_ENCONTRADO", base="cst_csosn_regras.xlsx")
-        elif cst:
-            if cst_set and cst not in cst_set:
-                add("ERRO", "CST", f"CST '{cst}' não encontrado na base.", regra="CST_NAO_ENCONTRADO", base="cst_csosn_regras.xlsx")
-        else:
-            add("ALERTA", "CST/CSOSN", "CST/CSOSN ausente no item", regra="CST_CSOSN_AUSENTE")
-
-        # Cross checks with base tables (existence)
-        if ncm_set and ncm_digits:
-            ncm_norm = ncm_digits.zfill(8)
-            if ncm_norm not in ncm_set:
-                add("ERRO", "NCM", f"NCM '{ncm_norm}' não encontrado na base.", regra="NCM_NAO_ENCONTRADO", base="ncm_regras.xlsx")
-
-        if cfop_set and cfop_digits:
-            cfop_norm = cfop_digits.zfill(4)
-            if cfop_norm not in cfop_set:
-                add("ERRO", "CFOP", f"CFOP '{cfop_norm}' não encontrado na base.", regra="CFOP_NAO_ENCONTRADO", base="cfop_regras.xlsx")
-
-    return pd.DataFrame(findings)
+        return pd.DataFrame(columns=META_COLS + FINDING_COLS)
+
+    # Regras V2 em lote (v3_corrector/rules/v2_checks.py), filtradas pelo perfil do cliente
+    out = _validate(df_itens, compile_base_legal(tables), profile)
+    return _finish(out, df_itens, item_ref, compact)
+
+
+def _finish(out: pd.DataFrame, df_itens: pd.DataFrame, item_ref: bool, compact: bool = True) -> pd.DataFrame:
+    out = compact_v2(out.rename(columns={"_row": ITEM_COL}))
+    return out if compact else expand_v2(out, df_itens, item_ref=item_ref)
+
+
+@instrumented("validar_itens_por_vigencia", count=count_rows)
+def validar_itens_por_vigencia(
+    df_itens: pd.DataFrame,
+    profile: Optional[RuleProfile] = None,
+    item_ref: bool = False,
+    compact: bool = False,
+) -> pd.DataFrame:
+    """
+    Como validar_itens, mas cada item contra a Base Legal vigente no dhEmi da NF-e
+    (utils.base_legal_history). Achados na mesma ordem de validar_itens.
+    """
+    from .base_legal_history import split_by_vigencia
+
+    if df_itens is None:
+        return pd.DataFrame(columns=META_COLS + FINDING_COLS)
+    groups = split_by_vigencia(df_itens)
+    if len(groups) == 1:
+        return validar_itens(df_itens, groups[0][0], profile=profile, item_ref=item_ref, compact=compact)
+    parts = []
+    for bl, pos in groups:
+        f = _validate(df_itens.iloc[pos], bl, profile)
+        if not f.empty:
+            f["_row"] = pos[f["_row"].to_numpy()]
+            parts.append(f)
+    if not parts:
+        return pd.DataFrame()
+    out = pd.concat(parts, ignore_index=True).sort_values("_row", kind="mergesort")
+    return _finish(out.reset_index(drop=True), df_itens, item_ref, compact)
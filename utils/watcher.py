@@ -0,0 +1,388 @@
+"""Watch-folder ingestion: python -m utils.watcher ENTRADA SAIDA [opções]
+
+The ERP drops XMLs (or ZIPs of XMLs) into ENTRADA. The daemon polls it,
+groups new files into batches (--lote arquivos or --janela segundos, whichever
+comes first), runs each batch on a worker pool (utils.batch: parse -> V2 ->
+V3) and writes its outputs to SAIDA/<lote>/:
+
+    itens, itens_corrigido, cabecalho, achados_v2, achados_v3, erros (.parquet)
+    xmls_corrigidos.zip   com --aplicar
+    lote.json             resumo: arquivos, itens, erros de leitura, Base Legal
+
+A file is taken only after its size and mtime stay unchanged for --estavel
+seconds (the ERP may still be writing it). Processed files are recorded in
+SAIDA/checkpoint.sqlite (caminho, tamanho, mtime, sha256, lote) once the
+batch folder is in place, so a restart resumes without reprocessing; a file
+rewritten with the same content (sha256) is not processed again. Batches that
+failed are recorded too and retried only with --retentar-falhas.
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import signal
+import sqlite3
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+log = logging.getLogger("nfe.watcher")
+
+EXTENSIONS = (".xml", ".zip")
+CHECKPOINT_NAME = "checkpoint.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS arquivos (
+    caminho TEXT PRIMARY KEY, tamanho INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL, lote TEXT NOT NULL, estado TEXT NOT NULL, processado_em TEXT NOT NULL
+);
+"""
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@dataclass(frozen=True)
+class FileRef:
+    caminho: str        # relativo a ENTRADA
+    tamanho: int
+    mtime_ns: int
+    sha256: str = ""
+
+
+class Checkpoint:
+    """Processed files (SQLite, WAL); kept in memory after the first load."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as con:
+            rows = con.execute("SELECT caminho, tamanho, mtime_ns, sha256, estado FROM arquivos").fetchall()
+        self.files: Dict[str, Tuple[int, int, str, str]] = {r[0]: tuple(r[1:]) for r in rows}
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(str(self.path), timeout=30)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.executescript(_SCHEMA)
+        return con
+
+    def record(self, refs: List[FileRef], lote: str, estado: str = "ok") -> None:
+        now = datetime.now().isoformat(timespec="seconds")
+        with closing(self._connect()) as con, con:
+            con.executemany(
+                "INSERT OR REPLACE INTO arquivos VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(r.caminho, r.tamanho, r.mtime_ns, r.sha256, lote, estado, now) for r in refs],
+            )
+        for r in refs:
+            self.files[r.caminho] = (r.tamanho, r.mtime_ns, r.sha256, estado)
+
+    def touch(self, ref: FileRef) -> None:
+        """Same content under a new size/mtime stamp (file rewritten by the ERP)."""
+        with closing(self._connect()) as con, con:
+            con.execute("UPDATE arquivos SET tamanho = ?, mtime_ns = ? WHERE caminho = ?",
+                        (ref.tamanho, ref.mtime_ns, ref.caminho))
+        old = self.files[ref.caminho]
+        self.files[ref.caminho] = (ref.tamanho, ref.mtime_ns, old[2], old[3])
+
+    def forget_failures(self) -> int:
+        with closing(self._connect()) as con, con:
+            n = con.execute("DELETE FROM arquivos WHERE estado != 'ok'").rowcount
+        self.files = {k: v for k, v in self.files.items() if v[3] == "ok"}
+        return n
+
+
+# ---------------------------------------------------------------------------
+# Worker (processo do pool)
+# ---------------------------------------------------------------------------
+
+def _read_inputs(entrada: Path, refs: List[FileRef]) -> Tuple[List[Tuple[str, bytes]], List[FileRef], List[Tuple[str, str]]]:
+    """XML payloads of the batch + the refs as actually read (sha256 of the bytes processed)."""
+    files, read, errors = [], [], []
+    for ref in refs:
+        p = entrada / ref.caminho
+        try:
+            data = p.read_bytes()
+        except OSError as e:
+            errors.append((ref.caminho, f"não foi possível ler: {e}"))
+            continue
+        read.append(FileRef(ref.caminho, len(data), ref.mtime_ns, hashlib.sha256(data).hexdigest()))
+        if ref.caminho.lower().endswith(".zip"):
+            try:
+                with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                    files.extend((f"{ref.caminho}/{zi.filename}", zf.read(zi))
+                                 for zi in zf.infolist() if zi.filename.lower().endswith(".xml"))
+            except zipfile.BadZipFile as e:
+                errors.append((ref.caminho, f"ZIP inválido: {e}"))
+        else:
+            files.append((ref.caminho, data))
+    return files, read, errors
+
+
+def process_batch(lote: str, entrada: str, saida: str, refs: List[FileRef], options: Dict[str, Any]) -> Dict[str, Any]:
+    """Process one batch into SAIDA/<lote>/ (written aside and renamed when complete)."""
+    import pandas as pd
+
+    from .batch import process_files, rewrite_files
+    from .columnar_export import write_columnar
+
+    entrada_p, saida_p = Path(entrada), Path(saida)
+    files, read, read_errors = _read_inputs(entrada_p, refs)
+    res = process_files(files, options)
+    if read_errors:
+        res.erros = pd.concat([res.erros, pd.DataFrame(read_errors, columns=["arquivo", "erro"])], ignore_index=True)
+
+    tmp = saida_p / f".{lote}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    write_columnar(res.tables(), tmp, fmt="parquet")
+    if options.get("aplicar_correcao_v3"):
+        with zipfile.ZipFile(tmp / "xmls_corrigidos.zip", "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, payload in rewrite_files(files, res.itens, res.itens_corrigido):
+                zf.writestr(name, payload)
+    resumo = {
+        "lote": lote, "concluido_em": datetime.now().isoformat(timespec="seconds"),
+        "arquivos": [r.caminho for r in read], "documentos": len(res.cabecalho),
+        "itens": len(res.itens), "erros": len(res.erros), "opcoes": options,
+        "base_legal": [list(v) for v in res.base_legal],
+    }
+    (tmp / "lote.json").write_text(json.dumps(resumo, ensure_ascii=False, indent=2), encoding="utf-8")
+    final = saida_p / lote
+    shutil.rmtree(final, ignore_errors=True)
+    tmp.replace(final)
+    return {"lote": lote, "refs": read, "itens": len(res.itens), "erros": len(res.erros)}
+
+
+# ---------------------------------------------------------------------------
+# Daemon
+# ---------------------------------------------------------------------------
+
+@dataclass
+class _Seen:
+    tamanho: int
+    mtime_ns: int
+    desde: float        # monotonic em que o arquivo foi visto com este tamanho/mtime
+
+
+@dataclass
+class _Running:
+    refs: List[FileRef]
+    future: Future
+
+
+class FolderWatcher:
+    """Polls `entrada`, batches stable new files and processes them on a worker pool."""
+
+    def __init__(self, entrada, saida, lote: int = 500, janela: float = 30.0, estavel: float = 2.0,
+                 intervalo: float = 1.0, workers: Optional[int] = None, options: Optional[Dict[str, Any]] = None):
+        from .jobs import max_workers
+
+        self.entrada = Path(entrada).resolve()
+        self.saida = Path(saida).resolve()
+        self.lote = max(1, lote)
+        self.janela = janela
+        self.estavel = estavel
+        self.intervalo = intervalo
+        self.workers = workers or max_workers()
+        self.options = dict(options or {})
+        self.checkpoint = Checkpoint(self.saida / CHECKPOINT_NAME)
+        self._seen: Dict[str, _Seen] = {}
+        self._pending: List[FileRef] = []
+        self._pending_since = 0.0
+        self._running: Dict[str, _Running] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._seq = 0
+        self._stop = threading.Event()
+
+    # -- descoberta ----------------------------------------------------------
+
+    def _busy(self) -> set:
+        busy = {r.caminho for r in self._pending}
+        for run in self._running.values():
+            busy.update(r.caminho for r in run.refs)
+        return busy
+
+    def scan(self) -> int:
+        """Move stable new files into the pending batch; returns how many were added."""
+        now_m, now_w = time.monotonic(), time.time_ns()
+        busy = self._busy()
+        present = set()
+        added = 0
+        for dirpath, dirnames, filenames in os.walk(self.entrada):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for fname in filenames:
+                if fname.startswith(".") or not fname.lower().endswith(EXTENSIONS):
+                    continue
+                p = Path(dirpath) / fname
+                rel = p.relative_to(self.entrada).as_posix()
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                present.add(rel)
+                if rel in busy:
+                    continue
+                done = self.checkpoint.files.get(rel)
+                if done is not None and done[:2] == (st.st_size, st.st_mtime_ns):
+                    continue
+                seen = self._seen.get(rel)
+                if seen is None or (seen.tamanho, seen.mtime_ns) != (st.st_size, st.st_mtime_ns):
+                    self._seen[rel] = _Seen(st.st_size, st.st_mtime_ns, now_m)
+                    if self.estavel > 0:
+                        continue
+                elif now_m - seen.desde < self.estavel or (now_w - st.st_mtime_ns) / 1e9 < self.estavel:
+                    continue
+                ref = FileRef(rel, st.st_size, st.st_mtime_ns, _sha256(p))
+                self._seen.pop(rel, None)
+                if done is not None and done[2] == ref.sha256:
+                    # regravado com o mesmo conteúdo: só atualiza o checkpoint
+                    self.checkpoint.touch(ref)
+                    continue
+                if not self._pending:
+                    self._pending_since = now_m
+                self._pending.append(ref)
+                added += 1
+        self._seen = {k: v for k, v in self._seen.items() if k in present}
+        return added
+
+    # -- lotes ---------------------------------------------------------------
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            from .batch import init_worker
+            from .jobs import mp_context
+
+            # recriado após BrokenProcessPool com threads vivas: forkserver/spawn, não fork
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                             mp_context=mp_context())
+        return self._pool
+
+    def _next_id(self) -> str:
+        self._seq += 1
+        return f"{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}_{self._seq:04d}"
+
+    def flush(self, force: bool = False) -> int:
+        """Submit full batches (or the partial one after `janela`); returns batches submitted."""
+        n = 0
+        # contrapressão: no máximo 2 lotes por worker em andamento; o resto espera na pasta
+        while self._pending and len(self._running) < 2 * self.workers:
+            full = len(self._pending) >= self.lote
+            expired = time.monotonic() - self._pending_since >= self.janela
+            if not (full or expired or force):
+                break
+            refs, self._pending = self._pending[:self.lote], self._pending[self.lote:]
+            self._pending_since = time.monotonic()
+            lote = self._next_id()
+            fut = self.pool().submit(process_batch, lote, str(self.entrada), str(self.saida), refs, self.options)
+            self._running[lote] = _Running(refs, fut)
+            log.info("lote %s: %d arquivo(s) enviados", lote, len(refs))
+            n += 1
+        return n
+
+    def collect(self) -> int:
+        """Record finished batches in the checkpoint; returns how many finished."""
+        finished = [lote for lote, run in self._running.items() if run.future.done()]
+        for lote in finished:
+            run = self._running.pop(lote)
+            try:
+                out = run.future.result()
+            except Exception as e:
+                # falha do lote inteiro (OOM, worker morto): registrada para não repetir em laço
+                log.error("lote %s falhou: %s: %s", lote, type(e).__name__, e)
+                self.checkpoint.record(run.refs, lote, "falha")
+                if isinstance(e, BrokenProcessPool) and self._pool is not None:
+                    self._pool.shutdown(wait=False, cancel_futures=True)
+                    self._pool = None
+                continue
+            self.checkpoint.record(out["refs"], lote)
+            log.info("lote %s concluído: %d item(ns), %d erro(s) de leitura", lote, out["itens"], out["erros"])
+        return len(finished)
+
+    def step(self, force: bool = False) -> None:
+        self.collect()
+        self.scan()
+        self.flush(force=force)
+
+    def idle(self) -> bool:
+        return not self._pending and not self._running and not self._seen
+
+    def run(self, once: bool = False) -> None:
+        """Poll until stop() (once=True: until the files present now are processed)."""
+        log.info("observando %s -> %s (lote %d, janela %gs, %d worker(s))",
+                 self.entrada, self.saida, self.lote, self.janela, self.workers)
+        try:
+            while not self._stop.is_set():
+                self.step(force=once)
+                if once and self.idle():
+                    break
+                self._stop.wait(self.intervalo)
+        finally:
+            self.close()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def close(self) -> None:
+        """Wait for the batches in progress (their files get recorded) and stop the pool."""
+        while self._running:
+            time.sleep(0.1)
+            self.collect()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Ingestão contínua de XMLs de NF-e a partir de uma pasta")
+    ap.add_argument("entrada", help="pasta observada (XML ou ZIP)")
+    ap.add_argument("saida", help="pasta de saída (um subdiretório por lote + checkpoint.sqlite)")
+    ap.add_argument("--lote", type=int, default=500, help="arquivos por lote")
+    ap.add_argument("--janela", type=float, default=30.0, help="segundos até fechar um lote incompleto")
+    ap.add_argument("--estavel", type=float, default=2.0, help="segundos sem mudança para considerar o arquivo pronto")
+    ap.add_argument("--intervalo", type=float, default=1.0, help="segundos entre varreduras")
+    ap.add_argument("--workers", type=int, default=None, help="processos worker (padrão: NFE_JOB_WORKERS)")
+    ap.add_argument("--aplicar", action="store_true", help="aplicar correções automáticas (V3) e gerar XMLs corrigidos")
+    ap.add_argument("--perfil", default=None, help="perfil de regras")
+    ap.add_argument("--motor-ncm", default=None)
+    ap.add_argument("--vigencia", action="store_true", help="Base Legal vigente no dhEmi de cada NF-e")
+    ap.add_argument("--sem-validacao", action="store_true", help="somente leitura (sem V2/V3)")
+    ap.add_argument("--retentar-falhas", action="store_true", help="reprocessar arquivos de lotes que falharam")
+    ap.add_argument("--uma-vez", action="store_true", help="processar o que está na pasta e sair")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    watcher = FolderWatcher(
+        args.entrada, args.saida, lote=args.lote, janela=args.janela, estavel=args.estavel,
+        intervalo=args.intervalo, workers=args.workers,
+        options={
+            "executar_validacao": not args.sem_validacao, "aplicar_correcao_v3": args.aplicar,
+            "ncm_engine": args.motor_ncm, "perfil_regras": args.perfil, "por_vigencia": args.vigencia,
+        },
+    )
+    if args.retentar_falhas:
+        log.info("%d arquivo(s) de lotes com falha voltam para a fila", watcher.checkpoint.forget_failures())
+    signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+    try:
+        watcher.run(once=args.uma_vez)
+    except KeyboardInterrupt:
+        watcher.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
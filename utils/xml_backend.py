@@ -0,0 +1,98 @@
+from __future__ import annotations
+import os
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+from importlib import import_module
+from typing import Any, Dict, Optional
+
+# Backend selection: NFE_XML_BACKEND = auto | lxml | etree
+# - auto: lxml when installed, ElementTree otherwise
+BACKEND_ENV = "NFE_XML_BACKEND"
+
+_LOCAL_NAMES: Dict[str, str] = {}
+
+
+def local_name(tag: Any) -> str:
+    """'{ns}det' -> 'det' (memoized; NF-e uses a handful of distinct tags)."""
+    try:
+        return _LOCAL_NAMES[tag]
+    except KeyError:
+        pass
+    except TypeError:
+        return ""  # lxml comments / processing instructions
+    if not isinstance(tag, str):
+        return ""
+    name = tag.split("}", 1)[-1] if "}" in tag else tag
+    if len(_LOCAL_NAMES) < 10_000:
+        _LOCAL_NAMES[tag] = name
+    return name
+
+
+class EtreeBackend:
+    """Standard library xml.etree.ElementTree."""
+    name = "etree"
+
+    def fromstring(self, xml_bytes: bytes):
+        return ET.fromstring(xml_bytes)
+
+    def tostring(self, root) -> bytes:
+        return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+
+    def find_first(self, root, tag: str):
+        """First element (document order) whose local name is `tag`."""
+        for el in root.iter():
+            if local_name(el.tag) == tag:
+                return el
+        return None
+
+
+class LxmlBackend:
+    """lxml.etree: C parser, namespace-wildcard iteration (libxml2 size limits kept)."""
+    name = "lxml"
+
+    def __init__(self):
+        from lxml import etree  # optional dependency
+        self._etree = etree
+        self._parser = etree.XMLParser(
+            remove_comments=True,
+            remove_pis=True,
+            resolve_entities=False,
+            no_network=True,
+        )
+
+    def fromstring(self, xml_bytes: bytes):
+        return self._etree.fromstring(xml_bytes, self._parser)
+
+    def tostring(self, root) -> bytes:
+        return self._etree.tostring(root, encoding="utf-8", xml_declaration=True)
+
+    def find_first(self, root, tag: str):
+        for el in root.iter("{*}" + tag):
+            return el
+        return None
+
+
+def lxml_available() -> bool:
+    try:
+        import_module("lxml.etree")
+    except ImportError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=4)
+def _make_backend(name: str):
+    if name == "lxml" or (name == "auto" and lxml_available()):
+        try:
+            return LxmlBackend()
+        except ImportError:
+            pass  # lxml pedido mas não instalado: cai para ElementTree
+    return EtreeBackend()
+
+
+def get_backend(name: Optional[str] = None):
+    """Return the XML backend for `name` (or the NFE_XML_BACKEND setting)."""
+    name = (name or os.environ.get(BACKEND_ENV, "auto") or "auto").strip().lower()
+    if name not in {"auto", "lxml", "etree"}:
+        name = "auto"
+    return _make_backend(name)
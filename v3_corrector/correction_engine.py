@@ -1,41 +1,167 @@
 from __future__ import annotations
-from typing import Dict, List, Tuple, Any
+from typing import Dict, List, Mapping, Optional, Tuple, Any
+import numpy as np
 import pandas as pd
 
-from .finding import FindingV3
+from utils.base_legal import compile_base_legal
+from utils.validator import ITEM_COL
+from utils.instrumentation import instrumented, count_rows
+from utils.product_catalog import CatalogSnapshot
+from .finding import compact_v3, expand_v3
 from .text_utils import digits_only, norm_text
 from .rules.ncm_rules import suggest_ncm_from_description
+from .rules.ncm_similarity import resolve_engine, similarity_index
 from .rules.product_consistency import build_desc_to_ncm_mode
-from .rules.cfop_cst_rules import suggest_cfop_for_st, suggest_cst_for_cfop_st
+from .rules.registry import RuleProfile, run_rules
 
+@instrumented("apply_corrections", count=count_rows)
 def apply_corrections(
     df_itens: pd.DataFrame,
-    tables: Dict[str, pd.DataFrame],
+    tables: Mapping[str, pd.DataFrame],
     auto_apply: bool = False,
+    ncm_engine: Optional[str] = None,
+    catalog: Optional[CatalogSnapshot] = None,
+    profile: Optional[RuleProfile] = None,
+    item_ref: bool = False,
+    compact: bool = False,
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """Return (df_corrigido, df_findings_v3).
     - Sugere correções e, se auto_apply=True, aplica correções seguras por item.
+    - ncm_engine: 'palavras' (padrão) ou 'similaridade' (TF-IDF de n-gramas, em lote);
+      None usa NFE_NCM_ENGINE.
+    - catalog: snapshot do catálogo de produtos (utils.product_catalog); NCM zerado
+      é sugerido primeiro pelo emitente + cProd / descrição já confirmados.
+    - profile: perfil do cliente (regras em lote ativadas/desativadas).
+    - item_ref: mantém a coluna `item` (posição do item em df_itens) nos achados.
+    - compact: achados compactos (item + regra do catálogo, finding.compact_v3);
+      o texto legível sai de expand_v3 na exibição/exportação.
     """
     if df_itens is None or df_itens.empty:
         return df_itens, pd.DataFrame()
+    df, df_find = _apply_corrections(df_itens, compile_base_legal(tables or {}), auto_apply, ncm_engine, catalog, profile)
+    return df, _output(sort_findings(df_find, item_ref=True), item_ref, compact)
 
+
+def _output(df_find: pd.DataFrame, item_ref: bool, compact: bool) -> pd.DataFrame:
+    return df_find if compact else expand_v3(df_find, item_ref=item_ref)
+
+
+@instrumented("apply_corrections_por_vigencia", count=count_rows)
+def apply_corrections_por_vigencia(
+    df_itens: pd.DataFrame,
+    auto_apply: bool = False,
+    ncm_engine: Optional[str] = None,
+    catalog: Optional[CatalogSnapshot] = None,
+    profile: Optional[RuleProfile] = None,
+    item_ref: bool = False,
+    compact: bool = False,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """apply_corrections with each item checked against the Base Legal in force at its dhEmi.
+
+    Items are split by version combination (utils.base_legal_history); the
+    batch-level heuristics (recorrência / divergência de NCM por descrição)
+    still look at the whole batch.
+    """
+    from utils.base_legal_history import split_by_vigencia
+
+    if df_itens is None or df_itens.empty:
+        return df_itens, pd.DataFrame()
+    groups = split_by_vigencia(df_itens)
+    if len(groups) == 1:
+        return apply_corrections(df_itens, groups[0][0], auto_apply, ncm_engine, catalog, profile, item_ref, compact)
+    dfs, finds, order = [], [], []
+    for bl, pos in groups:
+        d, f = _apply_corrections(df_itens.iloc[pos], bl, auto_apply, ncm_engine, catalog, profile, lote=df_itens)
+        dfs.append(d)
+        order.append(pos)
+        if not f.empty:
+            f["_row"] = pos[f["_row"].to_numpy()]
+            finds.append(f)
+    df = pd.concat(dfs).iloc[np.argsort(np.concatenate(order), kind="stable")]
+    df_find = pd.DataFrame()
+    if finds:
+        df_find = compact_v3(pd.concat(finds, ignore_index=True).sort_values(["_row", "_ord"], kind="mergesort"))
+    return df, _output(sort_findings(df_find, item_ref=True), item_ref, compact)
+
+
+def sort_findings(df_find: pd.DataFrame, item_ref: bool = False) -> pd.DataFrame:
+    """Display order: ERRO before ALERTA, then campo (stable, so item order is kept within).
+
+    Expects findings in item order with _row (and _ord); item_ref keeps _row as `item`.
+    """
+    drop = ["_ord"] if item_ref else ["_row", "_ord"]
+    df_find = df_find.drop(columns=drop, errors="ignore").rename(columns={"_row": ITEM_COL}).reset_index(drop=True)
+    if not df_find.empty:
+        sev_order={"ERRO":0,"ALERTA":1}
+        df_find["_o"]=df_find["severidade"].astype(object).map(lambda x: sev_order.get(x,9))
+        df_find["_c"]=df_find["campo"].astype(object)
+        df_find=df_find.sort_values(["_o","_c"]).drop(columns=["_o","_c"])
+    return df_find
+
+
+def _apply_corrections(
+    df_itens: pd.DataFrame,
+    bl,
+    auto_apply: bool,
+    ncm_engine: Optional[str],
+    catalog: Optional[CatalogSnapshot],
+    profile: Optional[RuleProfile],
+    lote: Optional[pd.DataFrame] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """(df_corrigido, achados compactos com _row/_ord, na ordem dos itens).
+
+    lote: itens usados nas heurísticas do lote (padrão: os próprios df_itens).
+    """
     df = df_itens.copy()
-    findings: List[FindingV3] = []
+    lote = df if lote is None else lote
+    findings: List[Tuple[str, str, str, Optional[str], bool]] = []
 
-    ncm_table = (tables or {}).get("ncm", pd.DataFrame())
-    allowed_ncms = set()
-    try:
-        if ncm_table is not None and not ncm_table.empty and 'ncm' in ncm_table.columns:
-            allowed_ncms = {digits_only(x).zfill(8)[:8] for x in ncm_table['ncm'].astype(str).tolist()}
-            # Filtra NCMs inválidos (ex.: começando com '00' ou zerado)
-            allowed_ncms = {n for n in allowed_ncms if n and n != '00000000' and not n.startswith('00')}
-    except Exception:
-        allowed_ncms = set()
-    desc_to_mode = build_desc_to_ncm_mode(df)
+    ncm_table = bl.get("ncm", pd.DataFrame())
+    allowed_ncms = bl.allowed_ncms
+    desc_to_mode = build_desc_to_ncm_mode(lote)
+
+    ncm8_all = df.get("NCM", pd.Series("", index=df.index)).apply(lambda x: digits_only(x).zfill(8)[:8])
+    zero = ncm8_all.isin(["00000000", ""])
+
+    def _ok(code: str) -> bool:
+        return bool(code) and not code.startswith("00") and (not allowed_ncms or code in allowed_ncms)
+
+    # Catálogo de produtos (NCMs confirmados em lotes anteriores): consulta por hash
+    # antes de qualquer pontuação por texto.
+    cat_sug: Dict[Any, Tuple[str, int, str]] = {}
+    if catalog is not None and len(catalog) and zero.any():
+        sub = df.loc[zero]
+        for idx, cnpj, cprod, x in zip(
+            sub.index,
+            sub.get("emit_CNPJ", pd.Series("", index=sub.index)),
+            sub.get("cProd", pd.Series("", index=sub.index)),
+            sub.get("xProd", pd.Series("", index=sub.index)),
+        ):
+            hit = catalog.lookup(cnpj, cprod, norm_text(x))
+            if hit and _ok(hit[0]):
+                cat_sug[idx] = hit
+
+    # Motor "similaridade": as descrições com NCM zerado/vazio (sem acerto no catálogo)
+    # são pontuadas de uma vez (um produto esparso); fica o melhor candidato válido do top-k.
+    engine = resolve_engine(ncm_engine)
+    sim_sug: Dict[str, Tuple[str, float]] = {}
+    if engine == "similaridade" and bl.ncm_index and "xProd" in df.columns:
+        pending = zero & ~df.index.isin(list(cat_sug))
+        zero_descs = pd.unique(df.loc[pending, "xProd"].astype(str))
+        if len(zero_descs):
+            cands = similarity_index(bl.ncm_index).suggest(list(zero_descs))
+            for d, cs in zip(zero_descs, cands):
+                for code, score in cs:
+                    if _ok(code):
+                        sim_sug[d] = (code, score)
+                        break
+
+    # Regras em lote (registry): NCM fora da tabela, matriz CFOP x CST/CSOSN, CST/CSOSN ausente...
+    rule_run = run_rules(df, bl, "v3", profile)
 
     # --- Divergência: mesma descrição com NCMs diferentes no lote (mesmo quando não há recorrência forte)
     try:
-        tmp_div = df.copy()
+        tmp_div = lote.copy()
         tmp_div["_desc_norm"] = tmp_div.get("xProd","").apply(norm_text)
         tmp_div["_ncm8"] = tmp_div.get("NCM","").apply(lambda x: digits_only(x).zfill(8)[:8])
         # mapeia descrição -> conjunto de NCMs distintos (inclui inválidos diferentes de vazio)
@@ -49,50 +175,39 @@ def apply_corrections(
     except Exception:
         desc_to_unique_ncms = {}
 
-    def add(**kwargs):
-        findings.append(FindingV3(**kwargs))
+    # (posição do item, ordem da verificação) de cada achado do laço, para intercalar
+    # com os achados das regras em lote na mesma ordem
+    keys: List[Tuple[int, int]] = []
 
-    for idx, row in df.iterrows():
+    def add(regra, valor_atual, correcao_sugerida="", base_legal=None, aplicado=False):
+        # severidade, campo e textos fixos: catálogo (rules/ncm_rules.py)
+        findings.append((regra, valor_atual, correcao_sugerida, base_legal, aplicado))
+        keys.append((pos, ordem))
+
+    for pos, (idx, row) in enumerate(df.iterrows()):
         desc = row.get("xProd","")
         desc_norm = norm_text(desc)
         ncm_raw = row.get("NCM","")
-        cfop_raw = row.get("CFOP","")
-        cst_raw = row.get("CST_ICMS","") or ""
-        csosn_raw = row.get("CSOSN","") or ""
 
         # --- NCM: 00000000 / vazio
         ncm_digits = digits_only(ncm_raw).zfill(8)[:8]
-        # --- NCM: informado mas não consta na tabela (quando disponível)
-        if allowed_ncms and ncm_digits not in {'00000000',''} and ncm_digits not in allowed_ncms:
-            add(
-                severidade='ERRO',
-                campo='NCM',
-                problema='NCM não consta na Tabela NCM',
-                causa='Código no XML não existe na base legal informada',
-                valor_atual=ncm_digits,
-                correcao_sugerida='',
-                base_legal='Sem correspondência na Tabela NCM (ncm_regras.xlsx)',
-                correcao_automatica=False,
-                aplicado=False,
-            )
+        # (NCM informado fora da Tabela NCM: regra V3_NCM_FORA_DA_TABELA)
 
         # ALERTA: mesma descrição com NCMs diferentes no lote (sem recorrência forte)
+        ordem = 10
         if desc_norm and (desc_norm in desc_to_unique_ncms) and (desc_norm not in desc_to_mode):
-            add(
-                severidade="ALERTA",
-                campo="NCM",
-                problema="Mesma descrição com NCM diferente em itens do lote",
-                causa="Itens com mesma descrição aparecem com NCMs distintos no mesmo processamento",
-                valor_atual=ncm_digits or "",
-                correcao_sugerida="",
-                base_legal="Divergência por comparação no lote (itens do XML)",
-                correcao_automatica=False,
-                aplicado=False,
-            )
+            add("V3_NCM_DIVERGENCIA_LOTE", ncm_digits or "")
+        ordem = 20
         if ncm_digits in {"00000000",""}:
-            sug_table = suggest_ncm_from_description(desc, ncm_table)
+            sug_cat = cat_sug.get(idx)
+            if sug_cat:
+                sug_table, sim_score = None, None
+            elif engine == "similaridade":
+                sug_table, sim_score = sim_sug.get(str(desc), (None, None))
+            else:
+                sug_table, sim_score = suggest_ncm_from_description(desc, ncm_table, index=bl.ncm_index), None
             sug_mode = desc_to_mode.get(desc_norm)
-            sug = sug_table or sug_mode
+            sug = (sug_cat[0] if sug_cat else None) or sug_table or sug_mode
             # Validação: só aceite NCM existente na Tabela NCM (quando disponível)
             if sug:
                 sug8 = digits_only(sug).zfill(8)[:8]
@@ -107,30 +222,27 @@ def apply_corrections(
                     df.at[idx,"NCM"] = sug
                     aplicado = True
                 add(
-                    severidade="ERRO",
-                    campo="NCM",
-                    problema="NCM inválido (00000000) ou ausente",
-                    causa="Cadastro incompleto ou item sem NCM no XML",
-                    valor_atual=ncm_digits or "",
-                    correcao_sugerida=sug,
-                    base_legal=("Tabela NCM (ncm_regras.xlsx)" if sug_table else "Padronização por recorrência (itens do lote)"),
-                    correcao_automatica=True,
+                    "V3_NCM_ZERADO_SUGESTAO",
+                    ncm_digits or "",
+                    sug,
+                    base_legal=(
+                        f"Catálogo de produtos ({'emitente + cProd' if sug_cat[2] == 'codigo' else 'descrição'}, confirmado {sug_cat[1]}x)"
+                        if sug_cat else
+                        (f"Tabela NCM (ncm_regras.xlsx) – similaridade {sim_score:.2f}" if sim_score is not None else "Tabela NCM (ncm_regras.xlsx)")
+                        if sug_table else "Padronização por recorrência (itens do lote)"
+                    ),
                     aplicado=aplicado,
                 )
             else:
                 add(
-                    severidade="ERRO",
-                    campo="NCM",
-                    problema="NCM inválido (00000000) ou ausente",
-                    causa="Cadastro incompleto e não foi possível inferir pela base",
-                    valor_atual=ncm_digits or "",
-                    correcao_sugerida="Preencher NCM correto (manual) / atualizar base NCM",
-                    base_legal=("Tabela NCM (ncm_regras.xlsx)" if sug_table else "Padronização por recorrência (itens do lote)"),
-                    correcao_automatica=False,
-                    aplicado=False,
+                    "V3_NCM_ZERADO_SEM_SUGESTAO",
+                    ncm_digits or "",
+                    "Preencher NCM correto (manual) / atualizar base NCM",
+                    base_legal=("Tabela NCM (ncm_regras.xlsx)" if sug_table else None),
                 )
 
         # --- Mesmo produto com NCM diferente (consistência por descrição)
+        ordem = 30
         if desc_norm and desc_norm in desc_to_mode:
             mode_ncm = desc_to_mode[desc_norm]
             if ncm_digits and ncm_digits != "00000000" and mode_ncm and ncm_digits != mode_ncm:
@@ -138,89 +250,30 @@ def apply_corrections(
                 if auto_apply:
                     df.at[idx,"NCM"] = mode_ncm
                     aplicado = True
-                add(
-                    severidade="ALERTA",
-                    campo="NCM",
-                    problema="Mesma descrição com NCM diferente em outros itens",
-                    causa="Cadastro divergente para o mesmo produto",
-                    valor_atual=ncm_digits,
-                    correcao_sugerida=mode_ncm,
-                    base_legal="Padronização por recorrência (itens do lote)",
-                    correcao_automatica=True,
-                    aplicado=aplicado,
-                )
+                add("V3_NCM_RECORRENCIA", ncm_digits, mode_ncm, aplicado=aplicado)
             else:
                 # Sem correspondência válida na tabela: não sugere automaticamente
-                add(
-                    severidade="ERRO",
-                    campo="NCM",
-                    problema="NCM inválido (00000000) ou ausente",
-                    causa="Cadastro incompleto ou item sem NCM no XML",
-                    valor_atual=ncm_digits or "",
-                    correcao_sugerida="",
-                    base_legal="Sem correspondência na Tabela NCM (ncm_regras.xlsx)",
-                    correcao_automatica=False,
-                    aplicado=False,
-                )
+                add("V3_NCM_SEM_CORRESPONDENCIA", ncm_digits or "")
 
-        # --- CFOP x CST (ICMS) - foco nos casos 5101/5102 com 060/010
-        if cst_raw:
-            sug_cfop, why = suggest_cfop_for_st(cfop_raw, cst_raw)
-            if sug_cfop:
-                aplicado=False
-                if auto_apply:
-                    df.at[idx,"CFOP"] = sug_cfop
-                    aplicado=True
-                add(
-                    severidade="ERRO",
-                    campo="CFOP/CST",
-                    problema="CFOP incompatível com CST informado",
-                    causa=why or "Incompatibilidade CFOP x CST (ST)",
-                    valor_atual=f"CFOP={digits_only(cfop_raw).zfill(4)[:4]} | CST={digits_only(cst_raw).zfill(3)[:3]}",
-                    correcao_sugerida=f"CFOP={sug_cfop} (manter CST={digits_only(cst_raw).zfill(3)[:3]})",
-                    base_legal="Regra operacional (ST) – ajustar CFOP 54xx quando CST 060/010",
-                    correcao_automatica=True,
-                    aplicado=aplicado,
-                )
+        # (CFOP x CST/CSOSN e CST/CSOSN ausente: regras V3_CFOP_CST / V3_CST_CSOSN_AUSENTE)
 
-        # Se CFOP 54xx e CST não ST-related, sugerir CST
-        if cfop_raw:
-            sug_cst, why2 = suggest_cst_for_cfop_st(cfop_raw, cst_raw)
-            if sug_cst:
-                aplicado=False
-                if auto_apply:
-                    df.at[idx,"CST_ICMS"] = sug_cst
-                    aplicado=True
-                add(
-                    severidade="ALERTA",
-                    campo="CST",
-                    problema="CST possivelmente incompatível com CFOP 54xx",
-                    causa=why2 or "Incompatibilidade CFOP 54xx x CST",
-                    valor_atual=f"CFOP={digits_only(cfop_raw).zfill(4)[:4]} | CST={digits_only(cst_raw).zfill(3)[:3] or ''}",
-                    correcao_sugerida=f"CST={sug_cst}",
-                    base_legal="Regra operacional (ST) – CST 060/010 quando CFOP 54xx",
-                    correcao_automatica=True,
-                    aplicado=aplicado,
-                )
+    # Correções das regras em lote (colunares): aplicadas por coluna de uma vez
+    df_rules = rule_run.findings
+    if auto_apply and not df_rules.empty:
+        corr = rule_run.corrections()
+        for col, grp in corr.groupby("corr_coluna", sort=False):
+            df.loc[df.index[grp["_row"].to_numpy()], col] = grp["corr_valor"].to_numpy()
+        df_rules.loc[df_rules["corr_coluna"].fillna("").ne(""), "aplicado"] = True
 
-        # --- CST/CSOSN ausente (sugestão: depende regime, apenas alerta)
-        if not cst_raw and not csosn_raw:
-            add(
-                severidade="ALERTA",
-                campo="CST/CSOSN",
-                problema="CST/CSOSN ausente",
-                causa="Item sem tributação ICMS identificada no XML",
-                valor_atual="",
-                correcao_sugerida="Revisar tributação do item (CST para Regime Normal / CSOSN para Simples)",
-                base_legal="Tabela CST/CSOSN (cst_csosn_regras.xlsx)",
-                correcao_automatica=False,
-                aplicado=False,
-            )
-
-    df_find = pd.DataFrame([f.__dict__ for f in findings])
-    # sort
-    if not df_find.empty:
-        sev_order={"ERRO":0,"ALERTA":1}
-        df_find["_o"]=df_find["severidade"].map(lambda x: sev_order.get(x,9))
-        df_find=df_find.sort_values(["_o","campo"]).drop(columns=["_o"])
-    return df, df_find
+    parts = []
+    if findings:
+        df_loop = pd.DataFrame(findings, columns=["regra", "valor_atual", "correcao_sugerida", "base_legal", "aplicado"])
+        df_loop["_row"] = [k[0] for k in keys]
+        df_loop["_ord"] = [k[1] for k in keys]
+        parts.append(df_loop)
+    if not df_rules.empty:
+        parts.append(df_rules.drop(columns=["corr_coluna", "corr_valor"], errors="ignore"))
+    df_find = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+    if len(parts) > 1:
+        df_find = df_find.sort_values(["_row", "_ord"], kind="mergesort").reset_index(drop=True)
+    return df, compact_v3(df_find)
@@ -1,5 +1,10 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from typing import Optional
+
+import pandas as pd
+
+from .rules.catalog import categorize, from_catalog
 
 @dataclass
 class FindingV3:
@@ -12,3 +17,65 @@ class FindingV3:
     base_legal: str = ""       # referência à tabela/lei (quando aplicável)
     correcao_automatica: bool = False  # se é seguro aplicar automaticamente
     aplicado: bool = False     # se foi aplicado no DF/XML
+
+
+FINDING_FIELDS = tuple(f.name for f in fields(FindingV3))
+
+# Achados V3 compactos: regra (catálogo) + o que varia por achado, texto repetido como category.
+# severidade/campo ficam gravados (a matriz CFOP x CST/CSOSN os define por linha e a exibição
+# ordena por eles); problema/causa/base_legal só quando diferem do catálogo (nulo = catálogo).
+COMPACT_TEXT = ["regra", "severidade", "campo", "valor_atual", "correcao_sugerida"]
+COMPACT_OVERRIDES = ["problema", "causa", "base_legal"]
+_CATALOG_ATTR = {"problema": "texto", "causa": "causa", "base_legal": "base"}
+_REF_COLS = ["_row", "_ord", "item"]
+
+
+def compact_v3(df: pd.DataFrame) -> pd.DataFrame:
+    """Compact V3 findings: fill what the catalog defines, drop what it repeats, categorize."""
+    if df is None or df.empty:
+        return pd.DataFrame()
+    out = pd.DataFrame(index=df.index)
+    for c in _REF_COLS:
+        if c in df.columns:
+            out[c] = df[c].to_numpy()
+    if "item" in out.columns:
+        out["item"] = out["item"].astype("int32")
+    regra = df["regra"].astype(str)
+    out["regra"] = regra
+    for c, attr in (("severidade", "severidade"), ("campo", "campo")):
+        out[c] = from_catalog(regra, attr, df[c] if c in df.columns else None)
+    for c in ("valor_atual", "correcao_sugerida"):
+        out[c] = df[c].astype(object).fillna("").astype(str) if c in df.columns else ""
+    out["correcao_automatica"] = from_catalog(regra, "correcao_automatica", df.get("correcao_automatica")).astype(bool)
+    out["aplicado"] = df["aplicado"].eq(True) if "aplicado" in df.columns else False
+    for c in COMPACT_OVERRIDES:
+        if c in df.columns:
+            out[c] = df[c]
+    return categorize(out, COMPACT_TEXT + COMPACT_OVERRIDES)
+
+
+def expand_v3(compact: pd.DataFrame, item_ref: bool = False) -> pd.DataFrame:
+    """Readable V3 findings (FINDING_FIELDS) from the compact form, same index and order.
+
+    item_ref keeps the `item` column.
+    """
+    if compact is None or compact.empty:
+        return pd.DataFrame()
+    regra = compact["regra"]
+    out = {}
+    for c in FINDING_FIELDS:
+        if c in _CATALOG_ATTR:
+            out[c] = from_catalog(regra, _CATALOG_ATTR[c], compact.get(c))
+        elif c in ("correcao_automatica", "aplicado"):
+            out[c] = compact[c].to_numpy(dtype=bool)
+        else:
+            out[c] = compact[c].astype(object).to_numpy()
+    df = pd.DataFrame(out, index=compact.index)
+    if item_ref and "item" in compact.columns:
+        df["item"] = compact["item"].to_numpy(dtype="int64")
+    return df
+
+
+def is_compact_v3(df: Optional[pd.DataFrame]) -> bool:
+    """Stored findings in the compact form (results saved before it are expanded, without regra)."""
+    return df is None or df.empty or {"item", "regra"}.issubset(df.columns)
@@ -0,0 +1,100 @@
+"""Rule catalog: the fixed text of each kind of finding, kept out of the finding rows.
+
+Findings are stored compact — the item position (`item`), the catalog id
+(`regra`) and only what varies per finding — with the repeated strings as
+categorical columns. The readable columns are rebuilt only for display or
+export (utils.validator.expand_v2 / v3_corrector.finding.expand_v3):
+
+    regra   -> severidade, campo, texto (V2 mensagem / V3 problema), causa, base
+    V2      mensagem = texto.format(valor=..., digitos=...), once per (regra, valor)
+
+A rule whose text comes from data (e.g. the CFOP x CST/CSOSN matrix) fills
+the column itself; a non-null value there overrides the catalog.
+
+    template("FORMATO_NCM", "ALERTA", "NCM", "NCM com tamanho incomum ({digitos} dígitos): {valor}")
+"""
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass(frozen=True)
+class MessageTemplate:
+    regra: str
+    severidade: str
+    campo: str
+    texto: str = ""                 # V2: mensagem (com {valor}/{digitos}); V3: problema
+    causa: str = ""                 # V3
+    base: str = ""                  # V2: base; V3: base_legal
+    correcao_automatica: bool = False
+
+    def render(self, valor: str) -> str:
+        if "{" not in self.texto:
+            return self.texto
+        return self.texto.format(valor=valor, digitos=len(re.sub(r"\D", "", valor)))
+
+
+CATALOG: Dict[str, MessageTemplate] = {}
+_UNKNOWN = MessageTemplate("", "", "")
+
+
+def template(regra: str, severidade: str, campo: str, texto: str = "", causa: str = "", base: str = "",
+             correcao_automatica: bool = False) -> str:
+    """Add a finding template to CATALOG (ids are unique); returns the id."""
+    t = MessageTemplate(regra, severidade, campo, texto, causa, base, correcao_automatica)
+    if CATALOG.get(regra, t) != t:
+        raise ValueError(f"Modelo de achado já registrado: {regra}")
+    CATALOG[regra] = t
+    return regra
+
+
+def get_template(regra: str) -> MessageTemplate:
+    if regra not in CATALOG:
+        from .registry import _load_builtin
+        _load_builtin()
+    return CATALOG.get(regra, _UNKNOWN)
+
+
+def categorize(df: pd.DataFrame, cols: Iterable[str]) -> pd.DataFrame:
+    """Text columns as category, in place (after a concat, categories are unified again)."""
+    for c in cols:
+        if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype("category")
+    return df
+
+
+def _per_regra(regra: pd.Series, fn) -> np.ndarray:
+    """fn(template) for each finding, evaluated once per distinct regra."""
+    r = regra if isinstance(regra.dtype, pd.CategoricalDtype) else regra.astype("category")
+    vals = np.array([fn(get_template(x)) for x in r.cat.categories] + [fn(_UNKNOWN)], dtype=object)
+    codes = r.cat.codes.to_numpy()
+    return vals[np.where(codes < 0, len(vals) - 1, codes)]
+
+
+def from_catalog(regra: pd.Series, attr: str, override: Optional[pd.Series] = None) -> np.ndarray:
+    """Catalog attribute per finding; non-null values of `override` win."""
+    out = _per_regra(regra, lambda t: getattr(t, attr))
+    if override is not None:
+        o = override.to_numpy(dtype=object)
+        out = np.where(pd.notna(o), o, out)
+    return out
+
+
+def render_messages(regra: pd.Series, valor: pd.Series, override: Optional[pd.Series] = None) -> np.ndarray:
+    """Template text with each finding's value (formatted once per distinct (regra, valor))."""
+    if not len(regra):
+        return np.array([], dtype=object)
+    codes, uniq = pd.factorize(pd.MultiIndex.from_arrays([
+        regra.astype(object).to_numpy(), valor.astype(object).fillna("").to_numpy(),
+    ]))
+    texts = np.array([get_template(r).render(str(v)) for r, v in uniq], dtype=object)
+    out = texts[codes]
+    if override is not None:
+        o = override.to_numpy(dtype=object)
+        out = np.where(pd.notna(o), o, out)
+    return out
@@ -1,37 +1,183 @@
 from __future__ import annotations
-from typing import Optional, Tuple
-from ..text_utils import digits_only
-
-def suggest_cfop_for_st(cfop: str, cst: str) -> Tuple[Optional[str], str]:
-    """Rules for common mismatches:
-    - CST 60 (060) indicates ICMS ST already collected. For saída, CFOP should be 54xx (e.g., 5405/5401).
-    - CST 10 (010) indicates tributada com cobrança de ST. CFOP should be 54xx (5401/5403/5405...).
-    Heuristic based on original CFOP:
-      5101 -> own production => suggest 5401
-      5102 -> third-party     => suggest 5405
-    Returns (suggested_cfop, rationale).
-    """
-    cf=digits_only(cfop).zfill(4)[:4]
-    cs=digits_only(cst).zfill(3)[:3]
-    if cs not in {"060","010"}:
-        return None, ""
-    if cf in {"5101","5102"}:
-        if cf=="5101":
-            return "5401", "CST indica ST; CFOP 5101 costuma migrar para 5401 (venda prod. própria sujeita a ST)."
-        return "5405", "CST indica ST; CFOP 5102 costuma migrar para 5405 (venda mercadoria de terceiros sujeita a ST)."
-    return None, ""
-
-def suggest_cst_for_cfop_st(cfop: str, cst: str) -> Tuple[Optional[str], str]:
-    """If CFOP is 54xx but CST isn't ST-related, suggest CST 060 or 010.
-    If cfop 5405/5403 -> suggest 060 (mais comum quando ST já recolhido).
-    If cfop 5401 -> suggest 010 (tributada com ST) as default.
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+
+from .catalog import template
+from .registry import findings_frame, register
+
+# Matriz de compatibilidade CFOP x CST/CSOSN (Base Legal: cfop_cst_regras.xlsx)
+#   cfop, tipo (CST|CSOSN), codigo ('*' = qualquer código sem linha própria),
+#   permitido (SIM|NAO), cfop_sugerido, codigo_sugerido, severidade, justificativa, base_legal
+TIPOS = {"CST": 0, "CSOSN": 1}
+WILDCARD = "*"
+RULE_COLS = ["cfop_sugerido", "codigo_sugerido", "severidade", "justificativa", "base_legal"]
+_NAO = {"NAO", "NÃO", "N", "0", "FALSE", "FALSO"}
+
+_CFOP_54XX = ["5401", "5402", "5403", "5405", "5408", "5409", "5410", "5411", "5412", "5413", "5414", "5415"]
+
+
+def default_rows() -> List[Dict[str, str]]:
+    """Starter matrix: the operational ST rules (5101/5102 x 060/010, 54xx x CST)."""
+    st_cfop = "Regra operacional (ST) – ajustar CFOP 54xx quando CST 060/010"
+    st_cst = "Regra operacional (ST) – CST 060/010 quando CFOP 54xx"
+    rows = []
+    for cst in ("060", "010"):
+        rows.append({"cfop": "5101", "tipo": "CST", "codigo": cst, "permitido": "NAO", "cfop_sugerido": "5401",
+                     "codigo_sugerido": "", "severidade": "ERRO", "base_legal": st_cfop,
+                     "justificativa": "CST indica ST; CFOP 5101 costuma migrar para 5401 (venda prod. própria sujeita a ST)."})
+        rows.append({"cfop": "5102", "tipo": "CST", "codigo": cst, "permitido": "NAO", "cfop_sugerido": "5405",
+                     "codigo_sugerido": "", "severidade": "ERRO", "base_legal": st_cfop,
+                     "justificativa": "CST indica ST; CFOP 5102 costuma migrar para 5405 (venda mercadoria de terceiros sujeita a ST)."})
+    for cfop in _CFOP_54XX:
+        for cst in ("060", "010"):
+            rows.append({"cfop": cfop, "tipo": "CST", "codigo": cst, "permitido": "SIM", "cfop_sugerido": "",
+                         "codigo_sugerido": "", "severidade": "", "base_legal": "", "justificativa": ""})
+        if cfop == "5401":
+            sug, why = "010", "CFOP 5401 indica operação sujeita a ST; sugerido CST 10 (010) por padrão."
+        else:
+            sug, why = "060", "CFOP 54xx indica ST; sugerido CST 60 (060) por padrão (ST já recolhido)."
+        rows.append({"cfop": cfop, "tipo": "CST", "codigo": WILDCARD, "permitido": "NAO", "cfop_sugerido": "",
+                     "codigo_sugerido": sug, "severidade": "ALERTA", "base_legal": st_cst, "justificativa": why})
+    return rows
+
+
+def _digits(s: pd.Series, width: int) -> pd.Series:
+    """digits_only(x).zfill(width)[:width], vectorized ('' stays '')."""
+    d = s.fillna("").astype(str).str.replace(r"\D+", "", regex=True)
+    return d.where(d == "", d.str.zfill(width).str[:width])
+
+
+@dataclass(frozen=True)
+class CfopCstMatrix:
+    """Compiled matrix: integer keys -> rule rows, looked up for a whole batch at once.
+
+    exact: cfop*10000 + tipo*1000 + codigo    wild: cfop*10 + tipo ('*' rows)
+    rules: one row per key (exact rows first, then wildcard rows), RULE_COLS + permitido.
     """
-    cf=digits_only(cfop).zfill(4)[:4]
-    cs=digits_only(cst).zfill(3)[:3]
-    if not cf.startswith("54"):
-        return None, ""
-    if cs in {"060","010"}:
-        return None, ""
-    if cf=="5401":
-        return "010", "CFOP 5401 indica operação sujeita a ST; sugerido CST 10 (010) por padrão."
-    return "060", "CFOP 54xx indica ST; sugerido CST 60 (060) por padrão (ST já recolhido)."
+    exact: pd.Index = field(default_factory=lambda: pd.Index([], dtype="int64"))
+    wild: pd.Index = field(default_factory=lambda: pd.Index([], dtype="int64"))
+    rules: pd.DataFrame = field(default_factory=pd.DataFrame)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    @classmethod
+    def build(cls, tbl: pd.DataFrame) -> "CfopCstMatrix":
+        need = {"cfop", "tipo", "codigo", "permitido"}
+        if tbl is None or tbl.empty or not need.issubset(tbl.columns):
+            return cls()
+        t = tbl.copy()
+        for c in RULE_COLS:
+            if c not in t.columns:
+                t[c] = ""
+            t[c] = t[c].fillna("").astype(str).str.strip()
+        t["_tipo"] = t["tipo"].astype(str).str.upper().str.strip().map(TIPOS)
+        t["_cfop"] = _digits(t["cfop"], 4)
+        cod = t["codigo"].fillna("").astype(str).str.strip()
+        t["_wild"] = cod == WILDCARD
+        t["_cod"] = _digits(cod, 3)
+        t = t[t["_tipo"].notna() & (t["_cfop"] != "") & (t["_wild"] | (t["_cod"] != ""))]
+        t["permitido"] = ~t["permitido"].astype(str).str.upper().str.strip().isin(_NAO)
+        cfop_i = t["_cfop"].astype("int64")
+        tipo_i = t["_tipo"].astype("int64")
+        t["_key"] = np.where(t["_wild"], cfop_i * 10 + tipo_i,
+                             cfop_i * 10000 + tipo_i * 1000 + pd.to_numeric(t["_cod"], errors="coerce").fillna(0).astype("int64"))
+        # a última linha repetida prevalece
+        t = t.drop_duplicates(subset=["_wild", "_key"], keep="last")
+        ex, wi = t[~t["_wild"]], t[t["_wild"]]
+        rules = pd.concat([ex, wi], ignore_index=True)[["permitido"] + RULE_COLS]
+        return cls(exact=pd.Index(ex["_key"].to_numpy()), wild=pd.Index(wi["_key"].to_numpy()), rules=rules)
+
+    def evaluate(self, cfop: pd.Series, cst: pd.Series, csosn: pd.Series) -> pd.DataFrame:
+        """Rules violated by each item (CSOSN has precedence over CST, as in the validator).
+
+        Returns one row per non-allowed item (same index as the inputs) with
+        cfop, tipo, codigo and RULE_COLS.
+        """
+        out_cols = ["cfop", "tipo", "codigo"] + RULE_COLS
+        if not len(self.rules) or cfop is None or not len(cfop):
+            return pd.DataFrame(columns=out_cols)
+        cf = _digits(cfop, 4)
+        cs = _digits(cst, 3)
+        co = _digits(csosn, 3)
+        is_csosn = co != ""
+        code = co.where(is_csosn, cs)
+        valid = (cf != "") & (code != "")
+        cf_i = pd.to_numeric(cf, errors="coerce").fillna(0).astype("int64").to_numpy()
+        tipo_i = is_csosn.astype("int64").to_numpy()
+        code_i = pd.to_numeric(code, errors="coerce").fillna(0).astype("int64").to_numpy()
+
+        pos = self.exact.get_indexer(cf_i * 10000 + tipo_i * 1000 + code_i)
+        wpos = self.wild.get_indexer(cf_i * 10 + tipo_i)
+        rule = np.where(pos >= 0, pos, np.where(wpos >= 0, wpos + len(self.exact), -1))
+        rule = np.where(valid.to_numpy(), rule, -1)
+        hit = rule >= 0
+        if not hit.any():
+            return pd.DataFrame(columns=out_cols)
+        r = self.rules.iloc[rule[hit]].reset_index(drop=True)
+        r.index = cfop.index[hit]
+        keep = ~r["permitido"].to_numpy()
+        r = r[keep]
+        idx = r.index
+        r.insert(0, "codigo", code.loc[idx])
+        r.insert(0, "tipo", np.where(is_csosn.loc[idx], "CSOSN", "CST"))
+        r.insert(0, "cfop", cf.loc[idx])
+        return r[out_cols]
+
+
+_MATRIZ = "Matriz CFOP x CST/CSOSN (cfop_cst_regras.xlsx)"
+# textos da matriz vêm das linhas da planilha (gravados no achado quando diferem do catálogo)
+template("V3_CFOP_CST", "ERRO", "CFOP", "Combinação CFOP x CST/CSOSN não permitida",
+         "Par CFOP x CST/CSOSN marcado como não permitido na matriz", _MATRIZ)
+template("V3_CST_CSOSN_AUSENTE", "ALERTA", "CST/CSOSN", "CST/CSOSN ausente",
+         "Item sem tributação ICMS identificada no XML", "Tabela CST/CSOSN (cst_csosn_regras.xlsx)")
+
+
+@register("V3_CFOP_CST", stage="v3", columns=["CFOP", "CST_ICMS", "CSOSN"], ordem=40)
+def cfop_cst_matriz(batch: pd.DataFrame, bl) -> Optional[pd.DataFrame]:
+    """Pares CFOP x CST/CSOSN não permitidos na matriz da Base Legal (com correção sugerida)."""
+    r = bl.cfop_cst.evaluate(batch["CFOP"], batch["CST_ICMS"], batch["CSOSN"])
+    if r.empty:
+        return None
+    tipo = r["tipo"]
+    has_cfop = r["cfop_sugerido"] != ""
+    has_cod = ~has_cfop & (r["codigo_sugerido"] != "")
+    neither = ~has_cfop & ~has_cod
+    why_default = "Incompatibilidade CFOP x " + tipo
+    out = findings_frame(
+        pd.Series(True, index=r.index),
+        severidade=r["severidade"].where(r["severidade"] != "", np.where(has_cod, "ALERTA", "ERRO")),
+        campo=pd.Series(np.where(has_cod, tipo, "CFOP/" + tipo), index=r.index),
+        problema=pd.Series(np.select(
+            [has_cfop, has_cod],
+            ["CFOP incompatível com " + tipo + " informado", tipo + " possivelmente incompatível com CFOP " + r["cfop"]],
+            "Combinação CFOP x " + tipo + " não permitida",
+        ), index=r.index),
+        causa=r["justificativa"].where(r["justificativa"] != "", np.where(
+            neither, "Par CFOP x " + tipo + " marcado como não permitido na matriz", why_default)),
+        valor_atual="CFOP=" + r["cfop"] + " | " + tipo + "=" + r["codigo"],
+        correcao_sugerida=pd.Series(np.select(
+            [has_cfop, has_cod],
+            ["CFOP=" + r["cfop_sugerido"] + " (manter " + tipo + "=" + r["codigo"] + ")", tipo + "=" + r["codigo_sugerido"]],
+            "Revisar CFOP / tributação do item",
+        ), index=r.index),
+        base_legal=r["base_legal"].where(r["base_legal"] != "", _MATRIZ),
+        correcao_automatica=~neither,
+        corr_coluna=pd.Series(np.select([has_cfop, has_cod & (tipo == "CSOSN"), has_cod], ["CFOP", "CSOSN", "CST_ICMS"], ""), index=r.index),
+        corr_valor=pd.Series(np.select([has_cfop, has_cod], [r["cfop_sugerido"], r["codigo_sugerido"]], ""), index=r.index),
+    )
+    # _row: posição no lote (evaluate devolve o índice do lote, que é 0..n-1)
+    out["_row"] = r.index.to_numpy()
+    return out
+
+
+@register("V3_CST_CSOSN_AUSENTE", stage="v3", columns=["CST_ICMS", "CSOSN"], ordem=50)
+def cst_csosn_ausente(batch: pd.DataFrame, bl) -> pd.DataFrame:
+    """Item sem CST nem CSOSN (apenas alerta: depende do regime)."""
+    return findings_frame(
+        ~batch["CST_ICMS"].astype(bool) & ~batch["CSOSN"].astype(bool),
+        valor_atual="",
+        correcao_sugerida="Revisar tributação do item (CST para Regime Normal / CSOSN para Simples)",
+    )
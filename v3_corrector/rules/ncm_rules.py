@@ -1,11 +1,47 @@
 from __future__ import annotations
-from typing import Optional
+from typing import Optional, Sequence, Tuple
 import pandas as pd
 from ..text_utils import norm_text, digits_only
+from .catalog import template
+from .registry import findings_frame, register
 
-def suggest_ncm_from_description(desc: str, ncm_table: pd.DataFrame) -> Optional[str]:
+# Achados de NCM (regra V3 em lote e verificações por item do correction_engine)
+_NCM_INVALIDO = "NCM inválido (00000000) ou ausente"
+_SEM_CORRESPONDENCIA = "Sem correspondência na Tabela NCM (ncm_regras.xlsx)"
+_RECORRENCIA = "Padronização por recorrência (itens do lote)"
+template("V3_NCM_FORA_DA_TABELA", "ERRO", "NCM", "NCM não consta na Tabela NCM",
+         "Código no XML não existe na base legal informada", _SEM_CORRESPONDENCIA)
+template("V3_NCM_DIVERGENCIA_LOTE", "ALERTA", "NCM", "Mesma descrição com NCM diferente em itens do lote",
+         "Itens com mesma descrição aparecem com NCMs distintos no mesmo processamento",
+         "Divergência por comparação no lote (itens do XML)")
+template("V3_NCM_ZERADO_SUGESTAO", "ERRO", "NCM", _NCM_INVALIDO,
+         "Cadastro incompleto ou item sem NCM no XML", "Tabela NCM (ncm_regras.xlsx)", correcao_automatica=True)
+template("V3_NCM_ZERADO_SEM_SUGESTAO", "ERRO", "NCM", _NCM_INVALIDO,
+         "Cadastro incompleto e não foi possível inferir pela base", _RECORRENCIA)
+template("V3_NCM_RECORRENCIA", "ALERTA", "NCM", "Mesma descrição com NCM diferente em outros itens",
+         "Cadastro divergente para o mesmo produto", _RECORRENCIA, correcao_automatica=True)
+template("V3_NCM_SEM_CORRESPONDENCIA", "ERRO", "NCM", _NCM_INVALIDO,
+         "Cadastro incompleto ou item sem NCM no XML", _SEM_CORRESPONDENCIA)
+
+def build_ncm_text_index(ncm_table: pd.DataFrame) -> Tuple[Tuple[str, str], ...]:
+    """(ncm8, descricao normalizada) per table row, in table order (rows without description skipped)."""
+    if ncm_table is None or ncm_table.empty or "ncm" not in ncm_table.columns or "descricao" not in ncm_table.columns:
+        return ()
+    out = []
+    for ncm, descricao in zip(ncm_table["ncm"].tolist(), ncm_table["descricao"].tolist()):
+        cand_desc = norm_text(descricao)
+        if cand_desc:
+            out.append((digits_only(ncm).zfill(8)[:8], cand_desc))
+    return tuple(out)
+
+def suggest_ncm_from_description(
+    desc: str,
+    ncm_table: pd.DataFrame,
+    index: Optional[Sequence[Tuple[str, str]]] = None,
+) -> Optional[str]:
     """Heuristic: tries to find a NCM by description match against base table.
     Expects columns: ncm, descricao (lowercase normalized in load_tables()).
+    `index` is the precomputed build_ncm_text_index(ncm_table) (Base Legal compilada).
     """
     if ncm_table is None or ncm_table.empty:
         return None
@@ -21,15 +57,26 @@ def suggest_ncm_from_description(desc: str, ncm_table: pd.DataFrame) -> Optional
         tokens = [t for t in desc_norm.split(" ") if len(t) >= 4]
         if not tokens:
             tokens = desc_norm.split(" ")
+        if index is None:
+            index = build_ncm_text_index(ncm_table)
         best = (0, None)
-        for _, row in ncm_table.iterrows():
-            cand_desc = norm_text(row.get("descricao",""))
-            if not cand_desc:
-                continue
+        for ncm, cand_desc in index:
             score = sum(1 for t in tokens if t in cand_desc)
             if score > best[0]:
-                ncm = digits_only(row.get("ncm","")).zfill(8)[:8]
                 best = (score, ncm)
         if best[0] > 0:
             return best[1]
     return None
+
+
+@register("V3_NCM_FORA_DA_TABELA", stage="v3", columns=["NCM"], ordem=0)
+def ncm_fora_da_tabela(batch: pd.DataFrame, bl) -> Optional[pd.DataFrame]:
+    """NCM informado (não zerado) que não existe na Tabela NCM."""
+    if not bl.allowed_ncms:
+        return None
+    ncm8 = batch["NCM"].map(lambda x: digits_only(x).zfill(8)[:8])
+    return findings_frame(
+        (ncm8 != "00000000") & ~ncm8.isin(bl.allowed_ncms),
+        valor_atual=ncm8,
+        correcao_sugerida="",
+    )
@@ -0,0 +1,165 @@
+"""NCM suggestion by char n-gram TF-IDF similarity (engine "similaridade").
+
+The NCM descriptions are vectorized once per Base Legal into a sparse,
+L2-normalized TF-IDF matrix of word-bounded char n-grams; a batch of item
+descriptions is scored with one sparse product (cosine similarity), so
+abbreviations common in xProd ("PARAF SEXT", "REFRIG 2L") still share most
+n-grams with "parafuso sextavado" / "refrigerante".
+
+Needs only NumPy/SciPy (optional dependency); without SciPy the engine
+falls back to the token heuristic in ncm_rules.
+"""
+from __future__ import annotations
+
+import math
+import os
+import warnings
+from dataclasses import dataclass
+from functools import lru_cache
+from importlib import import_module
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ..text_utils import norm_text
+
+ENGINE_ENV = "NFE_NCM_ENGINE"
+ENGINES = {"palavras": "Palavras (padrão)", "similaridade": "Similaridade (n-gramas)"}
+DEFAULT_ENGINE = "palavras"
+
+NGRAM_MIN = 3
+NGRAM_MAX = 4
+MIN_SCORE = 0.30   # cosseno mínimo para sugerir
+TOP_K = 3
+_QUERY_CHUNK = 1024  # linhas de Q @ M.T densificadas por vez
+
+
+def scipy_available() -> bool:
+    try:
+        import_module("scipy.sparse")
+    except ImportError:
+        return False
+    return True
+
+
+def available_engines() -> Dict[str, str]:
+    """Engines this install can run (the UI offers only these)."""
+    return {k: v for k, v in ENGINES.items() if k != "similaridade" or scipy_available()}
+
+
+def default_engine() -> str:
+    """Engine from NFE_NCM_ENGINE for the UI: an unknown value warns and falls back to the default."""
+    try:
+        return resolve_engine()
+    except ValueError as e:
+        warnings.warn(f"{e}; usando '{DEFAULT_ENGINE}'.", RuntimeWarning, stacklevel=2)
+        return DEFAULT_ENGINE
+
+
+def resolve_engine(name: Optional[str] = None) -> str:
+    """Engine name from argument or NFE_NCM_ENGINE; 'similaridade' needs SciPy."""
+    name = (name or os.environ.get(ENGINE_ENV, "") or DEFAULT_ENGINE).strip().lower()
+    if name not in ENGINES:
+        raise ValueError(f"Motor de sugestão NCM desconhecido: {name}")
+    if name == "similaridade" and not scipy_available():
+        return DEFAULT_ENGINE
+    return name
+
+
+def _ngrams(text: str) -> Dict[str, int]:
+    """Char n-gram counts inside word boundaries (' paraf ' -> ' pa', 'par', ...)."""
+    counts: Dict[str, int] = {}
+    for word in text.split():
+        w = f" {word} "
+        for n in range(NGRAM_MIN, NGRAM_MAX + 1):
+            for i in range(len(w) - n + 1):
+                g = w[i:i + n]
+                counts[g] = counts.get(g, 0) + 1
+    return counts
+
+
+def _tfidf_matrix(docs: List[Dict[str, int]], vocab: Dict[str, int], idf: np.ndarray):
+    """CSR (len(docs) x len(vocab)) with sublinear tf * idf, rows L2-normalized."""
+    import scipy.sparse as sp
+
+    indptr = [0]
+    indices: List[int] = []
+    data: List[float] = []
+    for doc in docs:
+        for g, tf in doc.items():
+            j = vocab.get(g)
+            if j is not None:
+                indices.append(j)
+                data.append(1.0 + math.log(tf))
+        indptr.append(len(indices))
+    m = sp.csr_matrix(
+        (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+        shape=(len(docs), len(vocab)),
+    )
+    m = m.multiply(idf).tocsr()
+    norms = np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return (sp.diags(1.0 / norms) @ m).tocsr()
+
+
+@dataclass(frozen=True)
+class NcmSimilarityIndex:
+    codes: np.ndarray          # ncm8 por linha da matriz
+    vocab: Dict[str, int]      # n-grama -> coluna
+    idf: np.ndarray
+    matrix: object             # scipy.sparse.csr_matrix (n_ncm x n_ngramas), linhas L2 = 1
+
+    @classmethod
+    def build(cls, ncm_index: Sequence[Tuple[str, str]]) -> "NcmSimilarityIndex":
+        """Vectorize (ncm8, descrição normalizada) pairs (see build_ncm_text_index)."""
+        codes = np.array([c for c, _ in ncm_index], dtype=object)
+        docs = [_ngrams(d) for _, d in ncm_index]
+        vocab: Dict[str, int] = {}
+        for doc in docs:
+            for g in doc:
+                if g not in vocab:
+                    vocab[g] = len(vocab)
+        df = np.zeros(len(vocab), dtype=np.float64)
+        for doc in docs:
+            for g in doc:
+                df[vocab[g]] += 1
+        n = len(docs)
+        idf = np.log((1.0 + n) / (1.0 + df)) + 1.0
+        return cls(codes=codes, vocab=vocab, idf=idf, matrix=_tfidf_matrix(docs, vocab, idf))
+
+    def top_k(self, descs: Iterable[str], k: int = TOP_K) -> Tuple[np.ndarray, np.ndarray]:
+        """(índices, scores), both (n, k): best NCM rows per description, score desc.
+
+        Descriptions are normalized with norm_text; rows with no known n-gram get score 0.
+        """
+        q = _tfidf_matrix([_ngrams(norm_text(d)) for d in descs], self.vocab, self.idf)
+        n = q.shape[0]
+        k = max(1, min(k, len(self.codes)))
+        out_idx = np.zeros((n, k), dtype=np.int64)
+        out_score = np.zeros((n, k), dtype=np.float64)
+        if n == 0 or len(self.codes) == 0:
+            return out_idx, out_score
+        mt = self.matrix.T  # CSR transposta = CSC, sem cópia
+        for start in range(0, n, _QUERY_CHUNK):
+            s = (q[start:start + _QUERY_CHUNK] @ mt).toarray()
+            part = np.argpartition(-s, k - 1, axis=1)[:, :k] if k < s.shape[1] else np.tile(np.arange(s.shape[1]), (s.shape[0], 1))
+            ps = np.take_along_axis(s, part, axis=1)
+            # ordem: score desc, empate -> linha da tabela (como na heurística por palavras)
+            order = np.lexsort((part, -ps), axis=1)
+            out_idx[start:start + len(s)] = np.take_along_axis(part, order, axis=1)
+            out_score[start:start + len(s)] = np.take_along_axis(ps, order, axis=1)
+        return out_idx, out_score
+
+    def suggest(self, descs: Sequence[str], k: int = TOP_K, min_score: float = MIN_SCORE) -> List[List[Tuple[str, float]]]:
+        """Per description, up to k (ncm8, score) candidates with score >= min_score."""
+        idx, score = self.top_k(descs, k)
+        out: List[List[Tuple[str, float]]] = []
+        for row_i, row_s in zip(idx, score):
+            out.append([(self.codes[i], float(s)) for i, s in zip(row_i, row_s) if s >= min_score])
+        return out
+
+
+@lru_cache(maxsize=2)
+def similarity_index(ncm_index: Tuple[Tuple[str, str], ...]) -> NcmSimilarityIndex:
+    """Index for a Base Legal version (cached: the compiled base keeps the same tuple)."""
+    return NcmSimilarityIndex.build(ncm_index)
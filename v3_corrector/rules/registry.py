@@ -0,0 +1,141 @@
+"""Rule registry: batch (vectorized) checks for V2 validation and V3 correction.
+
+A rule declares the item columns it reads and receives the whole batch at
+once (only those columns, missing ones filled with ""), plus the compiled
+Base Legal. It returns its findings as a DataFrame with one row per finding,
+in the compact form (texts come from the rule catalog, rules/catalog.py):
+
+    _row        posição do item no lote (0..n-1)
+    regra       id do modelo no catálogo (padrão: o id da regra)
+    <valores>   V2: valor; V3: valor_atual, correcao_sugerida (e o que variar por achado)
+    corr_coluna / corr_valor   (V3, opcional) correção a aplicar no item
+
+run_rules() runs the enabled rules (per client profile), merges the results
+in item order and records per-rule timings.
+
+    @register("FORMATO_NCM", stage="v2", columns=["NCM"], ordem=10)
+    def formato_ncm(batch, bl): ...
+"""
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+from importlib import import_module
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils.instrumentation import span
+
+STAGES = ("v2", "v3")
+CORR_COLS = ["corr_coluna", "corr_valor"]
+
+
+@dataclass(frozen=True)
+class Rule:
+    rule_id: str
+    stage: str
+    columns: Tuple[str, ...]
+    fn: Callable[[pd.DataFrame, Any], Optional[pd.DataFrame]]
+    ordem: int = 100          # posição relativa das regras dentro de cada item
+    descricao: str = ""
+    enabled: bool = True      # padrão quando o perfil não diz nada
+
+
+REGISTRY: Dict[str, Rule] = {}
+
+
+def register(rule_id: str, stage: str, columns: Sequence[str], ordem: int = 100,
+             descricao: str = "", enabled: bool = True):
+    """Decorator adding a batch rule to REGISTRY (ids are unique)."""
+    if stage not in STAGES:
+        raise ValueError(f"Etapa de regra inválida: {stage}")
+
+    def deco(fn):
+        if rule_id in REGISTRY and REGISTRY[rule_id].fn is not fn:
+            raise ValueError(f"Regra já registrada: {rule_id}")
+        REGISTRY[rule_id] = Rule(rule_id, stage, tuple(columns), fn, ordem,
+                                 descricao or (fn.__doc__ or "").strip().split("\n")[0], enabled)
+        return fn
+    return deco
+
+
+def _load_builtin() -> None:
+    # módulos com regras embutidas: importar registra as regras (@rule)
+    for mod in ("cfop_cst_rules", "ncm_rules", "v2_checks"):
+        import_module(f".{mod}", __package__)
+
+
+@dataclass(frozen=True)
+class RuleProfile:
+    """Per-client selection: rules switched off (or on, for rules disabled by default)."""
+    nome: str = "padrão"
+    desativadas: FrozenSet[str] = frozenset()
+    ativadas: FrozenSet[str] = frozenset()
+
+    def is_enabled(self, rule: Rule) -> bool:
+        if rule.rule_id in self.desativadas:
+            return False
+        return rule.enabled or rule.rule_id in self.ativadas
+
+
+def list_rules(stage: Optional[str] = None) -> List[Rule]:
+    _load_builtin()
+    return sorted((r for r in REGISTRY.values() if stage is None or r.stage == stage),
+                  key=lambda r: (STAGES.index(r.stage), r.ordem, r.rule_id))
+
+
+def findings_frame(mask: pd.Series, **cols) -> pd.DataFrame:
+    """Findings for the items where `mask` is True; values are scalars or Series aligned with mask."""
+    m = np.asarray(mask, dtype=bool)
+    out = {"_row": np.flatnonzero(m)}
+    for k, v in cols.items():
+        out[k] = np.asarray(v)[m] if isinstance(v, (pd.Series, np.ndarray)) else [v] * int(m.sum())
+    return pd.DataFrame(out)
+
+
+@dataclass
+class RuleRun:
+    findings: pd.DataFrame
+    timings: List[Dict[str, Any]] = field(default_factory=list)
+
+    def corrections(self) -> pd.DataFrame:
+        """(_row, corr_coluna, corr_valor) of the findings that carry a correction."""
+        f = self.findings
+        if f.empty or "corr_coluna" not in f.columns:
+            return pd.DataFrame(columns=["_row"] + CORR_COLS)
+        return f.loc[f["corr_coluna"].fillna("") != "", ["_row"] + CORR_COLS]
+
+
+def run_rules(df: pd.DataFrame, bl: Any, stage: str, profile: Optional[RuleProfile] = None,
+              rules: Optional[Iterable[Rule]] = None) -> RuleRun:
+    """Run the enabled rules of `stage` over the batch and merge their findings.
+
+    Findings come back ordered by item, then rule `ordem`, then the order the
+    rule produced them; helper columns _row and _ord are kept for the caller.
+    """
+    profile = profile or RuleProfile()
+    selected = [r for r in (rules if rules is not None else list_rules(stage)) if profile.is_enabled(r)]
+    parts: List[pd.DataFrame] = []
+    timings: List[Dict[str, Any]] = []
+    n = 0 if df is None else len(df)
+    for rule in selected:
+        batch = df.reindex(columns=list(rule.columns), fill_value="").reset_index(drop=True)
+        t0 = time.perf_counter()
+        with span(f"rule:{rule.rule_id}", items=n) as sp:
+            res = rule.fn(batch, bl)
+            k = 0 if res is None else len(res)
+            sp.set(achados=k)
+        timings.append({"regra": rule.rule_id, "etapa": rule.stage, "segundos": time.perf_counter() - t0, "achados": k})
+        if k:
+            res = res.copy()
+            if "regra" not in res.columns:
+                res["regra"] = rule.rule_id
+            res["_ord"] = rule.ordem
+            parts.append(res)
+    if not parts:
+        return RuleRun(pd.DataFrame(columns=["_row", "_ord"]), timings)
+    out = pd.concat(parts, ignore_index=True)
+    out = out.sort_values(["_row", "_ord"], kind="mergesort").reset_index(drop=True)
+    return RuleRun(out, timings)
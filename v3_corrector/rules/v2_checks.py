@@ -0,0 +1,127 @@
+"""V2 checks (validar_itens): formato e existência de NCM/CFOP/CST/CSOSN na Base Legal.
+
+Each finding carries only its catalog id (regra) and the offending value;
+the message is rendered from the template at display/export time.
+"""
+from __future__ import annotations
+
+import pandas as pd
+
+from .catalog import template
+from .registry import findings_frame, register
+
+# Textos dos achados (catálogo); os achados guardam só regra + valor
+template("FORMATO_NCM", "ALERTA", "NCM", "NCM com tamanho incomum ({digitos} dígitos): {valor}")
+template("NCM_AUSENTE_OU_ZERADO", "ALERTA", "NCM", "NCM ausente ou zerado: {valor}")
+template("FORMATO_CFOP", "ALERTA", "CFOP", "CFOP com tamanho incomum ({digitos} dígitos): {valor}")
+template("CFOP_AUSENTE", "ALERTA", "CFOP", "CFOP ausente")
+template("CSOSN_NAO_ENCONTRADO", "ERRO", "CSOSN", "CSOSN '{valor}' não encontrado na base.", base="cst_csosn_regras.xlsx")
+template("CST_NAO_ENCONTRADO", "ERRO", "CST", "CST '{valor}' não encontrado na base.", base="cst_csosn_regras.xlsx")
+template("CST_CSOSN_AUSENTE", "ALERTA", "CST/CSOSN", "CST/CSOSN ausente no item")
+template("NCM_NAO_ENCONTRADO", "ERRO", "NCM", "NCM '{valor}' não encontrado na base.", base="ncm_regras.xlsx")
+template("CFOP_NAO_ENCONTRADO", "ERRO", "CFOP", "CFOP '{valor}' não encontrado na base.", base="cfop_regras.xlsx")
+
+
+def _code(s: pd.Series) -> pd.Series:
+    # mesmo tratamento de utils.validator._norm_code: str(x or "").strip()
+    return s.map(lambda x: str(x or "").strip())
+
+
+def _digits(s: pd.Series) -> pd.Series:
+    return s.str.replace(r"\D", "", regex=True)
+
+
+@register("FORMATO_NCM", stage="v2", columns=["NCM"], ordem=10)
+def formato_ncm(batch: pd.DataFrame, bl) -> pd.DataFrame:
+    """NCM com quantidade de dígitos diferente de 8."""
+    ncm = _code(batch["NCM"])
+    d = _digits(ncm)
+    n = d.str.len()
+    return findings_frame(
+        (d != "") & (n != 8),
+        regra="FORMATO_NCM", valor=ncm,
+    )
+
+
+@register("NCM_AUSENTE_OU_ZERADO", stage="v2", columns=["NCM"], ordem=20)
+def ncm_ausente(batch: pd.DataFrame, bl) -> pd.DataFrame:
+    """NCM vazio ou 00000000."""
+    ncm = _code(batch["NCM"])
+    d = _digits(ncm)
+    return findings_frame(
+        (d == "") | (d == "00000000"),
+        regra="NCM_AUSENTE_OU_ZERADO", valor=ncm.where(ncm != "", "(vazio)"),
+    )
+
+
+@register("FORMATO_CFOP", stage="v2", columns=["CFOP"], ordem=30)
+def formato_cfop(batch: pd.DataFrame, bl) -> pd.DataFrame:
+    """CFOP com quantidade de dígitos diferente de 4."""
+    cfop = _code(batch["CFOP"])
+    d = _digits(cfop)
+    n = d.str.len()
+    return findings_frame(
+        (d != "") & (n != 4),
+        regra="FORMATO_CFOP", valor=cfop,
+    )
+
+
+@register("CFOP_AUSENTE", stage="v2", columns=["CFOP"], ordem=40)
+def cfop_ausente(batch: pd.DataFrame, bl) -> pd.DataFrame:
+    """CFOP vazio."""
+    return findings_frame(
+        _digits(_code(batch["CFOP"])) == "",
+        regra="CFOP_AUSENTE", valor="",
+    )
+
+
+@register("CST_CSOSN", stage="v2", columns=["CST_ICMS", "CSOSN"], ordem=50)
+def cst_csosn(batch: pd.DataFrame, bl) -> pd.DataFrame:
+    """CSOSN/CST fora da tabela CST/CSOSN, ou nenhum dos dois no item."""
+    cst = _code(batch["CST_ICMS"])
+    csosn = _code(batch["CSOSN"])
+    has_csosn = csosn != ""
+    has_cst = ~has_csosn & (cst != "")
+    parts = []
+    if bl.csosn_set:
+        parts.append(findings_frame(
+            has_csosn & ~csosn.isin(bl.csosn_set),
+            regra="CSOSN_NAO_ENCONTRADO", valor=csosn,
+        ))
+    if bl.cst_set:
+        parts.append(findings_frame(
+            has_cst & ~cst.isin(bl.cst_set),
+            regra="CST_NAO_ENCONTRADO", valor=cst,
+        ))
+    parts.append(findings_frame(
+        ~has_csosn & ~has_cst,
+        regra="CST_CSOSN_AUSENTE", valor="",
+    ))
+    # as três situações são exclusivas por item
+    return pd.concat(parts, ignore_index=True)
+
+
+@register("NCM_NAO_ENCONTRADO", stage="v2", columns=["NCM"], ordem=60)
+def ncm_nao_encontrado(batch: pd.DataFrame, bl) -> pd.DataFrame:
+    """NCM informado que não consta na Tabela NCM."""
+    if not bl.ncm_set:
+        return None
+    norm = _digits(_code(batch["NCM"]))
+    norm8 = norm.str.zfill(8)
+    return findings_frame(
+        (norm != "") & ~norm8.isin(bl.ncm_set),
+        regra="NCM_NAO_ENCONTRADO", valor=norm8,
+    )
+
+
+@register("CFOP_NAO_ENCONTRADO", stage="v2", columns=["CFOP"], ordem=70)
+def cfop_nao_encontrado(batch: pd.DataFrame, bl) -> pd.DataFrame:
+    """CFOP informado que não consta na tabela CFOP."""
+    if not bl.cfop_set:
+        return None
+    norm = _digits(_code(batch["CFOP"]))
+    norm4 = norm.str.zfill(4)
+    return findings_frame(
+        (norm != "") & ~norm4.isin(bl.cfop_set),
+        regra="CFOP_NAO_ENCONTRADO", valor=norm4,
+    )
@@ -1,10 +1,8 @@
 from __future__ import annotations
-import xml.etree.ElementTree as ET
 from typing import Dict
 import re
 
-def _strip_ns(tag: str) -> str:
-    return tag.split("}", 1)[-1] if "}" in tag else tag
+from utils.xml_backend import get_backend, local_name as _strip_ns
 
 def _digits(s: str) -> str:
     return re.sub(r"\D+","", str(s or ""))
@@ -13,13 +11,13 @@ def rewrite_nfe_xml(xml_bytes: bytes, changes_by_nitem: Dict[str, Dict[str,str]]
     """Apply changes to NF-e XML by det@nItem.
     changes_by_nitem: { '1': {'NCM':'12345678', 'CFOP':'5102', 'CST':'060', 'CSOSN':'102'} }
     Only modifies present nodes.
+    Always serialized with ElementTree, so the corrected XML is byte-identical
+    whether or not lxml is installed (NFE_XML_BACKEND only affects parsing).
     """
-    root = ET.fromstring(xml_bytes)
+    xb = get_backend("etree")
+    root = xb.fromstring(xml_bytes)
     # find infNFe
-    infNFe=None
-    for el in root.iter():
-        if _strip_ns(el.tag)=="infNFe":
-            infNFe=el; break
+    infNFe = xb.find_first(root, "infNFe")
     if infNFe is None:
         return xml_bytes
 
@@ -65,4 +63,4 @@ def rewrite_nfe_xml(xml_bytes: bytes, changes_by_nitem: Dict[str, Dict[str,str]]
                             node.text = _digits(changes["CSOSN"]).zfill(3)[:3]
 
     # Serialize keeping encoding utf-8
-    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+    return xb.tostring(root)